@@ -1,25 +1,48 @@
 #!/usr/bin/env python3
 
 import os
+import argparse
 import sys
-import subprocess
 import json
-import ipaddress
-import socket
+import threading
+import time
+import shutil
+from pathlib import Path
+from packaging import version
+from contextlib import contextmanager
 
 from lib.logger import logger as log
-from lib.config import Config
+from lib.config import Config, config_load_started, launched_settings
 from lib.template import Template
+from lib.startup import StartupGraph
+from lib.metrics import instrumentation
+from lib.backoff import backoff_delays
+from lib import dns, httpserver
+from lib.maintenance import MaintenanceScheduler, run_maintenance
+from lib.exporter import Exporter, source_from_config
+from lib.readiness import ReadinessProbe
+from lib.warmup import Warmup, names_from_query_log, names_from_records
+from lib.supervisor import Supervisor, exec_command
+from lib.reload import ConfigWatcher
+from lib import snapshot
+from lib.autosecondary import (AutoprimaryRefresher, ResolverCache,
+                               load_autoprimaries, resolve_autoprimaries,
+                               sync_autoprimaries)
 
 # Set working directory
 os.chdir(os.path.dirname(os.path.realpath(__file__)))
 
 # Init
-renderer = Template()
+resolver_cache = ResolverCache(Config.autosecondary_cache_ttl)
+autoprimaries = []
+autoprimary_rows = []
+autoprimary_unresolved = []
 
 # Log the configuration for debuging. OBS! The password is visible. Do not run in a production environment
 log.debug(json.dumps(Config.pdns_conf, indent=2))
 log.debug(json.dumps(Config.autosecondary, indent=2))
+for note in Config.autotune_notes:
+    log.info(f"Autotune: {note}")
 
 
 def gen_pdns_version():
@@ -29,108 +52,759 @@ def gen_pdns_version():
     return result
 
 
-def get_ipv4_by_hostname(hostname):
-    return list(i[4][0] for i in socket.getaddrinfo(hostname, 0)
-                if i[0] is socket.AddressFamily.AF_INET
-                and i[1] is socket.SocketKind.SOCK_RAW)
+def is_primary():
+    return Config.pdns_conf.get('primary') == 'yes' or Config.pdns_conf.get(
+        'master') == 'yes'
+
+
+def is_secondary():
+    return Config.pdns_conf.get('secondary') == 'yes' or Config.pdns_conf.get(
+        'slave') == 'yes'
+
+
+def resolve_autosecondary():
+    autoprimaries[:] = load_autoprimaries(Config.autosecondary)
+    rows, unresolved = resolve_autoprimaries(autoprimaries, resolver_cache)
+    autoprimary_rows[:] = rows
+    autoprimary_unresolved[:] = unresolved
+    log.info(
+        f"Resolved {len(autoprimaries)} autoprimary(s) to {len(rows)} address(es)")
+
+
+def update_autosecondary(session):
+    if not autoprimaries:
+        log.debug("No autoprimaries configured")
+        return
+    sync_autoprimaries(session, autoprimary_rows, autoprimary_unresolved,
+                       Config.autosecondary_prune)
+
+
+def backend_module():
+    """
+        Module of the SQL backend. None when pdns_server only serves from LMDB without a SQL source.
+    """
+    backend = discover_backend()
+    if backend == 'gpgsql':
+        import lib.migrations.gpgsql as backend
+    elif backend == 'gsqlite3':
+        import lib.migrations.gsqlite3 as backend
+    else:
+        return None
+    return backend
+
+
+def discover_backend():
+    if "gpgsql" in Config.pdns_conf['launch']:
+        return 'gpgsql'
+    elif "gsqlite3" in Config.pdns_conf['launch']:
+        return 'gsqlite3'
+    elif "lmdb" in Config.pdns_conf['launch']:
+        return lmdb_source() or 'lmdb'
+    log.error("No backend discovered")
+    sys.exit(1)
+
+
+def lmdb_source():
+    """
+        SQL backend that is converted into LMDB. None unless pdns_server serves from LMDB alone.
+    """
+    launch = Config.pdns_conf['launch']
+    if "lmdb" not in launch or "gpgsql" in launch or "gsqlite3" in launch:
+        return None
+    if Config.lmdb_source in ('gpgsql', 'gsqlite3'):
+        return Config.lmdb_source
+    return None
+
+
+def convert_lmdb(force=False):
+    """
+        Size the LMDB map from the source database and convert the source into LMDB when needed.
+    """
+    from lib import lmdb
+
+    source = lmdb_source()
+    backend = backend_module()
+    if 'lmdb-map-size' not in Config.env_conf and 'lmdb-map-size' not in Config.file_conf:
+        zones, records = lmdb.count_rows(backend)
+        Config.derived_conf['lmdb-map-size'] = lmdb.map_size(
+            records, Config.lmdb_map_headroom)
+        Config.pdns_conf.update(Config.derived_conf)
+        log.info(
+            f"lmdb-map-size={Config.derived_conf['lmdb-map-size']} MB for {records} record(s)"
+        )
+    exists = lmdb.lmdb_exists(Config.pdns_conf['lmdb-filename'])
+    if force or Config.lmdb_convert == 'always' or (
+            Config.lmdb_convert == 'missing' and not exists):
+        lmdb.convert(source, backend, Config.pdns_conf)
+    elif not exists:
+        log.warning(
+            f"{Config.pdns_conf['lmdb-filename']} does not exist and LMDB_CONVERT=no. Starting with an empty LMDB"
+        )
+    else:
+        log.info(f"Serving the existing {Config.pdns_conf['lmdb-filename']}")
+
+
+def provision(session, backend):
+    """
+        Install, register autosecondaries and migrate using one database session.
+        A matching schema fingerprint in pdns_meta skips install and migrate entirely.
+    """
+    from lib.migrations.fingerprint import compute_fingerprint
+
+    backend_name = backend.__name__.split('.')[-1]
+    sql_update_schemas_path = os.path.join(Config.sql_update_schemas_path,
+                                           backend_name)
+    primary = is_primary()
+    secondary = is_secondary()
+
+    fingerprint = compute_fingerprint(
+        backend_name, sql_update_schemas_path, gen_pdns_version(),
+        [backend.sql_schema, backend.create_metadata_table])
+
+    def fingerprint_matches():
+        stamp = session.get_fingerprint() if Config.schema_fast_path else None
+        if stamp is not None and stamp[1] == fingerprint:
+            log.info(
+                f"Schema fingerprint matches database version {stamp[0]}. Skipping install and migration"
+            )
+            return True
+        return False
+
+    if not fingerprint_matches():
+        with session.lock():
+            # Another replica may have migrated while we were waiting for the lock
+            if not fingerprint_matches():
+                with instrumentation.span('install'):
+                    backend.install(
+                        session)  # Install fresh db only if it does not exists.
+                if primary or secondary:
+                    with instrumentation.span('migrate'):
+                        applied = backend.migrate(sql_update_schemas_path,
+                                                  gen_pdns_version(), session)
+                    session.set_fingerprint(fingerprint)
+                    session.commit()
+                    if applied and Config.maintenance_after_migrate:
+                        run_maintenance(session, backend.sql_schema,
+                                        Config.maintenance_vacuum)
+
+    if secondary:
+        update_autosecondary(session)
 
 
 def gpgsql():
-    from lib.migrations.gpgsql import install, migrate, execute_sql_schema, wait_for_db
+    import lib.migrations.gpgsql as backend
 
     log.debug("Discovered PostgreSQL")
-    sql_update_schemas_path = os.path.join(Config.sql_update_schemas_path,
-                                           'gpgsql')
-    wait_for_db()
-    install()  # Install fresh db only if it does not exists.
-    if Config.pdns_conf.get('primary') == 'yes' or Config.pdns_conf.get(
-            'master') == 'yes':
-        migrate(sql_update_schemas_path, gen_pdns_version())
-
-    elif Config.pdns_conf.get('secondary') == 'yes' or Config.pdns_conf.get(
-            'slave') == 'yes':
-        try:
-            ip_from_env = ipaddress.ip_address(
-                Config.autosecondary.get('AUTOSECONDARY_IP'))
-            log.debug("AUTOSECONDARY_IP is a correct IP")
-        except ValueError:
-            log.debug("AUTOSECONDARY_IP is NOT a correct IP")
-            try:
-                resolved_ip = get_ipv4_by_hostname(
-                    Config.autosecondary.get('AUTOSECONDARY_IP'))
-                Config.autosecondary.update(
-                    {'AUTOSECONDARY_IP': f'{resolved_ip}'})
-            except:
-                log.error(
-                    f"Unable to resolve {Config.autosecondary.get('AUTOSECONDARY_IP')}"
-                )
-        autosecondary_sql = os.path.join(Config.sql_schema_path,
-                                         "update_supermaster.pgsql.sql")
-        log.debug(f"Autosecondary SQL path: {autosecondary_sql}")
-        renderer.render_template(template=os.path.join(
-            Config.template_path, "update_supermaster.pgsql.sql.j2"),
-                                 output_file=autosecondary_sql)
-        execute_sql_schema(autosecondary_sql)
-        migrate(sql_update_schemas_path, gen_pdns_version())
+    with backend.Session() as session:
+        provision(session, backend)
 
 
 def gsqlite3():
-    from lib.migrations.gsqlite3 import install, migrate, execute_sql_schema
+    import lib.migrations.gsqlite3 as backend
 
     log.debug("Discovered SQLite")
-    sql_update_schemas_path = os.path.join(Config.sql_update_schemas_path,
-                                           'gsqlite3')
-    install()  # Install fresh db only if it does not exists.
-    if Config.pdns_conf.get('primary') == 'yes' or Config.pdns_conf.get(
-            'master') == 'yes':
-        migrate(sql_update_schemas_path, gen_pdns_version())
-
-    elif Config.pdns_conf.get('secondary') == 'yes' or Config.pdns_conf.get(
-            'slave') == 'yes':
+    if Config.snapshot_bootstrap:
+        bootstrap_snapshot()
+    Path(Config.gsqlite3_path).touch()
+    with backend.Session() as session:
+        provision(session, backend)
+
+
+def bootstrap_snapshot():
+    if not is_secondary():
+        log.warning("SNAPSHOT_BOOTSTRAP is only used by secondaries. Ignoring it")
+        return
+    primaries = Config.snapshot_primaries or sorted(
+        {ip for ip, nameserver, account in autoprimary_rows})
+    snapshot.bootstrap(Config.snapshot_bootstrap, Config.gsqlite3_path,
+                       primaries)
+
+
+@contextmanager
+def database_session():
+    """
+        Wait for the database, install/migrate it and yield an open session.
+        Used by the modes that work on the database instead of starting PowerDNS.
+    """
+    backend = backend_module()
+    if backend is None:
+        log.error("This mode needs a gsqlite3 or gpgsql database")
+        sys.exit(1)
+    if discover_backend() == 'gpgsql':
+        backend.wait_for_db()
+    else:
+        Path(Config.gsqlite3_path).touch()
+
+    with backend.Session() as session:
+        provision(session, backend)
+        yield session
+
+
+def bulk_import(args):
+    """
+        Load BIND zone files or JSON/CSV dumps straight into domains and records.
+    """
+    from lib.bulk import BulkLoader, read_zones
+
+    with database_session() as session:
+        loader = BulkLoader(session,
+                            batch_records=args.batch_records,
+                            commit_records=args.commit_records,
+                            defer_indexes=not args.keep_indexes)
+        loader.load(read_zones(args.paths, args.format, args.kind))
+    instrumentation.publish()
+
+
+def generate(args):
+    """
+        Fill a fresh database with a deterministic synthetic dataset and optionally write a dnsperf query file.
+    """
+    from lib.bulk import BulkLoader
+    from lib.synthetic import SyntheticDataset, write_query_file
+
+    if args.zones < 1 or args.records < 1:
+        log.error("--zones and --records must be at least 1")
+        sys.exit(1)
+    dataset = SyntheticDataset(args.seed, args.zones, args.records,
+                               args.dnssec_ratio, args.kind)
+    with database_session() as session:
+        if session.fetch_one("SELECT EXISTS (SELECT 1 FROM domains)"):
+            log.error(
+                "The database already holds zones. Generate into a fresh database so runs stay comparable"
+            )
+            sys.exit(1)
+        loader = BulkLoader(session,
+                            batch_records=args.batch_records,
+                            commit_records=args.commit_records)
+        with instrumentation.span('generate', seed=args.seed):
+            loader.load(dataset.zones())
+            keys = dataset.keys(loader.zone_ids)
+            session.insert_cryptokeys(keys)
+            session.commit()
+        log.info(f"Added DNSSEC keys to {len(keys)} zone(s)")
+    if args.query_file:
+        write_query_file(args.query_file,
+                         dataset.queries(args.queries, args.hit_ratio))
+    instrumentation.publish()
+
+
+def rectify(args):
+    """
+        Run pdnsutil rectify-zone (and secure-zone with --secure) on every zone with a pool of pdnsutil processes.
+    """
+    from lib.config import get_cpu_limit
+    from lib.zonework import Checkpoint, ZoneWorkerPool, list_zones
+
+    with database_session() as session:
+        zones = list_zones(session, args.include_secondaries)
+    render_pdns_conf()  # pdnsutil reads pdns.conf
+
+    workers = args.workers
+    if workers is None:
+        # SQLite has a single writer, more processes would only wait for each other
+        workers = 1 if discover_backend() == 'gsqlite3' else max(
+            int(get_cpu_limit()[0]), 1)
+    checkpoint_file = args.checkpoint or os.path.join(
+        '/var/lib/powerdns',
+        f"{'secure' if args.secure else 'rectify'}.checkpoint")
+    checkpoint = Checkpoint(checkpoint_file)
+    if args.restart:
+        checkpoint.remove()
+
+    def keyed_zones():
+        with backend_module().Session() as session:
+            return {name for name, keys in list_zones(session, True) if keys}
+
+    failed = ZoneWorkerPool(workers, args.batch_size, checkpoint,
+                            keyed_zones).run(zones, args.secure)
+    instrumentation.publish()
+    if failed:
+        log.error(
+            f"{len(failed)} zone(s) failed. Run again to retry them, completed zones are kept in {checkpoint_file}"
+        )
+        sys.exit(1)
+
+
+def lmdb_convert(args):
+    """
+        Convert the SQL database into LMDB now. A running pdns_server serves the new files after a restart.
+    """
+    if lmdb_source() is None:
+        log.error(
+            "Set launch=lmdb and LMDB_SOURCE to gsqlite3 or gpgsql to convert into LMDB")
+        sys.exit(1)
+    with database_session():
+        pass
+    convert_lmdb(force=True)
+    instrumentation.publish()
+
+
+def export(args):
+    """
+        Write a consistent snapshot of the SQLite database for bootstrapping secondaries.
+    """
+    if discover_backend() != 'gsqlite3':
+        log.error("Snapshots can only be exported from gsqlite3")
+        sys.exit(1)
+    with instrumentation.span('snapshot_export'):
+        snapshot.export_snapshot(Config.gsqlite3_path, args.destination)
+    instrumentation.publish()
+
+
+def restore(args):
+    """
+        Swap a pre-migration snapshot in for the SQLite database. pdns_server must not be running.
+    """
+    if discover_backend() != 'gsqlite3':
+        log.error("Snapshots can only be restored into gsqlite3")
+        sys.exit(1)
+    snapshots = snapshot.list_snapshots(Config.gsqlite3_path)
+    if args.list:
+        for path in snapshots:
+            print(path)
+        return
+    source = args.snapshot or (snapshots[-1] if snapshots else None)
+    if source is None:
+        log.error(
+            f"No snapshots in {snapshot.snapshot_dir(Config.gsqlite3_path)}")
+        sys.exit(1)
+    from lib.migrations import gsqlite3
+
+    with gsqlite3.Session().lock():
+        snapshot.restore_snapshot(Config.gsqlite3_path, source)
+    instrumentation.publish()
+
+
+def maintenance(args):
+    """
+        Run ANALYZE (and VACUUM with --vacuum) and the index health check once.
+    """
+    with database_session() as session:
+        problems = run_maintenance(session, backend_module().sql_schema,
+                                   args.vacuum or Config.maintenance_vacuum)
+    instrumentation.publish()
+    sys.exit(1 if problems else 0)
+
+
+def print_plan(args):
+    """
+        Print the upgrade chain for the configured backend without touching the database.
+    """
+    from lib.migrations.registry import get_registry, format_plan
+
+    backend = discover_backend()
+    registry = get_registry(
+        os.path.join(Config.sql_update_schemas_path, backend))
+    from_version = args.from_version or registry.base_version()
+    to_version = args.to_version or gen_pdns_version()
+    plan = registry.plan(from_version, to_version)
+    if plan is None:
+        log.error(f"No upgrade path from {from_version} to {to_version}")
+        sys.exit(1)
+
+    print(f"Upgrade plan for {backend}: {from_version} -> {to_version}")
+    if not plan:
+        print("Nothing to do")
+    for line in format_plan(plan):
+        print(f"  {line}")
+
+
+def wait_for_first_answer(running):
+    """
+        Measure the time from launching pdns_server until it answers a query, then publish the startup spans.
+    """
+    host, port = dns.local_target(Config.pdns_conf)
+    started = time.perf_counter()
+    deadline = started + Config.first_answer_timeout
+    delays = backoff_delays(0.01, 0.5, jitter=False)
+    while running() and time.perf_counter() < deadline:
         try:
-            ip_from_env = ipaddress.ip_address(
-                Config.autosecondary.get('AUTOSECONDARY_IP'))
-            log.debug("AUTOSECONDARY_IP is a correct IP")
-        except ValueError:
-            log.debug("AUTOSECONDARY_IP is NOT a correct IP")
-            try:
-                resolved_ip = get_ipv4_by_hostname(
-                    Config.autosecondary.get('AUTOSECONDARY_IP'))
-                Config.autosecondary.update(
-                    {'AUTOSECONDARY_IP': f'{resolved_ip}'})
-            except:
-                log.error(
-                    f"Unable to resolve {Config.autosecondary.get('AUTOSECONDARY_IP')}"
-                )
-        autosecondary_sql = os.path.join(Config.sql_schema_path,
-                                         "update_supermaster.sqlite3.sql")
-        log.debug(f"Autosecondary SQL path: {autosecondary_sql}")
-        renderer.render_template(template=os.path.join(
-            Config.template_path, "update_supermaster.sqlite3.sql.j2"),
-                                 output_file=autosecondary_sql)
-        execute_sql_schema(autosecondary_sql)
-        migrate(sql_update_schemas_path, gen_pdns_version())
-
-
-if "gpgsql" in Config.pdns_conf['launch']:
-    gpgsql()
-elif "gsqlite3" in Config.pdns_conf['launch']:
-    gsqlite3()
-else:
-    log.error("No backend discovered")
-    sys.exit(1)
+            dns.query(host, port, '.', 'SOA', timeout=0.5)
+            duration = time.perf_counter() - started
+            instrumentation.record('pdns_first_answer', duration)
+            instrumentation.record(
+                'startup_total',
+                time.perf_counter() - config_load_started)
+            log.info(
+                f"PowerDNS answered its first query after {duration * 1000:.0f} ms"
+            )
+            break
+        except (OSError, ValueError):
+            time.sleep(next(delays))
+    else:
+        log.warning("PowerDNS did not answer before the first answer timeout")
+    instrumentation.publish()
+
+
+def render_pdns_conf():
+    template = os.path.join(Config.template_path, "pdns.conf.j2")
+    Template(launched_settings(Config.pdns_conf)).render_template(
+        template=template, output_file="/etc/powerdns/pdns.conf")
+
+
+def prepare():
+    """
+        Render pdns.conf and install/migrate the database. Independent phases run in parallel.
+    """
+    backend = discover_backend()
+
+    graph = StartupGraph()
+    requires = []
+    if is_secondary():
+        graph.add('resolve_autosecondary', resolve_autosecondary)
+        requires.append('resolve_autosecondary')
+    if backend == 'gpgsql':
+        from lib.migrations.gpgsql import wait_for_db
+        graph.add('wait_for_db', wait_for_db)
+        graph.add('provision', gpgsql, requires + ['wait_for_db'])
+    elif backend == 'gsqlite3':
+        graph.add('provision', gsqlite3, requires)
+    if lmdb_source():
+        # The map size in pdns.conf is derived from the source database
+        graph.add('convert_lmdb', convert_lmdb, ['provision'])
+        graph.add('render_config', render_pdns_conf, ['convert_lmdb'])
+    else:
+        graph.add('render_config', render_pdns_conf)
+    graph.run()
+
+
+def init(args):
+    """
+        Prepare everything pdns_server needs and exit. For init containers and benchmarks.
+    """
+    prepare()
+    instrumentation.publish()
+
+
+def benchmark(args):
+    """
+        Measure cold starts and the migration chain on generated datasets and write the results as JSON.
+    """
+    from lib.benchmark import Benchmark, write_results
+    from lib.migrations.registry import get_registry
+
+    target = gen_pdns_version()
+    versions = args.from_versions
+    if not versions:
+        registry = get_registry(
+            os.path.join(Config.sql_update_schemas_path, 'gsqlite3'))
+        versions = [registry.base_version()
+                    ] + [migration.new for migration in registry.migrations()]
+    versions = [str(v) for v in versions if version.parse(str(v)) <= version.parse(target)]
+    if 'gpgsql' in args.backends and not Config.gpgsql_dbname:
+        log.error("Set the ENV_GPGSQL_* variables to benchmark gpgsql")
+        sys.exit(1)
+    serve = not args.no_server
+    if serve and shutil.which('pdns_server') is None:
+        log.warning("pdns_server not found. Measuring without starting it")
+        serve = False
+
+    results = Benchmark(os.path.realpath(__file__),
+                        args.workdir,
+                        args.sizes,
+                        versions,
+                        target,
+                        backends=args.backends,
+                        repeat=args.repeat,
+                        serve=serve,
+                        port=args.port,
+                        timeout=args.timeout,
+                        seed=args.seed).run()
+    write_results(args.output, results)
+
+
+def serve(args):
+    prepare()
+
+    # Launch PowerDNS
+    command1 = [
+        "pdns_server", "--guardian=no", "--daemon=no", "--disable-syslog",
+        "--write-pid=no"
+    ]
+    if Config.supervisor_mode == 'exec':
+        if Config.http_port or Config.ready_file or Config.warmup or Config.maintenance_interval > 0:
+            log.warning(
+                "SUPERVISOR_MODE=exec. HTTP endpoints, readiness, warm-up and scheduled maintenance are disabled"
+            )
+        instrumentation.publish()
+        exec_command(command1)
+
+    exporter = None
+    if Config.exporter_source in ('socket', 'api'):
+        exporter = Exporter(source_from_config(), Config.exporter_interval)
+
+    readiness = None
+    if Config.http_port or Config.ready_file:
+        readiness = ReadinessProbe(Config.ready_zones, backend_module(),
+                                   Config.ready_sample_zones,
+                                   Config.ready_file)
+
+    warmup = None
+    if Config.warmup and not Config.warmup_query_log and backend_module() is None:
+        log.warning("Warm-up without a SQL database needs WARMUP_QUERY_LOG. Skipping it")
+    elif Config.warmup:
+        if Config.warmup_query_log:
+            load_names = lambda: names_from_query_log(Config.warmup_query_log,
+                                                      Config.warmup_top)
+        else:
+            load_names = lambda: names_from_records(backend_module(),
+                                                    Config.warmup_top)
+        warmup = Warmup(load_names, Config.warmup_concurrency,
+                        Config.warmup_budget)
+        if readiness is not None:
+            readiness.add_gate(warmup.done, 'warming up caches')
+
+    if Config.http_port:
+        if readiness is not None:
+            httpserver.register('/ready', readiness.http_handler)
+        httpserver.register('/metrics', lambda: (
+            200, 'text/plain; version=0.0.4',
+            instrumentation.prometheus_text() +
+            (exporter.prometheus_text() if exporter else '')))
+        httpserver.start()
+
+    supervisor = Supervisor(command1,
+                            drain=readiness.drain if readiness else None,
+                            drain_seconds=Config.drain_seconds,
+                            stop_timeout=Config.stop_timeout,
+                            restart=Config.restart_on_failure,
+                            hold=readiness.hold if readiness else None,
+                            release=readiness.release if readiness else None)
+    log.info("Starting PowerDNS")
+    supervisor.start()
+    if exporter is not None:
+        exporter.start()
+    if warmup is not None:
+        warmup.start()
+    if readiness is not None:
+        readiness.start()
+    if is_secondary() and autoprimaries and Config.autosecondary_refresh and backend_module():
+        AutoprimaryRefresher(backend_module(), autoprimaries, resolver_cache,
+                             autoprimary_rows,
+                             Config.autosecondary_prune).start()
+    if Config.config_reload:
+        ConfigWatcher(supervisor, render_pdns_conf,
+                      Config.config_reload_interval).start()
+    if Config.maintenance_interval > 0 and backend_module():
+        MaintenanceScheduler(backend_module(), Config.maintenance_interval,
+                             Config.maintenance_vacuum).start()
+    threading.Thread(target=wait_for_first_answer,
+                     args=(supervisor.running, ),
+                     name='first-answer',
+                     daemon=True).start()
+    code = supervisor.run()
+    if readiness is not None:
+        readiness.stop()
+    log.info("PowerDNS stopped")
+    return code
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="PowerDNS authoritative container entrypoint")
+    parser.add_argument(
+        "--plan",
+        "--dry-run",
+        dest="plan",
+        action="store_true",
+        help="Print the schema upgrade chain and exit without touching the database")
+    parser.add_argument(
+        "--from",
+        dest="from_version",
+        help="Database version to plan from (default: oldest known schema)")
+    parser.add_argument(
+        "--to",
+        dest="to_version",
+        help="Version to plan to (default: the running PowerDNS version)")
+
+    modes = parser.add_subparsers(dest="mode", metavar="MODE")
+    import_parser = modes.add_parser(
+        "import", help="Bulk load zones into the database and exit")
+    import_parser.add_argument("paths",
+                               nargs="+",
+                               help="Zone files, JSON/CSV dumps or directories")
+    import_parser.add_argument(
+        "--format",
+        choices=["bind", "json", "csv"],
+        help="Input format (default: guessed from the file extension)")
+    import_parser.add_argument("--kind",
+                               default="NATIVE",
+                               choices=["NATIVE", "MASTER", "SLAVE"],
+                               help="Domain type of imported zones")
+    import_parser.add_argument("--batch-records",
+                               type=int,
+                               default=50000,
+                               help="Records written per COPY/executemany batch")
+    import_parser.add_argument("--commit-records",
+                               type=int,
+                               default=1000000,
+                               help="Records per transaction")
+    import_parser.add_argument(
+        "--keep-indexes",
+        action="store_true",
+        help="Do not drop the records indexes while loading an empty table")
+    import_parser.set_defaults(func=bulk_import)
+
+    maintenance_parser = modes.add_parser(
+        "maintenance",
+        help="Refresh planner statistics, check indexes and exit")
+    maintenance_parser.add_argument("--vacuum",
+                                    action="store_true",
+                                    help="Also VACUUM the tables")
+    maintenance_parser.set_defaults(func=maintenance)
+
+    generate_parser = modes.add_parser(
+        "generate",
+        help="Fill a fresh database with synthetic zones for load testing and exit")
+    generate_parser.add_argument("--seed",
+                                 type=int,
+                                 default=1,
+                                 help="Same seed, same dataset and queries")
+    generate_parser.add_argument("--zones",
+                                 type=int,
+                                 default=1000,
+                                 help="Number of zones")
+    generate_parser.add_argument("--records",
+                                 type=int,
+                                 default=100000,
+                                 help="Total number of records")
+    generate_parser.add_argument("--kind",
+                                 default="NATIVE",
+                                 choices=["NATIVE", "MASTER"],
+                                 help="Domain type of the zones")
+    generate_parser.add_argument(
+        "--dnssec-ratio",
+        type=float,
+        default=0.0,
+        help="Share of zones that get a DNSSEC key (0 to 1)")
+    generate_parser.add_argument(
+        "--query-file",
+        help="Write a dnsperf query file for the generated zones")
+    generate_parser.add_argument("--queries",
+                                 type=int,
+                                 default=100000,
+                                 help="Number of queries in the query file")
+    generate_parser.add_argument(
+        "--hit-ratio",
+        type=float,
+        default=0.9,
+        help="Share of queries for existing names, the rest are NXDOMAIN")
+    generate_parser.add_argument("--batch-records",
+                                 type=int,
+                                 default=50000,
+                                 help="Records written per COPY/executemany batch")
+    generate_parser.add_argument("--commit-records",
+                                 type=int,
+                                 default=1000000,
+                                 help="Records per transaction")
+    generate_parser.set_defaults(func=generate)
+
+    rectify_parser = modes.add_parser(
+        "rectify",
+        help="Rectify (and secure) every zone with parallel pdnsutil processes and exit")
+    rectify_parser.add_argument(
+        "--secure",
+        action="store_true",
+        help="Run secure-zone on zones without DNSSEC keys first")
+    rectify_parser.add_argument(
+        "--workers",
+        type=int,
+        help="Parallel pdnsutil processes (default: CPUs of the container, 1 for gsqlite3)")
+    rectify_parser.add_argument("--batch-size",
+                                type=int,
+                                default=50,
+                                help="Zones per pdnsutil call")
+    rectify_parser.add_argument(
+        "--checkpoint",
+        help="File of completed zones (default: /var/lib/powerdns/<rectify|secure>.checkpoint)")
+    rectify_parser.add_argument("--restart",
+                                action="store_true",
+                                help="Ignore the checkpoint and start over")
+    rectify_parser.add_argument("--include-secondaries",
+                                action="store_true",
+                                help="Also process secondary zones")
+    rectify_parser.set_defaults(func=rectify)
+
+    lmdb_parser = modes.add_parser(
+        "convert-lmdb",
+        help="Convert the gsqlite3/gpgsql database into LMDB and exit")
+    lmdb_parser.set_defaults(func=lmdb_convert)
+
+    export_parser = modes.add_parser(
+        "export",
+        help="Write a snapshot of the SQLite database for secondaries and exit")
+    export_parser.add_argument("destination",
+                               help="Snapshot file, replaced atomically")
+    export_parser.set_defaults(func=export)
+
+    restore_parser = modes.add_parser(
+        "restore",
+        help="Replace the SQLite database with a pre-migration snapshot and exit")
+    restore_parser.add_argument("snapshot",
+                                nargs="?",
+                                help="Snapshot file (default: the latest)")
+    restore_parser.add_argument("--list",
+                                action="store_true",
+                                help="List the snapshots, oldest first")
+    restore_parser.set_defaults(func=restore)
+
+    init_parser = modes.add_parser(
+        "init",
+        help="Render pdns.conf, install/migrate the database and exit")
+    init_parser.set_defaults(func=init)
+
+    benchmark_parser = modes.add_parser(
+        "benchmark",
+        help="Measure cold start, migrations and time to first answer")
+    benchmark_parser.add_argument("--output",
+                                  default="benchmark.json",
+                                  help="JSON file for the results")
+    benchmark_parser.add_argument("--workdir",
+                                  default="/tmp/pdns-benchmark",
+                                  help="Datasets and run databases. Datasets are reused")
+    benchmark_parser.add_argument(
+        "--sizes",
+        type=lambda value: [int(size) for size in value.split(',')],
+        default=[10000, 100000, 1000000],
+        help="Comma separated record counts")
+    benchmark_parser.add_argument(
+        "--from",
+        dest="from_versions",
+        type=lambda value: value.split(','),
+        help="Comma separated schema versions to migrate from (default: all)")
+    benchmark_parser.add_argument(
+        "--backends",
+        type=lambda value: value.split(','),
+        default=["gsqlite3"],
+        help="gsqlite3 and/or gpgsql (uses the ENV_GPGSQL_* server)")
+    benchmark_parser.add_argument("--repeat",
+                                  type=int,
+                                  default=3,
+                                  help="Runs per combination")
+    benchmark_parser.add_argument("--seed", type=int, default=1)
+    benchmark_parser.add_argument(
+        "--no-server",
+        action="store_true",
+        help="Stop after install/migrate instead of waiting for the first answer")
+    benchmark_parser.add_argument("--port",
+                                  type=int,
+                                  default=5300,
+                                  help="Port pdns_server listens on")
+    benchmark_parser.add_argument("--timeout",
+                                  type=float,
+                                  default=600,
+                                  help="Seconds a single run may take")
+    benchmark_parser.set_defaults(func=benchmark)
+
+    args = parser.parse_args()
+
+    if args.plan:
+        print_plan(args)
+    elif args.mode:
+        args.func(args)
+    else:
+        sys.exit(serve(args))
+
 
-# Write PowerDNS configuration
-template = os.path.join(Config.template_path, "pdns.conf.j2")
-renderer.render_template(template=template,
-                         output_file="/etc/powerdns/pdns.conf")
-
-# Launch PowerDNS
-command1 = [
-    "pdns_server", "--guardian=no", "--daemon=no", "--disable-syslog",
-    "--write-pid=no"
-]
-log.info("Starting PowerDNS")
-process = subprocess.Popen(command1, shell=False)
-process.wait()
-log.info("PowerDNS stopped")
+if __name__ == "__main__":
+    main()
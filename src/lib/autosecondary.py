@@ -0,0 +1,221 @@
+import csv
+import time
+import socket
+import logging
+import ipaddress
+import threading
+from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor
+
+from lib.config import Config
+from lib import dns
+'''
+    Autoprimaries of a secondary: read from indexed AUTOSECONDARY_<n>_* variables and/or a file,
+    resolved concurrently to all their A/AAAA addresses and synchronized into the supermasters table.
+'''
+
+log_name = f'{Config.logger_name}.autosecondary'
+log = logging.getLogger(log_name)
+
+Autoprimary = namedtuple('Autoprimary', ['host', 'nameserver', 'account'])
+
+
+def read_autoprimary_file(file_path):
+    """
+        One autoprimary per line: host,nameserver[,account] (whitespace separated works too).
+    """
+    autoprimaries = []
+    with open(file_path, 'r', newline='') as f:
+        for row in csv.reader(line.replace(' ', ',') for line in f):
+            fields = [field.strip() for field in row if field.strip()]
+            if not fields or fields[0].startswith('#'):
+                continue
+            if len(fields) < 2:
+                log.warning(f"Ignoring autoprimary without nameserver: {row}")
+                continue
+            autoprimaries.append(
+                Autoprimary(fields[0], fields[1],
+                            fields[2] if len(fields) > 2 else ''))
+    return autoprimaries
+
+
+def load_autoprimaries(variables):
+    """
+        Autoprimaries from AUTOSECONDARY_IP/NAMESERVER/ACCOUNT (or SUPERSLAVE_*),
+        AUTOSECONDARY_<n>_IP/NAMESERVER/ACCOUNT and the file in AUTOSECONDARY_FILE.
+    """
+    autoprimaries = []
+    for prefix in ('AUTOSECONDARY', 'SUPERSLAVE'):
+        if variables.get(f'{prefix}_IP'):
+            autoprimaries.append(
+                Autoprimary(variables[f'{prefix}_IP'],
+                            variables.get(f'{prefix}_NAMESERVER', ''),
+                            variables.get(f'{prefix}_ACCOUNT', '')))
+            break
+    indexes = sorted(
+        int(key.split('_')[1]) for key in variables
+        if key.startswith('AUTOSECONDARY_') and key.endswith('_IP')
+        and key.split('_')[1].isdigit())
+    for index in indexes:
+        prefix = f'AUTOSECONDARY_{index}'
+        autoprimaries.append(
+            Autoprimary(variables[f'{prefix}_IP'],
+                        variables.get(f'{prefix}_NAMESERVER', ''),
+                        variables.get(f'{prefix}_ACCOUNT', '')))
+    if variables.get('AUTOSECONDARY_FILE'):
+        autoprimaries += read_autoprimary_file(variables['AUTOSECONDARY_FILE'])
+    missing = [a.host for a in autoprimaries if not a.nameserver]
+    if missing:
+        log.warning(f"Ignoring autoprimaries without nameserver: {missing}")
+    return [a for a in autoprimaries if a.nameserver]
+
+
+class ResolverCache:
+    """
+        Resolves names to all their IPv4 and IPv6 addresses and keeps them for the lowest TTL of the answer.
+        Names that are not in DNS (/etc/hosts, ...) fall back to getaddrinfo and are kept for fallback_ttl.
+    """
+    def __init__(self, fallback_ttl=60, timeout=2.0):
+        self.log_name = f"{log_name}.{self.__class__.__name__}"
+        self.log = logging.getLogger(self.log_name)
+        self.fallback_ttl = fallback_ttl
+        self.timeout = timeout
+        self.lock = threading.Lock()
+        self.entries = {}  # name -> (addresses, expires)
+        self.nameservers, self.search, self.ndots = dns.read_resolv_conf()
+
+    def candidates(self, name):
+        if name.endswith('.'):
+            return [name]
+        searched = [f"{name}.{domain}" for domain in self.search]
+        return [name] + searched if name.count('.') >= self.ndots else searched + [name]
+
+    def query_dns(self, name):
+        for candidate in self.candidates(name):
+            addresses = []
+            for qtype in ('A', 'AAAA'):
+                for nameserver in self.nameservers:
+                    try:
+                        rcode, found = dns.lookup(nameserver, 53, candidate,
+                                                  qtype, self.timeout)
+                    except (OSError, ValueError):
+                        continue
+                    addresses += found
+                    break
+            if addresses:
+                return addresses
+        return []
+
+    def query_system(self, name):
+        infos = socket.getaddrinfo(name, None, proto=socket.IPPROTO_TCP)
+        return [(info[4][0], self.fallback_ttl) for info in infos
+                if info[0] in (socket.AF_INET, socket.AF_INET6)]
+
+    def resolve(self, name):
+        """
+            Sorted list of the addresses of name. Empty if it does not resolve.
+        """
+        try:
+            return [str(ipaddress.ip_address(name))]
+        except ValueError:
+            pass
+        now = time.monotonic()
+        with self.lock:
+            entry = self.entries.get(name)
+        if entry is not None and entry[1] > now:
+            return entry[0]
+
+        answers = self.query_dns(name)
+        if not answers:
+            try:
+                answers = self.query_system(name)
+            except OSError as error:
+                self.log.error(f"Unable to resolve {name}: {error}")
+                return []
+        addresses = sorted({address for address, ttl in answers})
+        ttl = max(min(ttl for address, ttl in answers), 1)
+        with self.lock:
+            self.entries[name] = (addresses, now + ttl)
+        self.log.debug(f"{name} -> {addresses} (ttl {ttl}s)")
+        return addresses
+
+    def next_expiry(self):
+        with self.lock:
+            return min((expires for addresses, expires in self.entries.values()),
+                       default=None)
+
+
+def resolve_autoprimaries(autoprimaries, cache, max_workers=16):
+    """
+        (ip, nameserver, account) rows for every address of every autoprimary and the hosts that did not resolve.
+        Hosts are resolved concurrently.
+    """
+    hosts = sorted({a.host for a in autoprimaries})
+    if not hosts:
+        return [], []
+    with ThreadPoolExecutor(max_workers=min(max_workers, len(hosts)),
+                            thread_name_prefix='resolve') as executor:
+        resolved = dict(zip(hosts, executor.map(cache.resolve, hosts)))
+    rows = {}
+    for a in autoprimaries:
+        for address in resolved[a.host]:
+            rows[(address, a.nameserver.lower())] = (address,
+                                                     a.nameserver.lower(),
+                                                     a.account)
+    return list(rows.values()), [host for host in hosts if not resolved[host]]
+
+
+def sync_autoprimaries(session, rows, unresolved, prune=True):
+    """
+        Upsert rows into supermasters and remove stale entries.
+        Nothing is removed while a host does not resolve, its entries could be removed by mistake.
+    """
+    if unresolved:
+        log.warning(f"Unable to resolve {unresolved}. Not removing stale entries")
+    if not rows:
+        log.error("None of the autoprimaries resolved. Keeping supermasters as it is")
+        return
+    removed = session.sync_autoprimaries(rows, prune and not unresolved)
+    session.commit()
+    log.info(
+        f"Synchronized {len(rows)} autoprimary address(es), removed {removed} stale entr{'y' if removed == 1 else 'ies'}"
+    )
+
+
+class AutoprimaryRefresher(threading.Thread):
+    """
+        Resolves the autoprimaries again when their cached addresses expire and synchronizes changes.
+    """
+    def __init__(self, backend, autoprimaries, cache, rows, prune=True):
+        super().__init__(name='autoprimary-refresh', daemon=True)
+        self.log_name = f"{log_name}.{self.__class__.__name__}"
+        self.log = logging.getLogger(self.log_name)
+        self.backend = backend
+        self.autoprimaries = autoprimaries
+        self.cache = cache
+        self.rows = sorted(rows)
+        self.prune = prune
+        self.stopped = threading.Event()
+
+    def run(self):
+        while True:
+            expiry = self.cache.next_expiry()
+            delay = max(expiry - time.monotonic(), 5) if expiry else 300
+            if self.stopped.wait(delay):
+                return
+            rows, unresolved = resolve_autoprimaries(self.autoprimaries,
+                                                     self.cache)
+            rows = sorted(rows)
+            if rows == self.rows or not rows:
+                continue
+            self.log.info("Autoprimary addresses changed")
+            try:
+                with self.backend.Session() as session:
+                    sync_autoprimaries(session, rows, unresolved, self.prune)
+                self.rows = rows
+            except SystemExit:
+                # Database helpers exit on errors. Try again on the next expiry
+                self.log.error("Unable to synchronize the autoprimaries")
+
+    def stop(self):
+        self.stopped.set()
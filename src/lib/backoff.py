@@ -0,0 +1,13 @@
+import random
+
+
+def backoff_delays(initial, maximum, factor=2.0, jitter=True):
+    """
+        Yield exponentially growing delays starting at initial and capped at maximum.
+        With jitter each delay is drawn from [delay / 2, delay] so that many
+        containers started at the same time do not retry in lockstep.
+    """
+    delay = initial
+    while True:
+        yield random.uniform(delay / 2, delay) if jitter else delay
+        delay = min(delay * factor, maximum)
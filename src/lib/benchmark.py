@@ -0,0 +1,333 @@
+import os
+import sys
+import json
+import time
+import queue
+import shutil
+import signal
+import logging
+import platform
+import tempfile
+import threading
+import statistics
+import subprocess
+
+from lib.config import Config
+'''
+    Benchmark of the container start. Every run is a fresh entrypoint.py process against a copy of a generated
+    dataset at an older schema version, so config load, install, migrate, template rendering and the time
+    until pdns_server answers are measured the way a container starts. The spans the child publishes are
+    collected into a JSON file.
+'''
+
+log_name = f'{Config.logger_name}.benchmark'
+log = logging.getLogger(log_name)
+
+# Settings of the environment that would change what a run measures or collide between runs
+cleared_variables = ('HTTP_PORT', 'READY_FILE', 'METRICS_TEXTFILE',
+                     'SNAPSHOT_BOOTSTRAP', 'WARMUP_QUERY_LOG')
+backend_variables = {
+    'gsqlite3': 'ENV_GPGSQL_',
+    'gpgsql': 'ENV_GSQLITE3_',
+}
+
+
+def version_digits(version):
+    """
+        4.1.0 -> 41, the format of POWERDNS_VERSION.
+    """
+    major, minor = str(version).split('.')[:2]
+    return f'{major}{minor}'
+
+
+def span_key(span):
+    labels = ','.join(str(value) for key, value in sorted(span['labels'].items()))
+    return f"{span['name']}:{labels}" if labels else span['name']
+
+
+def summarize_spans(spans):
+    """
+        {name[:labels]: seconds}. Spans that repeat with the same labels are added up.
+    """
+    summary = {}
+    for span in spans:
+        key = span_key(span)
+        summary[key] = round(summary.get(key, 0) + span['duration_seconds'], 6)
+    return summary
+
+
+def median_summary(runs):
+    keys = sorted({key for run in runs for key in run})
+    return {
+        key: round(statistics.median(run[key] for run in runs if key in run), 6)
+        for key in keys
+    }
+
+
+class ChildProcess:
+    """
+        entrypoint.py as a child. Output is read on a thread and the published spans are handed over on a queue.
+    """
+    def __init__(self, command, env):
+        self.started = time.perf_counter()
+        self.process = subprocess.Popen(command,
+                                        env=env,
+                                        stdout=subprocess.PIPE,
+                                        stderr=subprocess.STDOUT,
+                                        universal_newlines=True)
+        self.published = queue.Queue()
+        self.tail = []
+        self.reader = threading.Thread(target=self.read,
+                                       name='benchmark-output',
+                                       daemon=True)
+        self.reader.start()
+
+    def read(self):
+        for line in self.process.stdout:
+            self.tail = (self.tail + [line.rstrip()])[-20:]
+            if '{"version"' in line:
+                try:
+                    self.published.put(
+                        (time.perf_counter() - self.started,
+                         json.loads(line[line.index('{"version"'):])))
+                except ValueError:
+                    pass
+        self.published.put(None)
+
+    def wait_published(self, timeout):
+        """
+            (seconds since the start, published spans) or None if the child exited without publishing.
+        """
+        try:
+            return self.published.get(timeout=timeout)
+        except queue.Empty:
+            return None
+
+    def stop(self, terminate=True, timeout=30):
+        """
+            Wait for the child to exit, after a SIGTERM when terminate is set. Returns its exit code.
+        """
+        if self.process.poll() is None:
+            if terminate:
+                self.process.send_signal(signal.SIGTERM)
+            try:
+                self.process.wait(timeout)
+            except subprocess.TimeoutExpired:
+                self.process.kill()
+                self.process.wait()
+        self.reader.join(5)
+        return self.process.returncode
+
+
+class Benchmark:
+    def __init__(self,
+                 entrypoint,
+                 workdir,
+                 sizes,
+                 versions,
+                 target_version,
+                 backends=('gsqlite3', ),
+                 repeat=3,
+                 serve=True,
+                 port=5300,
+                 timeout=600,
+                 seed=1):
+        self.log_name = f"{log_name}.{self.__class__.__name__}"
+        self.log = logging.getLogger(self.log_name)
+        self.entrypoint = entrypoint
+        self.workdir = os.path.abspath(workdir)
+        self.sizes = sizes
+        self.versions = versions
+        self.target_version = target_version
+        self.backends = backends
+        self.repeat = repeat
+        self.serve = serve
+        self.port = port
+        self.timeout = timeout
+        self.seed = seed
+        os.makedirs(self.workdir, exist_ok=True)
+
+    def child_env(self, backend, version, database):
+        env = {
+            key: value
+            for key, value in os.environ.items()
+            if key not in cleared_variables
+            and not key.startswith(backend_variables[backend])
+        }
+        env.update({
+            'POWERDNS_VERSION': version_digits(version),
+            'LOG_LEVEL': 'INFO',
+            'SUPERVISOR_MODE': 'supervise',
+            'RESTART_ON_FAILURE': 'no',
+            'DRAIN_SECONDS': '0',
+            'WARMUP': 'no',
+            'EXPORTER': 'no',
+            'CONFIG_RELOAD': 'no',
+            'MAINTENANCE_INTERVAL': '0',
+            'FIRST_ANSWER_TIMEOUT': str(self.timeout),
+            'ENV_LAUNCH': backend,
+            'ENV_PRIMARY': 'yes',
+            'ENV_SECONDARY': 'no',
+            'ENV_LOCAL_ADDRESS': '127.0.0.1',
+            'ENV_LOCAL_PORT': str(self.port),
+            'ENV_SOCKET_DIR': self.workdir,
+            'ENV_SETUID': str(os.getuid()),
+            'ENV_SETGID': str(os.getgid()),
+        })
+        if backend == 'gpgsql':
+            env['ENV_GPGSQL_DBNAME'] = database
+        else:
+            env['ENV_GSQLITE3_DATABASE'] = database
+        return env
+
+    def run_child(self, args, env, wait_for_answer=False):
+        """
+            Run entrypoint.py with args. Returns (wall seconds until the spans were published, spans).
+            A serving child is stopped once it published.
+        """
+        child = ChildProcess([sys.executable, self.entrypoint] + args, env)
+        published = child.wait_published(self.timeout)
+        code = child.stop(terminate=wait_for_answer)
+        if published is None or (not wait_for_answer and code != 0):
+            self.log.error(f"entrypoint.py {' '.join(args)} failed with code {code}")
+            for line in child.tail:
+                self.log.error(f"  {line}")
+            sys.exit(1)
+        wall, data = published
+        if wait_for_answer and not any(span['name'] == 'pdns_first_answer'
+                                       for span in data['spans']):
+            self.log.error("pdns_server did not answer within the timeout")
+            sys.exit(1)
+        return wall, data['spans']
+
+    # Datasets are generated once per backend, version and size and copied for every run
+
+    def dataset_name(self, backend, version, records):
+        name = f"bench_{version_digits(version)}_{records}_{self.seed}"
+        if backend == 'gpgsql':
+            return f"{Config.gpgsql_dbname}_{name}"
+        return os.path.join(self.workdir, f"{name}.db")
+
+    def run_database(self, backend):
+        if backend == 'gpgsql':
+            return f"{Config.gpgsql_dbname}_bench_run"
+        return os.path.join(self.workdir, 'run.db')
+
+    def admin_connection(self):
+        import psycopg2
+
+        conn = psycopg2.connect(dbname='postgres',
+                                user=Config.gpgsql_user,
+                                password=Config.gpgsql_password,
+                                host=Config.gpgsql_host,
+                                port=Config.gpgsql_port)
+        conn.autocommit = True
+        return conn
+
+    def database_exists(self, backend, name):
+        if backend != 'gpgsql':
+            return os.path.exists(name)
+        conn = self.admin_connection()
+        try:
+            with conn.cursor() as cursor:
+                cursor.execute("select 1 from pg_database where datname = %s",
+                               (name, ))
+                return cursor.fetchone() is not None
+        finally:
+            conn.close()
+
+    def recreate_database(self, backend, name, template=None):
+        """
+            Drop name and create it empty or as a copy of template.
+        """
+        if backend != 'gpgsql':
+            for suffix in ('', '-wal', '-shm', '.migrate.lock'):
+                if os.path.exists(name + suffix):
+                    os.unlink(name + suffix)
+            if template is not None:
+                shutil.copyfile(template, name)
+            return
+        conn = self.admin_connection()
+        try:
+            with conn.cursor() as cursor:
+                cursor.execute(f'drop database if exists "{name}"')
+                cursor.execute(f'create database "{name}"' +
+                               (f' template "{template}"' if template else ''))
+        finally:
+            conn.close()
+
+    def dataset(self, backend, version, records):
+        """
+            Name of the dataset, generated with the schema of version. Returns (name, seconds spent generating).
+        """
+        name = self.dataset_name(backend, version, records)
+        if self.database_exists(backend, name):
+            self.log.info(f"Reusing dataset {name}")
+            return name, None
+        self.log.info(f"Generating {records} records at {version} into {name}")
+        self.recreate_database(backend, name)
+        started = time.perf_counter()
+        self.run_child([
+            'generate', '--seed',
+            str(self.seed), '--records',
+            str(records), '--zones',
+            str(max(records // 100, 1))
+        ], self.child_env(backend, version, name))
+        return name, round(time.perf_counter() - started, 6)
+
+    def measure(self, backend, template):
+        database = self.run_database(backend)
+        self.recreate_database(backend, database, template)
+        args = [] if self.serve else ['init']
+        wall, spans = self.run_child(args,
+                                     self.child_env(backend,
+                                                    self.target_version,
+                                                    database),
+                                     wait_for_answer=self.serve)
+        return dict(summarize_spans(spans), wall_seconds=round(wall, 6))
+
+    def run(self):
+        results = []
+        for backend in self.backends:
+            for records in self.sizes:
+                for version in self.versions:
+                    template, generated = self.dataset(backend, version,
+                                                       records)
+                    runs = []
+                    for i in range(self.repeat):
+                        runs.append(self.measure(backend, template))
+                        self.log.info(
+                            f"{backend} {records} records from {version}: run {i + 1}/{self.repeat} "
+                            f"took {runs[-1]['wall_seconds']:.3f}s")
+                    results.append({
+                        'backend': backend,
+                        'records': records,
+                        'zones': max(records // 100, 1),
+                        'from_version': str(version),
+                        'to_version': str(self.target_version),
+                        'dataset_seconds': generated,
+                        'runs': runs,
+                        'median': median_summary(runs),
+                    })
+        return {
+            'created': time.strftime('%Y-%m-%dT%H:%M:%SZ', time.gmtime()),
+            'powerdns_version': str(Config.powerdns_app_version),
+            'mode': 'serve' if self.serve else 'init',
+            'seed': self.seed,
+            'repeat': self.repeat,
+            'python': platform.python_version(),
+            'cpus': os.cpu_count(),
+            'results': results,
+        }
+
+
+def write_results(file_path, results):
+    """
+        Write the results atomically so a CI job never picks up a partial file.
+    """
+    directory = os.path.dirname(os.path.abspath(file_path))
+    fd, tmp_path = tempfile.mkstemp(dir=directory, prefix='.benchmark.')
+    with os.fdopen(fd, 'w') as f:
+        json.dump(results, f, indent=2)
+    os.replace(tmp_path, file_path)
+    log.info(f"Wrote benchmark results to {file_path}")
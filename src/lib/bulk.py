@@ -0,0 +1,404 @@
+import os
+import re
+import csv
+import json
+import time
+import logging
+from collections import namedtuple
+
+from lib.config import Config
+from lib.metrics import instrumentation
+'''
+    Bulk loading of zones into the domains and records tables.
+    Readers turn BIND zone files, JSON and CSV dumps into Zone objects and
+    BulkLoader writes them through a backend Session (COPY for gpgsql, executemany for gsqlite3).
+'''
+
+log_name = f'{Config.logger_name}.bulk'
+log = logging.getLogger(log_name)
+
+Zone = namedtuple('Zone', ['name', 'kind', 'master', 'account', 'records'])
+# Record rows as stored in the records table, without domain_id
+Record = namedtuple('Record',
+                    ['name', 'type', 'content', 'ttl', 'prio', 'disabled'])
+
+# Positions of domain names in the rdata of types that need to be made absolute
+rdata_name_fields = {
+    'NS': [0],
+    'CNAME': [0],
+    'PTR': [0],
+    'DNAME': [0],
+    'MX': [1],
+    'SRV': [3],
+    'SOA': [0, 1],
+}
+
+ttl_units = {'s': 1, 'm': 60, 'h': 3600, 'd': 86400, 'w': 604800}
+ttl_pattern = re.compile(r'^(\d+[smhdw]?)+$', re.IGNORECASE)
+
+
+def normalize_name(name):
+    return name.rstrip('.').lower() if name != '.' else '.'
+
+
+def parse_ttl(value):
+    if value.isdigit():
+        return int(value)
+    total = 0
+    for number, unit in re.findall(r'(\d+)([smhdw]?)', value.lower()):
+        total += int(number) * ttl_units.get(unit or 's')
+    return total
+
+
+def qualify(name, origin):
+    """
+        Make a zone file name absolute (without the trailing dot).
+    """
+    if name == '@':
+        return origin
+    if name.endswith('.'):
+        return normalize_name(name)
+    return f"{name}.{origin}".lower() if origin else name.lower()
+
+
+def tokenize(line):
+    """
+        Split a zone file line into tokens. Quoted strings are kept with their quotes and comments are dropped.
+    """
+    tokens = []
+    token = ''
+    quoted = False
+    escaped = False
+    for char in line:
+        if escaped:
+            token += char
+            escaped = False
+        elif char == '\\':
+            token += char
+            escaped = True
+        elif char == '"':
+            token += char
+            quoted = not quoted
+        elif quoted:
+            token += char
+        elif char == ';':
+            break
+        elif char in '()':
+            if token:
+                tokens.append(token)
+                token = ''
+            tokens.append(char)
+        elif char.isspace():
+            if token:
+                tokens.append(token)
+                token = ''
+        else:
+            token += char
+    if token:
+        tokens.append(token)
+    return tokens
+
+
+def logical_lines(f):
+    """
+        Join lines that are continued with parentheses. Yields (first line number, starts with whitespace, tokens).
+    """
+    depth = 0
+    tokens = []
+    indented = False
+    first = 0
+    for number, line in enumerate(f, 1):
+        if depth == 0:
+            indented = line[:1].isspace()
+            first = number
+        for token in tokenize(line):
+            if token == '(':
+                depth += 1
+            elif token == ')':
+                depth -= 1
+            else:
+                tokens.append(token)
+        if depth == 0 and tokens:
+            yield first, indented, tokens
+            tokens = []
+    if tokens:
+        yield first, indented, tokens
+
+
+def read_bind_zone(file_path, origin=None, kind='NATIVE'):
+    """
+        Parse a BIND zone file. The zone name is taken from the argument, $ORIGIN or the file name.
+    """
+    if origin is None:
+        origin = os.path.basename(file_path)
+        for suffix in ('.zone', '.db', '.txt'):
+            if origin.endswith(suffix):
+                origin = origin[:-len(suffix)]
+    zone_name = normalize_name(origin)
+    origin = zone_name
+    default_ttl = 3600
+    owner = origin
+    records = []
+    with open(file_path, 'r') as f:
+        for number, indented, tokens in logical_lines(f):
+            if tokens[0].upper() in ('$ORIGIN', '$TTL') and len(tokens) < 2:
+                log.error(f"{file_path}:{number}: {tokens[0]} without a value. Skipping")
+                continue
+            if tokens[0].upper() == '$ORIGIN':
+                origin = normalize_name(tokens[1])
+                continue
+            if tokens[0].upper() == '$TTL':
+                default_ttl = parse_ttl(tokens[1])
+                continue
+            if tokens[0].startswith('$'):
+                log.warning(f"Ignoring unsupported directive {tokens[0]}")
+                continue
+            if not indented:
+                owner = qualify(tokens.pop(0), origin)
+
+            ttl = default_ttl
+            while tokens and (ttl_pattern.match(tokens[0])
+                              or tokens[0].upper() in ('IN', 'CH', 'HS')):
+                token = tokens.pop(0)
+                if ttl_pattern.match(token):
+                    ttl = parse_ttl(token)
+            if not tokens:
+                continue
+            rtype = tokens.pop(0).upper()
+            rdata = list(tokens)
+            for position in rdata_name_fields.get(rtype, []):
+                if position < len(rdata) and rdata[position] != '.':
+                    rdata[position] = qualify(rdata[position], origin)
+            records.append(
+                Record(owner, rtype, ' '.join(rdata), ttl, 0, False))
+    return Zone(zone_name, kind, None, None, records)
+
+
+def zone_from_dict(data, kind='NATIVE'):
+    return Zone(
+        normalize_name(data['name']), data.get('kind', kind).upper(),
+        data.get('master'), data.get('account'), [
+            Record(normalize_name(r['name']), r['type'].upper(), r['content'],
+                   int(r.get('ttl', 3600)), int(r.get('prio') or 0),
+                   bool(r.get('disabled', False)))
+            for r in data.get('records', [])
+        ])
+
+
+def read_json(file_path, kind='NATIVE'):
+    """
+        Read zones from a JSON array, an object with a "zones" key or JSON lines (one zone per line).
+    """
+    with open(file_path, 'r') as f:
+        first = f.read(1)
+        while first and first.isspace():
+            first = f.read(1)
+        f.seek(0)
+        if first == '[' or file_path.endswith('.json') and first == '{':
+            try:
+                data = json.load(f)
+            except ValueError as error:
+                log.error(f"{file_path}: {error}. Skipping the file")
+                return
+            for index, zone in enumerate(
+                    data.get('zones', []) if isinstance(data, dict) else data):
+                try:
+                    yield zone_from_dict(zone, kind)
+                except (ValueError, KeyError, TypeError, AttributeError) as error:
+                    log.error(f"{file_path}: zone {index}: bad value {error}. Skipping")
+        else:
+            for number, line in enumerate(f, 1):
+                if line.strip():
+                    try:
+                        zone = zone_from_dict(json.loads(line), kind)
+                    except (ValueError, KeyError, TypeError,
+                            AttributeError) as error:
+                        log.error(f"{file_path}:{number}: bad value {error}. Skipping")
+                        continue
+                    yield zone
+
+
+def read_csv(file_path, kind='NATIVE'):
+    """
+        Read records from a CSV file with the header zone,name,type,content[,ttl,prio,disabled].
+        Consecutive rows of the same zone are grouped into one Zone.
+    """
+    with open(file_path, 'r', newline='') as f:
+        zone = None
+        reader = csv.DictReader(f)
+        for row in reader:
+            try:
+                zone_name = normalize_name(row['zone'])
+                record = Record(normalize_name(row['name']), row['type'].upper(),
+                                row['content'], int(row.get('ttl') or 3600),
+                                int(row.get('prio') or 0),
+                                (row.get('disabled') or '').lower()
+                                in ('1', 'true', 'yes'))
+            except (ValueError, KeyError, AttributeError) as error:
+                log.error(f"{file_path}:{reader.line_num}: bad value {error}. Skipping")
+                continue
+            if zone is None or zone.name != zone_name:
+                if zone is not None:
+                    yield zone
+                zone = Zone(zone_name, kind, None, None, [])
+            zone.records.append(record)
+        if zone is not None:
+            yield zone
+
+
+readers = {
+    'bind': lambda path, kind: [read_bind_zone(path, kind=kind)],
+    'json': read_json,
+    'csv': read_csv,
+}
+
+
+def guess_format(file_path):
+    extension = os.path.splitext(file_path)[1].lower()
+    if extension in ('.json', '.jsonl'):
+        return 'json'
+    if extension == '.csv':
+        return 'csv'
+    return 'bind'
+
+
+def read_zones(paths, data_format=None, kind='NATIVE'):
+    """
+        Yield zones from files and directories (walked recursively in sorted order).
+    """
+    for path in paths:
+        if os.path.isdir(path):
+            files = sorted(
+                os.path.join(dir_path, filename)
+                for dir_path, subdir_list, file_list in os.walk(path)
+                for filename in file_list)
+        else:
+            files = [path]
+        for file_path in files:
+            log.debug(f"Reading {file_path}")
+            yield from readers[data_format or guess_format(file_path)](
+                file_path, kind)
+
+
+class BulkLoader:
+    """
+        Writes zones in batches through a backend Session.
+        Secondary indexes on records are dropped while loading into an empty table and rebuilt at the end.
+    """
+    def __init__(self,
+                 session,
+                 batch_records=50000,
+                 commit_records=1000000,
+                 defer_indexes=True):
+        self.log_name = f"{log_name}.{self.__class__.__name__}"
+        self.log = logging.getLogger(self.log_name)
+        self.session = session
+        self.batch_records = batch_records
+        self.commit_records = commit_records
+        self.defer_indexes = defer_indexes
+        self.zone_ids = {}
+        self.pending = []
+        self.pending_records = 0
+        self.uncommitted_records = 0
+        self.zones_loaded = 0
+        self.zones_skipped = 0
+        self.records_loaded = 0
+        self.dropped_indexes = []
+        self.started = None
+
+    def drop_indexes(self):
+        if self.session.fetch_one(
+                "SELECT EXISTS (SELECT 1 FROM records)"):
+            self.log.info(
+                "records is not empty. Keeping indexes during the import")
+            return
+        self.dropped_indexes = self.session.table_indexes('records')
+        for name, definition in self.dropped_indexes:
+            self.log.debug(f"Dropping index {name} until the import is done")
+            self.session.execute(f"DROP INDEX {name}")
+
+    def restore_indexes(self):
+        """
+            Rebuild the dropped indexes after a failed import. A rolled back DROP INDEX left its index in place.
+        """
+        self.session.rollback()
+        existing = {name for name, definition in self.session.table_indexes('records')}
+        self.dropped_indexes = [(name, definition)
+                                for name, definition in self.dropped_indexes
+                                if name not in existing]
+        if self.dropped_indexes:
+            self.log.error("Import failed. Rebuilding the dropped indexes of records")
+            self.rebuild_indexes()
+            self.session.commit()
+
+    def rebuild_indexes(self):
+        for name, definition in self.dropped_indexes:
+            with instrumentation.span('bulk_index_rebuild', index=name):
+                started = time.perf_counter()
+                self.session.execute(definition)
+            self.log.info(
+                f"Rebuilt index {name} in {time.perf_counter() - started:.1f}s")
+        self.dropped_indexes = []
+
+    def flush(self):
+        zones = self.pending
+        self.pending = []
+        self.pending_records = 0
+        new = [(z.name, z.kind, z.master, z.account) for z in zones
+               if z.name not in self.zone_ids]
+        created = self.session.insert_domains(
+            list({row[0]: row
+                  for row in new}.values()))
+        self.zone_ids.update(created)
+
+        rows = []
+        for zone in zones:
+            domain_id = self.zone_ids.get(zone.name)
+            if domain_id is None:
+                self.zones_skipped += 1
+                self.log.warning(f"Zone {zone.name} already exists. Skipping")
+                continue
+            if zone.name in created:
+                self.zones_loaded += 1
+                created.pop(zone.name)
+            rows += [(domain_id, r.name, r.type, r.content, r.ttl, r.prio,
+                      r.disabled, True) for r in zone.records]
+        self.session.insert_records(rows)
+        self.records_loaded += len(rows)
+        self.uncommitted_records += len(rows)
+
+        if self.uncommitted_records >= self.commit_records:
+            self.session.commit()
+            self.uncommitted_records = 0
+            self.report()
+
+    def report(self):
+        elapsed = time.perf_counter() - self.started
+        rate = self.records_loaded / elapsed if elapsed > 0 else 0
+        self.log.info(
+            f"Loaded {self.zones_loaded} zone(s) and {self.records_loaded} record(s) in {elapsed:.1f}s ({rate:.0f} records/s)"
+        )
+
+    def load(self, zones):
+        self.started = time.perf_counter()
+        with instrumentation.span('bulk_import'):
+            if self.defer_indexes:
+                self.drop_indexes()
+            try:
+                for zone in zones:
+                    self.pending.append(zone)
+                    self.pending_records += len(zone.records)
+                    if self.pending_records >= self.batch_records:
+                        self.flush()
+                self.flush()
+            except BaseException:
+                # Batches committed so far stay, records must not be left without indexes
+                self.restore_indexes()
+                raise
+            self.rebuild_indexes()
+            self.session.commit()
+        self.report()
+        if self.zones_skipped:
+            self.log.warning(
+                f"Skipped {self.zones_skipped} zone(s) that already existed")
+        return self.records_loaded
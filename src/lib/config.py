@@ -1,15 +1,9 @@
 import os
 import sys
-from packaging import version
+import time
 from logging import Formatter, DEBUG, INFO, WARNING, ERROR, StreamHandler, FileHandler
 
 
-def parse_sql_schema_filename(filename):
-    old_version = version.parse(filename.split('_')[0])
-    new_verion = version.parse(filename.split('_')[2])
-    return old_version, new_verion
-
-
 def get_from_environment(env_search_term="ENV"):
     enviroment = {}
     autosecondary = {}
@@ -47,11 +41,178 @@ def merge_dicts(defaults_dict, dict_list):
     for dict in dict_list:
         defaults_dict.update(dict)
     if "gpgsql-dbname" in defaults_dict:  # TODO: Extend with more databases
-        defaults_dict.pop('gsqlite3-database', None)
-        defaults_dict.pop('gsqlite3-pragma-synchronous', None)
+        for key in [k for k in defaults_dict if k.startswith('gsqlite3-')]:
+            defaults_dict.pop(key, None)
     return defaults_dict
 
 
+backend_prefixes = ('gpgsql-', 'gsqlite3-', 'lmdb-')
+
+
+def launched_settings(conf):
+    """
+        Leave out the settings of backends that are not launched. pdns_server refuses unknown settings.
+    """
+    launched = [
+        backend.strip().split(':')[0]
+        for backend in str(conf.get('launch', '')).split(',')
+    ]
+    return {
+        key: value
+        for key, value in conf.items() if not any(
+            key.startswith(prefix) and prefix[:-1] not in launched
+            for prefix in backend_prefixes)
+    }
+
+
+# SQLite performance profiles. Selected with SQLITE_PROFILE.
+#   pdns:                pdns.conf settings merged below the file and environment config
+#                        (dropped on PowerDNS versions older than pdns_settings_since says)
+#   install_pragmas:     persistent pragmas applied before a fresh schema is created
+#   connection_pragmas:  per connection pragmas used while installing/migrating
+#   optimize:            run ANALYZE/PRAGMA optimize after migrate()
+sqlite_profiles = {
+    'default': {},
+    'performance': {
+        'pdns': {
+            'gsqlite3-pragma-journal-mode': 'WAL',
+        },
+        'install_pragmas': [
+            ('page_size', 4096),
+            ('journal_mode', 'WAL'),
+        ],
+        'connection_pragmas': [
+            ('mmap_size', 268435456),  # 256 MiB
+            ('cache_size', -65536),  # 64 MiB
+            ('temp_store', 'MEMORY'),
+        ],
+        'optimize': True,
+    },
+}
+
+
+# First PowerDNS version (major, minor) that accepts a profile setting
+pdns_settings_since = {
+    'gsqlite3-pragma-journal-mode': (4, 3),
+}
+
+
+def get_sqlite_profile(name):
+    if name not in sqlite_profiles:
+        print(f"Unknown SQLITE_PROFILE '{name}'. Using 'default'")
+        name = 'default'
+    return sqlite_profiles[name]
+
+
+def get_profile_pdns_conf(profile, app_version):
+    """
+        The pdns.conf settings of a profile that app_version (e.g. "44") recognises.
+    """
+    name = str(app_version)
+    running = (int(name[0]), int(name[1]))
+    return {
+        key: value
+        for key, value in profile.get('pdns', {}).items()
+        if running >= pdns_settings_since.get(key, (0, 0))
+    }
+
+
+# Autotuning of pdns.conf from the container limits. Enabled with AUTOTUNE=yes.
+cgroup_root = "/sys/fs/cgroup"
+# A cgroup v1 memory limit above this value means "no limit"
+cgroup_v1_unlimited = 1 << 60
+# Rough memory used by one packet cache or query cache entry
+cache_entry_bytes = 512
+# Share of the memory limit given to the packet and query caches together
+cache_memory_share = 0.25
+
+
+def read_first_line(file_path):
+    try:
+        with open(file_path, "r") as f:
+            return f.readline().strip()
+    except OSError:
+        return None
+
+
+def get_cpu_limit(root=cgroup_root):
+    """
+        CPUs available to the container as (cpus, source). cpus is a float for fractional quotas.
+    """
+    cpus = float(len(os.sched_getaffinity(0)))
+    source = f"{int(cpus)} CPU(s) in the affinity mask"
+    cpu_max = read_first_line(os.path.join(root, "cpu.max"))  # cgroup v2
+    if cpu_max:
+        quota, period = (cpu_max.split() + ["100000"])[:2]
+        if quota != "max" and int(quota) / int(period) < cpus:
+            cpus = int(quota) / int(period)
+            source = f"cgroup v2 cpu.max {quota}/{period}"
+        return cpus, source
+    quota = read_first_line(os.path.join(root, "cpu", "cpu.cfs_quota_us"))  # cgroup v1
+    period = read_first_line(os.path.join(root, "cpu", "cpu.cfs_period_us"))
+    if quota and period and 0 < int(quota) / int(period) < cpus:
+        cpus = int(quota) / int(period)
+        source = f"cgroup v1 cfs quota {quota}/{period}"
+    return cpus, source
+
+
+def get_memory_limit(root=cgroup_root):
+    """
+        Memory available to the container in bytes as (bytes, source). Falls back to MemTotal.
+    """
+    memory_max = read_first_line(os.path.join(root, "memory.max"))  # cgroup v2
+    if memory_max and memory_max != "max":
+        return int(memory_max), "cgroup v2 memory.max"
+    limit = read_first_line(
+        os.path.join(root, "memory", "memory.limit_in_bytes"))  # cgroup v1
+    if memory_max is None and limit and int(limit) < cgroup_v1_unlimited:
+        return int(limit), "cgroup v1 memory.limit_in_bytes"
+    with open("/proc/meminfo", "r") as f:
+        for line in f:
+            if line.startswith("MemTotal:"):
+                return int(line.split()[1]) * 1024, "no cgroup limit, MemTotal"
+    return None, "unknown"
+
+
+def autotune(root=cgroup_root):
+    """
+        Derive thread counts and cache sizes from the CPU and memory limits.
+        Returns the pdns.conf settings and a list of notes explaining each value.
+    """
+    settings = {}
+    notes = []
+    cpus, cpu_source = get_cpu_limit(root)
+    notes.append(f"{cpus:g} CPU(s) from {cpu_source}")
+
+    # One receiver per whole CPU, spread by the kernel with SO_REUSEPORT
+    receivers = max(1, min(int(cpus), 16))
+    settings["receiver-threads"] = receivers
+    settings["reuseport"] = "yes" if receivers > 1 else "no"
+    # Distributors wait on the database. Keep the PowerDNS default of 3 per receiver unless CPU is scarce
+    settings["distributor-threads"] = 3 if cpus >= 2 else (2 if cpus >= 1 else 1)
+    notes.append(
+        f"receiver-threads={settings['receiver-threads']}, reuseport={settings['reuseport']}, "
+        f"distributor-threads={settings['distributor-threads']} (per receiver)")
+
+    memory, memory_source = get_memory_limit(root)
+    if memory:
+        notes.append(f"{memory // 1048576} MiB memory from {memory_source}")
+        entries = int(memory * cache_memory_share / 2 / cache_entry_bytes)
+        # Never above the PowerDNS default of 1M entries, never below 10k
+        entries = max(10000, min(entries, 1000000))
+        settings["max-packet-cache-entries"] = entries
+        settings["max-cache-entries"] = entries
+        notes.append(
+            f"max-packet-cache-entries={entries}, max-cache-entries={entries} "
+            f"({cache_memory_share:.0%} of memory at ~{cache_entry_bytes} bytes per entry)")
+    else:
+        notes.append("Memory limit unknown. Keeping the PowerDNS cache sizes")
+    return settings, notes
+
+
+config_load_started = time.perf_counter()
+
+
 class Config:
     powerdns_app_version = os.environ['POWERDNS_VERSION']
     exec_mode = os.environ['EXEC_MODE']  # DOCKER or K8S
@@ -65,6 +226,9 @@ class Config:
         "launch": "gsqlite3",
         "gsqlite3-database": "/var/lib/powerdns/auth.db",
         "gsqlite3-pragma-synchronous": 0,
+        "lmdb-filename": "/var/lib/powerdns/lmdb/pdns.lmdb",
+        "lmdb-shards": 4,
+        "lmdb-sync-mode": "mapasync",
         "socket-dir": "/var/run/powerdns-authorative",
         "entropy-source": "/dev/urandom",
         "local-address": "0.0.0.0",
@@ -72,16 +236,32 @@ class Config:
     }
 
     # Read config from file (/pdns.conf) and parse to dict
-    file_conf = get_from_file("/pdns.conf")
+    pdns_conf_file = "/pdns.conf"
+    file_conf = get_from_file(pdns_conf_file)
 
     # Read config from Environment variables (ENV_) and parse to dict
     env_conf, autosecondary = get_from_environment("ENV")
 
+    # SQLite performance profile
+    sqlite_profile_name = os.getenv('SQLITE_PROFILE', 'default')
+    sqlite_profile = get_sqlite_profile(sqlite_profile_name)
+    sqlite_profile_conf = get_profile_pdns_conf(sqlite_profile, powerdns_app_version)
+
+    # Thread counts and cache sizes derived from the container limits
+    autotune_enabled = os.getenv('AUTOTUNE', 'no') == 'yes'
+    autotune_conf, autotune_notes = autotune() if autotune_enabled else ({}, [])
+    # Settings derived from the data at startup (lmdb-map-size). Filled in by the entrypoint
+    derived_conf = {}
+
     # Merge all configs in this specific order. Higher number higher priority
     # 1. Defaults
-    # 2. File
-    # 3. Environment variables
-    pdns_conf = merge_dicts(defaults, [file_conf, env_conf])
+    # 2. Autotune and derived settings
+    # 3. SQLite profile
+    # 4. File
+    # 5. Environment variables
+    pdns_conf = merge_dicts(
+        dict(defaults),
+        [autotune_conf, derived_conf, sqlite_profile_conf, file_conf, env_conf])
 
     # Set database config
     ## PostgreSQL
@@ -98,6 +278,90 @@ class Config:
     sql_schema_path = os.path.join(base_dir, 'sql_schemas')
     sql_update_schemas_path = os.path.join(base_dir, 'sql_update_schemas')
     template_path = os.path.join(base_dir, 'templates')
+    # Compiled template bytecode. Defaults to a directory in the system temp dir
+    template_cache_dir = os.getenv('TEMPLATE_CACHE_DIR')
+
+    # STARTUP
+    # Skip install/migrate when pdns_meta carries the fingerprint of this image
+    schema_fast_path = os.getenv('SCHEMA_FAST_PATH', 'yes') == 'yes'
+    # Database readiness probing. The first probe is immediate, then the delay
+    # grows from the initial value up to the max value with jitter.
+    db_wait_timeout = float(os.getenv('DB_WAIT_TIMEOUT', '30'))
+    db_wait_initial_delay = float(os.getenv('DB_WAIT_INITIAL_DELAY', '0.1'))
+    db_wait_max_delay = float(os.getenv('DB_WAIT_MAX_DELAY', '5'))
+    db_wait_connect_timeout = int(os.getenv('DB_WAIT_CONNECT_TIMEOUT', '2'))
+    # MAINTENANCE
+    # ANALYZE (and optionally VACUUM) after an upgrade and/or every interval seconds (0 disables)
+    maintenance_after_migrate = os.getenv('MAINTENANCE_AFTER_MIGRATE',
+                                          'no') == 'yes'
+    maintenance_interval = float(os.getenv('MAINTENANCE_INTERVAL', '0'))
+    maintenance_vacuum = os.getenv('MAINTENANCE_VACUUM', 'no') == 'yes'
+
+    # METRICS AND HTTP ENDPOINTS
+    # The HTTP server (/metrics, ...) is only started when HTTP_PORT is set
+    http_address = os.getenv('HTTP_ADDRESS', '0.0.0.0')
+    http_port = os.getenv('HTTP_PORT')
+    metrics_textfile = os.getenv('METRICS_TEXTFILE')
+    first_answer_timeout = float(os.getenv('FIRST_ANSWER_TIMEOUT', '60'))
+    # Poll pdns_server statistics over the control socket (socket) or the webserver API (api). no disables
+    exporter_source = os.getenv('EXPORTER', 'no')
+    exporter_interval = float(os.getenv('EXPORTER_INTERVAL', '10'))
+    # READINESS
+    # SOA probes against the local pdns_server. Zones are listed or sampled from the domains table
+    ready_zones = [z.strip() for z in os.getenv('READY_ZONES', '').split(',') if z.strip()]
+    ready_sample_zones = int(os.getenv('READY_SAMPLE_ZONES', '3'))
+    ready_file = os.getenv('READY_FILE')
+    ready_tcp = os.getenv('READY_TCP', 'yes') == 'yes'
+    ready_timeout = float(os.getenv('READY_TIMEOUT', '1'))
+    ready_interval_min = float(os.getenv('READY_INTERVAL_MIN', '0.1'))
+    ready_interval_max = float(os.getenv('READY_INTERVAL_MAX', '10'))
+    ready_failure_threshold = int(os.getenv('READY_FAILURE_THRESHOLD', '3'))
+    # Replay the busiest names from a query log or from records before reporting ready
+    warmup = os.getenv('WARMUP', 'no') == 'yes'
+    warmup_query_log = os.getenv('WARMUP_QUERY_LOG')
+    warmup_top = int(os.getenv('WARMUP_TOP', '1000'))
+    warmup_concurrency = int(os.getenv('WARMUP_CONCURRENCY', '16'))
+    warmup_budget = float(os.getenv('WARMUP_BUDGET', '30'))
+    # SUPERVISOR
+    # supervise: run pdns_server as a child. exec: replace the entrypoint with pdns_server
+    supervisor_mode = os.getenv('SUPERVISOR_MODE', 'supervise')
+    drain_seconds = float(os.getenv('DRAIN_SECONDS', '5'))
+    stop_timeout = float(os.getenv('STOP_TIMEOUT', '10'))
+    restart_on_failure = os.getenv('RESTART_ON_FAILURE', 'no') == 'yes'
+    # Watch the mounted config and apply changes without restarting the container
+    config_reload = os.getenv('CONFIG_RELOAD', 'no') == 'yes'
+    config_reload_interval = float(os.getenv('CONFIG_RELOAD_INTERVAL', '2'))
+    # AUTOPRIMARIES (secondaries)
+    # Addresses resolved from DNS are cached for their TTL, from /etc/hosts and the like for the fallback TTL
+    autosecondary_cache_ttl = float(os.getenv('AUTOSECONDARY_CACHE_TTL', '60'))
+    autosecondary_prune = os.getenv('AUTOSECONDARY_PRUNE', 'yes') == 'yes'
+    autosecondary_refresh = os.getenv('AUTOSECONDARY_REFRESH', 'no') == 'yes'
+    # Snapshot of the SQLite database before a schema upgrade. Copied in batches of pages so readers are not blocked
+    sqlite_snapshot = os.getenv('SQLITE_SNAPSHOT', 'yes') == 'yes'
+    sqlite_snapshot_dir = os.getenv('SQLITE_SNAPSHOT_DIR')
+    sqlite_snapshot_keep = int(os.getenv('SQLITE_SNAPSHOT_KEEP', '3'))
+    sqlite_snapshot_pages = int(os.getenv('SQLITE_SNAPSHOT_PAGES', '1024'))
+    # LMDB
+    # SQL backend whose zones are converted into LMDB (gsqlite3, gpgsql or none) and when:
+    # missing (no LMDB files yet), always (every start) or no
+    lmdb_source = os.getenv('LMDB_SOURCE', 'gsqlite3')
+    lmdb_convert = os.getenv('LMDB_CONVERT', 'missing')
+    # lmdb-map-size is derived from the record count times this factor unless it is set
+    lmdb_map_headroom = float(os.getenv('LMDB_MAP_HEADROOM', '4'))
+    # SNAPSHOTS (gsqlite3)
+    # Path or http(s) URL of a snapshot exported by a primary. Loaded into an empty secondary database
+    snapshot_bootstrap = os.getenv('SNAPSHOT_BOOTSTRAP')
+    # Primaries of the bootstrapped zones. Defaults to the autoprimary addresses
+    snapshot_primaries = [p.strip() for p in os.getenv('SNAPSHOT_PRIMARIES', '').split(',') if p.strip()]
+    # Only one replica installs/migrates at a time (pg advisory lock or file lock)
+    migration_lock_id = int(os.getenv('MIGRATION_LOCK_ID', '1885630067'))
+    migration_lock_timeout = float(os.getenv('MIGRATION_LOCK_TIMEOUT', '300'))
+    # Online upgrades (gpgsql): batched backfills and short DDL transactions with timeouts (seconds)
+    migration_online = os.getenv('MIGRATION_ONLINE', 'no') == 'yes'
+    migration_batch_size = int(os.getenv('MIGRATION_BATCH_SIZE', '5000'))
+    migration_ddl_lock_timeout = float(os.getenv('MIGRATION_DDL_LOCK_TIMEOUT', '2'))
+    migration_statement_timeout = float(os.getenv('MIGRATION_STATEMENT_TIMEOUT', '60'))
+    migration_retries = int(os.getenv('MIGRATION_RETRIES', '10'))
 
     # LOGGING
     logger_name = 'pdns_auth'
@@ -123,3 +387,18 @@ class Config:
         logg_handlers.append(handler)
     except Exception as e:
         print('Unexpected error: (StreamHandler)', sys.exc_info()[0])
+
+    load_duration = time.perf_counter() - config_load_started
+
+
+def rebuild_pdns_conf():
+    """
+        Read the mounted config and the ENV_ variables again and merge them in the same order as Config.pdns_conf.
+    """
+    env_conf, autosecondary = get_from_environment("ENV")
+    return merge_dicts(dict(Config.defaults), [
+        Config.autotune_conf,
+        Config.derived_conf,
+        Config.sqlite_profile_conf,
+        get_from_file(Config.pdns_conf_file), env_conf
+    ])
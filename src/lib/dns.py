@@ -0,0 +1,210 @@
+import random
+import socket
+import struct
+'''
+    Minimal DNS client used to probe the local pdns_server and to look up addresses with their TTL.
+    Only what is needed to send a question, read the header and the A/AAAA records of the answer.
+'''
+
+QTYPES = {
+    'A': 1,
+    'NS': 2,
+    'CNAME': 5,
+    'SOA': 6,
+    'PTR': 12,
+    'MX': 15,
+    'TXT': 16,
+    'AAAA': 28,
+    'SRV': 33,
+    'DS': 43,
+    'DNSKEY': 48,
+    'CAA': 257,
+}
+
+RCODES = {
+    0: 'NOERROR',
+    1: 'FORMERR',
+    2: 'SERVFAIL',
+    3: 'NXDOMAIN',
+    4: 'NOTIMP',
+    5: 'REFUSED',
+}
+
+
+def encode_name(name):
+    labels = [label for label in name.rstrip('.').split('.') if label]
+    return b''.join(
+        struct.pack('!B', len(label)) + label.encode('idna')
+        for label in labels) + b'\x00'
+
+
+def build_query(name, qtype='SOA', recursion=False):
+    """
+        Return (query id, wire format query) for a single question. Recursion is only desired when asked for.
+    """
+    query_id = random.getrandbits(16)
+    flags = 0x0100 if recursion else 0
+    header = struct.pack('!HHHHHH', query_id, flags, 1, 0, 0, 0)
+    question = encode_name(name) + struct.pack('!HH', QTYPES[qtype.upper()],
+                                               1)
+    return query_id, header + question
+
+
+def parse_response(data):
+    """
+        Decode the header of an answer.
+    """
+    if len(data) < 12:
+        raise ValueError("Short DNS response")
+    query_id, flags, qdcount, ancount, nscount, arcount = struct.unpack(
+        '!HHHHHH', data[:12])
+    rcode = flags & 0x000F
+    return {
+        'id': query_id,
+        'rcode': RCODES.get(rcode, str(rcode)),
+        'authoritative': bool(flags & 0x0400),
+        'truncated': bool(flags & 0x0200),
+        'answers': ancount,
+    }
+
+
+def query(host, port, name, qtype='SOA', timeout=1.0, tcp=False):
+    """
+        Send one question to host:port over UDP (or TCP) and return the parsed header.
+        Raises OSError/socket.timeout if there is no answer.
+    """
+    return parse_response(exchange(host, port, name, qtype, timeout, tcp))
+
+
+def exchange(host,
+             port,
+             name,
+             qtype='SOA',
+             timeout=1.0,
+             tcp=False,
+             recursion=False):
+    """
+        Send one question to host:port over UDP (or TCP) and return the raw answer.
+    """
+    query_id, packet = build_query(name, qtype, recursion)
+    family = socket.AF_INET6 if ':' in host else socket.AF_INET
+    if tcp:
+        with socket.socket(family, socket.SOCK_STREAM) as sock:
+            sock.settimeout(timeout)
+            sock.connect((host, int(port)))
+            sock.sendall(struct.pack('!H', len(packet)) + packet)
+            length = struct.unpack('!H', _recv_exactly(sock, 2))[0]
+            data = _recv_exactly(sock, length)
+    else:
+        with socket.socket(family, socket.SOCK_DGRAM) as sock:
+            sock.settimeout(timeout)
+            sock.sendto(packet, (host, int(port)))
+            while True:
+                data, _ = sock.recvfrom(65535)
+                if len(data) >= 2 and struct.unpack('!H',
+                                                    data[:2])[0] == query_id:
+                    break
+    if parse_response(data)['id'] != query_id:
+        raise ValueError("DNS response id mismatch")
+    return data
+
+
+def skip_name(data, offset):
+    """
+        Offset of the first byte after the (possibly compressed) name at offset.
+    """
+    while True:
+        length = data[offset]
+        if length == 0:
+            return offset + 1
+        if length & 0xC0 == 0xC0:
+            return offset + 2
+        offset += 1 + length
+
+
+def parse_addresses(data):
+    """
+        (address, ttl) of the A and AAAA records in the answer section.
+        Raises ValueError if the answer is truncated or malformed.
+    """
+    response = parse_response(data)
+    try:
+        qdcount = struct.unpack('!H', data[4:6])[0]
+        offset = 12
+        for _ in range(qdcount):
+            offset = skip_name(data, offset) + 4
+        addresses = []
+        for _ in range(response['answers']):
+            offset = skip_name(data, offset)
+            rtype, rclass, ttl, length = struct.unpack(
+                '!HHIH', data[offset:offset + 10])
+            offset += 10
+            rdata = data[offset:offset + length]
+            offset += length
+            if rtype == QTYPES['A'] and length == 4:
+                addresses.append((socket.inet_ntop(socket.AF_INET, rdata), ttl))
+            elif rtype == QTYPES['AAAA'] and length == 16:
+                addresses.append((socket.inet_ntop(socket.AF_INET6, rdata), ttl))
+    except (struct.error, IndexError) as e:
+        raise ValueError(f"Malformed DNS response: {e}")
+    return addresses
+
+
+def lookup(host, port, name, qtype, timeout=2.0):
+    """
+        Ask a recursive nameserver for the A or AAAA records of name.
+        Returns (rcode, [(address, ttl)]). Truncated UDP answers are repeated over TCP.
+    """
+    data = exchange(host, port, name, qtype, timeout, recursion=True)
+    if parse_response(data)['truncated']:
+        data = exchange(host, port, name, qtype, timeout, True, True)
+    return parse_response(data)['rcode'], parse_addresses(data)
+
+
+def read_resolv_conf(file_path='/etc/resolv.conf'):
+    """
+        (nameservers, search domains, ndots) of the system resolver.
+    """
+    nameservers, search, ndots = [], [], 1
+    try:
+        with open(file_path, 'r') as f:
+            for line in f:
+                fields = line.split()
+                if not fields or fields[0].startswith(('#', ';')):
+                    continue
+                if fields[0] == 'nameserver' and len(fields) > 1:
+                    nameservers.append(fields[1].split('%')[0])
+                elif fields[0] in ('search', 'domain'):
+                    search = fields[1:]
+                elif fields[0] == 'options':
+                    for option in fields[1:]:
+                        if option.startswith('ndots:'):
+                            ndots = int(option.split(':')[1])
+    except OSError:
+        pass
+    return nameservers or ['127.0.0.1'], search, ndots
+
+
+def _recv_exactly(sock, length):
+    data = b''
+    while len(data) < length:
+        chunk = sock.recv(length - len(data))
+        if not chunk:
+            raise ConnectionError("Connection closed by DNS server")
+        data += chunk
+    return data
+
+
+def local_target(pdns_conf):
+    """
+        Address and port the local pdns_server can be queried on.
+        Wildcard listen addresses are mapped to the loopback address.
+    """
+    address = str(pdns_conf.get('local-address', '127.0.0.1'))
+    address = address.replace(',', ' ').split()[0] if address.strip() else '127.0.0.1'
+    address = address.split(':')[0] if address.count(':') == 1 else address
+    if address == '0.0.0.0':
+        address = '127.0.0.1'
+    elif address in ('::', '[::]'):
+        address = '::1'
+    return address.strip('[]'), int(pdns_conf.get('local-port', 53))
@@ -0,0 +1,276 @@
+import os
+import json
+import time
+import socket
+import logging
+import threading
+import http.client
+
+from lib.config import Config
+from lib.metrics import metric_prefix, format_labels
+'''
+    Polls the statistics of the running pdns_server and exposes them in the Prometheus text format.
+    Statistics come from the control socket in socket-dir ("show *") or from the webserver API.
+    Connections are kept open between polls and scrapes only read the last snapshot,
+    so scraping never reaches pdns_server.
+'''
+
+log_name = f'{Config.logger_name}.exporter'
+log = logging.getLogger(log_name)
+
+# Buckets of the sampled average answer latency in seconds
+latency_buckets = [
+    0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1
+]
+
+
+def parse_show_all(text):
+    """
+        Parse the "name=value,name=value,..." answer of "show *".
+    """
+    stats = {}
+    for item in text.replace('\n', ',').split(','):
+        name, separator, value = item.strip().partition('=')
+        if not separator:
+            continue
+        try:
+            stats[name] = float(value)
+        except ValueError:
+            continue
+    return stats
+
+
+def format_value(value):
+    return str(int(value)) if float(value).is_integer() else repr(value)
+
+
+def metric_name(stat):
+    return f"{metric_prefix}_{stat.replace('-', '_').replace('.', '_')}"
+
+
+class ControlSocketSource:
+    """
+        Talks to pdns_server over <socket-dir>/pdns.controlsocket like pdns_control does.
+        The connection is reused while pdns_server keeps it open.
+    """
+    terminator = b'\0\n'
+
+    def __init__(self, path, timeout=2.0):
+        self.log_name = f"{log_name}.{self.__class__.__name__}"
+        self.log = logging.getLogger(self.log_name)
+        self.path = path
+        self.timeout = timeout
+        self.sock = None
+
+    def connect(self):
+        self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.sock.settimeout(self.timeout)
+        self.sock.connect(self.path)
+
+    def close(self):
+        if self.sock is not None:
+            self.sock.close()
+            self.sock = None
+
+    def command(self, line):
+        data = b''
+        self.sock.sendall(line.encode() + b'\n')
+        while not data.endswith(self.terminator):
+            chunk = self.sock.recv(65536)
+            if not chunk:
+                break
+            data += chunk
+        return data
+
+    def fetch(self):
+        for attempt in range(2):
+            reused = self.sock is not None
+            if not reused:
+                self.connect()
+            try:
+                data = self.command('show *')
+            except OSError:
+                self.close()
+                if reused:
+                    continue  # pdns_server closed the idle connection
+                raise
+            if data.endswith(self.terminator):
+                return parse_show_all(data[:-len(self.terminator)].decode())
+            # Connection closed after the answer. Reconnect on the next poll
+            self.close()
+            if data:
+                return parse_show_all(data.decode().rstrip('\0\n'))
+        raise OSError(f"No answer from {self.path}")
+
+
+class ApiSource:
+    """
+        Reads /api/v1/servers/localhost/statistics from the pdns webserver over a keep-alive connection.
+    """
+    def __init__(self, host, port, api_key, timeout=2.0):
+        self.log_name = f"{log_name}.{self.__class__.__name__}"
+        self.log = logging.getLogger(self.log_name)
+        self.host = host
+        self.port = int(port)
+        self.api_key = api_key
+        self.timeout = timeout
+        self.connection = None
+
+    def close(self):
+        if self.connection is not None:
+            self.connection.close()
+            self.connection = None
+
+    def fetch(self):
+        for attempt in range(2):
+            if self.connection is None:
+                self.connection = http.client.HTTPConnection(
+                    self.host, self.port, timeout=self.timeout)
+            try:
+                self.connection.request(
+                    'GET', '/api/v1/servers/localhost/statistics',
+                    headers={'X-API-Key': self.api_key or ''})
+                response = self.connection.getresponse()
+                body = response.read()
+            except (OSError, http.client.HTTPException):
+                self.close()
+                if attempt == 0:
+                    continue
+                raise
+            if response.status != 200:
+                raise OSError(f"Statistics API answered {response.status}")
+            return {
+                item['name']: float(item['value'])
+                for item in json.loads(body)
+                if item.get('type') == 'StatisticItem'
+            }
+
+
+def source_from_config():
+    if Config.exporter_source == 'api':
+        host = Config.pdns_conf.get('webserver-address', '127.0.0.1')
+        if host in ('0.0.0.0', '::'):
+            host = '127.0.0.1'
+        return ApiSource(host, Config.pdns_conf.get('webserver-port', 8081),
+                         Config.pdns_conf.get('api-key'))
+    return ControlSocketSource(
+        os.path.join(
+            str(Config.pdns_conf.get('socket-dir', '/var/run/powerdns')),
+            'pdns.controlsocket'))
+
+
+class Exporter(threading.Thread):
+    """
+        Polls a statistics source every interval seconds and keeps the last snapshot,
+        the derived rates and a histogram of the sampled latency.
+    """
+    def __init__(self, source, interval):
+        super().__init__(name='exporter', daemon=True)
+        self.log_name = f"{log_name}.{self.__class__.__name__}"
+        self.log = logging.getLogger(self.log_name)
+        self.source = source
+        self.interval = interval
+        self.lock = threading.Lock()
+        self.stopped = threading.Event()
+        self.stats = {}
+        self.polled_at = None
+        self.derived = {}
+        self.latency_counts = [0] * len(latency_buckets)
+        self.latency_count = 0
+        self.latency_sum = 0.0
+        self.failures = 0
+
+    def poll(self):
+        started = time.perf_counter()
+        try:
+            stats = self.source.fetch()
+        except (OSError, ValueError) as error:
+            self.source.close()
+            with self.lock:
+                self.failures += 1
+            self.log.debug(f"Polling pdns_server failed: {error}")
+            return False
+        now = time.monotonic()
+        with self.lock:
+            self.update(stats, now)
+            self.derived['exporter_poll_duration_seconds'] = time.perf_counter(
+            ) - started
+        return True
+
+    def update(self, stats, now):
+        previous, previous_at = self.stats, self.polled_at
+        self.stats, self.polled_at = stats, now
+        if 'latency' in stats:
+            latency = stats['latency'] / 1000000  # microseconds
+            self.latency_count += 1
+            self.latency_sum += latency
+            for i, bound in enumerate(latency_buckets):
+                if latency <= bound:
+                    self.latency_counts[i] += 1
+        if not previous:
+            return
+
+        def delta(name):
+            # Counters restart with pdns_server
+            return max(stats.get(name, 0) - previous.get(name, 0), 0)
+
+        elapsed = now - previous_at
+        queries = delta('udp-queries') + delta('tcp-queries')
+        self.derived['queries_per_second'] = queries / elapsed
+        hits, misses = delta('packetcache-hit'), delta('packetcache-miss')
+        if hits + misses:
+            self.derived['packetcache_hit_ratio'] = hits / (hits + misses)
+        hits, misses = delta('query-cache-hit'), delta('query-cache-miss')
+        if hits + misses:
+            self.derived['query_cache_hit_ratio'] = hits / (hits + misses)
+        self.derived['backend_queries_per_second'] = delta(
+            'backend-queries') / elapsed
+
+    def run(self):
+        self.log.info(
+            f"Exporting pdns_server statistics every {self.interval}s")
+        while not self.stopped.is_set():
+            self.poll()
+            self.stopped.wait(self.interval)
+        self.source.close()
+
+    def stop(self):
+        self.stopped.set()
+
+    def prometheus_text(self):
+        with self.lock:
+            stats = dict(self.stats)
+            derived = dict(self.derived)
+            counts = list(self.latency_counts)
+            count, total, failures = self.latency_count, self.latency_sum, self.failures
+        lines = [
+            f'# HELP {metric_prefix}_exporter_poll_failures_total Failed polls of pdns_server statistics.',
+            f'# TYPE {metric_prefix}_exporter_poll_failures_total counter',
+            f'{metric_prefix}_exporter_poll_failures_total {failures}',
+        ]
+        for name, value in sorted(derived.items()):
+            lines += [
+                f'# TYPE {metric_prefix}_{name} gauge',
+                f'{metric_prefix}_{name} {format_value(value)}',
+            ]
+        if count:
+            name = f'{metric_prefix}_sampled_latency_seconds'
+            lines += [
+                f'# HELP {name} Average answer latency reported by pdns_server, sampled every poll.',
+                f'# TYPE {name} histogram',
+            ]
+            lines += [
+                f'{name}_bucket{format_labels({"le": bound})} {counts[i]}'
+                for i, bound in enumerate(latency_buckets)
+            ]
+            lines += [
+                f'{name}_bucket{format_labels({"le": "+Inf"})} {count}',
+                f'{name}_sum {format_value(total)}',
+                f'{name}_count {count}',
+            ]
+        for stat, value in sorted(stats.items()):
+            lines += [
+                f'# TYPE {metric_name(stat)} untyped',
+                f'{metric_name(stat)} {format_value(value)}',
+            ]
+        return '\n'.join(lines) + '\n'
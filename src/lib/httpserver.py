@@ -0,0 +1,61 @@
+import logging
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+from lib.config import Config
+'''
+    Small HTTP server shared by the metrics and health endpoints.
+    Handlers are registered per path and return (status, content type, body).
+'''
+
+log_name = f'{Config.logger_name}.httpserver'
+log = logging.getLogger(log_name)
+
+routes = {}
+server = None
+
+
+def register(path, handler):
+    routes[path] = handler
+
+
+class RequestHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        handler = routes.get(self.path.split('?')[0])
+        if handler is None:
+            status, content_type, body = 404, 'text/plain', 'Not found\n'
+        else:
+            try:
+                status, content_type, body = handler()
+            except Exception as error:
+                log.error(f"Handler for {self.path} failed")
+                log.debug(error)
+                status, content_type, body = 500, 'text/plain', 'Internal error\n'
+        payload = body.encode() if isinstance(body, str) else body
+        self.send_response(status)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(payload)))
+        self.end_headers()
+        self.wfile.write(payload)
+
+    def log_message(self, format, *args):
+        log.debug(f"{self.address_string()} {format % args}")
+
+
+def start(address=None, port=None):
+    """
+        Serve the registered routes from a daemon thread. Only starts once.
+    """
+    global server
+    if server is not None:
+        return server
+    address = address or Config.http_address
+    port = port or Config.http_port
+    server = ThreadingHTTPServer((address, int(port)), RequestHandler)
+    server.daemon_threads = True
+    thread = threading.Thread(target=server.serve_forever,
+                              name='httpserver',
+                              daemon=True)
+    thread.start()
+    log.info(f"Serving {sorted(routes)} on {address}:{port}")
+    return server
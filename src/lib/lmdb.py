@@ -0,0 +1,124 @@
+import os
+import sys
+import math
+import time
+import shutil
+import logging
+import subprocess
+
+from lib.config import Config
+from lib.metrics import instrumentation
+from lib.template import Template
+'''
+    Serving from the memory mapped LMDB backend with the zones of a gsqlite3/gpgsql database.
+    The LMDB file format is internal to PowerDNS, so the conversion is done by "pdnsutil b2b-migrate"
+    into a new directory that replaces the live one when it is complete.
+'''
+
+log_name = f'{Config.logger_name}.lmdb'
+log = logging.getLogger(log_name)
+
+# Rough size of one record in LMDB including the name indexes
+lmdb_bytes_per_record = 512
+lmdb_min_map_size = 64  # MB
+
+
+def map_size(records, headroom):
+    """
+        lmdb-map-size in MB for a dataset. Every shard gets this size, the map only reserves address space.
+    """
+    return max(math.ceil(records * lmdb_bytes_per_record * headroom / 1048576),
+               lmdb_min_map_size)
+
+
+def count_rows(backend):
+    with backend.Session() as session:
+        return (session.fetch_one("SELECT count(*) FROM domains"),
+                session.fetch_one("SELECT count(*) FROM records"))
+
+
+def lmdb_exists(filename):
+    return os.path.exists(filename)
+
+
+def chown_tree(path, user, group):
+    """
+        pdns_server drops privileges before it opens the LMDB files. user and group are ids or names.
+    """
+    if os.getuid() != 0:
+        return
+    user, group = (int(value) if str(value).isdigit() else value
+                   for value in (user, group))
+    for dir_path, dir_names, file_names in os.walk(path):
+        shutil.chown(dir_path, user, group)
+        for name in file_names:
+            shutil.chown(os.path.join(dir_path, name), user, group)
+
+
+def convert(source, backend, conf):
+    """
+        Copy every zone of the source backend into the LMDB files of conf with pdnsutil.
+        The new files are written next to the live directory and swapped in when pdnsutil succeeded.
+        Returns (zones, records).
+    """
+    filename = conf['lmdb-filename']
+    live_dir = os.path.dirname(filename)
+    new_dir = f"{live_dir}.new"
+    old_dir = f"{live_dir}.old"
+    shutil.rmtree(new_dir, ignore_errors=True)
+    os.makedirs(new_dir)
+
+    # pdnsutil reads pdns-convert.conf from the config dir
+    convert_conf = {
+        key: value
+        for key, value in conf.items()
+        if key.startswith((f'{source}-', 'lmdb-'))
+    }
+    convert_conf.update({
+        'launch': f'{source},lmdb',
+        'lmdb-filename': os.path.join(new_dir, os.path.basename(filename)),
+        'lmdb-sync-mode': 'nosync',  # Files are synced once below
+    })
+    convert_file = os.path.join(new_dir, 'pdns-convert.conf')
+    Template(convert_conf).render_template(
+        os.path.join(Config.template_path, 'pdns.conf.j2'), convert_file)
+
+    zones, records = count_rows(backend)
+    log.info(
+        f"Converting {zones} zone(s) and {records} record(s) from {source} into {filename}"
+    )
+    started = time.perf_counter()
+    with instrumentation.span('lmdb_convert', source=source):
+        result = subprocess.run([
+            'pdnsutil', f'--config-dir={new_dir}', '--config-name=convert',
+            'b2b-migrate', source, 'lmdb'
+        ],
+                                stdout=subprocess.PIPE,
+                                stderr=subprocess.STDOUT,
+                                universal_newlines=True)
+        os.unlink(convert_file)  # Holds the database credentials
+        for line in result.stdout.splitlines():
+            log.debug(line)
+        if result.returncode != 0:
+            log.error(f"pdnsutil b2b-migrate failed with code {result.returncode}")
+            for line in result.stdout.splitlines()[-20:]:
+                log.error(line)
+            shutil.rmtree(new_dir, ignore_errors=True)
+            sys.exit(1)
+
+        for name in os.listdir(new_dir):
+            with open(os.path.join(new_dir, name), 'rb') as f:
+                os.fsync(f.fileno())
+        chown_tree(new_dir, conf.get('setuid', 0), conf.get('setgid', 0))
+        shutil.rmtree(old_dir, ignore_errors=True)
+        if os.path.exists(live_dir):
+            os.rename(live_dir, old_dir)
+        os.rename(new_dir, live_dir)
+        shutil.rmtree(old_dir, ignore_errors=True)
+
+    elapsed = time.perf_counter() - started
+    rate = records / elapsed if elapsed > 0 else 0
+    log.info(
+        f"Converted {zones} zone(s) and {records} record(s) in {elapsed:.1f}s ({rate:.0f} records/s)"
+    )
+    return zones, records
@@ -0,0 +1,99 @@
+import re
+import logging
+import threading
+
+from lib.config import Config
+from lib.metrics import instrumentation
+from lib.migrations.common import StepTimer
+'''
+    Post migration maintenance: refresh planner statistics (ANALYZE, optionally VACUUM)
+    and check that the indexes of the install schema exist and are valid.
+'''
+
+log_name = f'{Config.logger_name}.maintenance'
+log = logging.getLogger(log_name)
+
+maintenance_tables = ['records', 'domains', 'cryptokeys']
+
+create_index = re.compile(
+    r'CREATE\s+(?:UNIQUE\s+)?INDEX\s+(?:IF\s+NOT\s+EXISTS\s+)?(\w+)\s+ON\s+(\w+)',
+    re.IGNORECASE)
+
+
+def expected_indexes(schema_file, tables=None):
+    """
+        (table, index) pairs created by an install schema file.
+    """
+    with open(schema_file, 'r') as f:
+        found = [(table, name) for name, table in create_index.findall(f.read())]
+    return [(t, n) for t, n in found if tables is None or t in tables]
+
+
+def check_indexes(session, schema_file, tables=None):
+    """
+        Log missing and invalid indexes. Returns the number of problems found.
+    """
+    tables = tables or maintenance_tables
+    status = {(table, name): valid
+              for table, name, valid in session.index_status(tables)}
+    problems = 0
+    for table, name in expected_indexes(schema_file, tables):
+        if (table, name) not in status:
+            log.error(f"Index {name} on {table} is missing")
+            problems += 1
+        elif not status[(table, name)]:
+            log.error(
+                f"Index {name} on {table} is invalid. Rebuild it with REINDEX INDEX {name}"
+            )
+            problems += 1
+        else:
+            log.debug(f"Index {name} on {table} is valid")
+    return problems
+
+
+def run_maintenance(session, schema_file, vacuum=False, tables=None):
+    """
+        Refresh statistics on the main tables and verify their indexes. Every step is timed.
+    """
+    tables = tables or maintenance_tables
+    timer = StepTimer('maintenance_step')
+    with instrumentation.span('maintenance'):
+        for statement in session.maintenance_statements(tables, vacuum):
+            with timer.step(statement):
+                session.run_outside_transaction(statement)
+        with timer.step('index check'):
+            problems = check_indexes(session, schema_file, tables)
+    timer.report()
+    if problems:
+        log.warning(f"Maintenance found {problems} index problem(s)")
+    else:
+        log.info("Maintenance done. All indexes are present and valid")
+    return problems
+
+
+class MaintenanceScheduler(threading.Thread):
+    """
+        Runs maintenance every interval seconds on a fresh session.
+    """
+    def __init__(self, backend, interval, vacuum=False):
+        super().__init__(name='maintenance', daemon=True)
+        self.log_name = f"{log_name}.{self.__class__.__name__}"
+        self.log = logging.getLogger(self.log_name)
+        self.backend = backend
+        self.interval = interval
+        self.vacuum = vacuum
+        self.stopped = threading.Event()
+
+    def run(self):
+        self.log.info(f"Running maintenance every {self.interval}s")
+        while not self.stopped.wait(self.interval):
+            try:
+                with self.backend.Session() as session:
+                    run_maintenance(session, self.backend.sql_schema,
+                                    self.vacuum)
+            except SystemExit:
+                # Database helpers exit on errors. Keep the schedule alive.
+                self.log.error("Scheduled maintenance failed")
+
+    def stop(self):
+        self.stopped.set()
@@ -0,0 +1,127 @@
+import os
+import json
+import time
+import logging
+import tempfile
+import threading
+from contextlib import contextmanager
+
+from lib.config import Config
+'''
+    Records timings of the startup phases and exports them as JSON and in the Prometheus text format.
+'''
+
+log_name = f'{Config.logger_name}.metrics'
+log = logging.getLogger(log_name)
+
+metric_prefix = 'pdns_auth'
+
+
+def escape_label(value):
+    return str(value).replace('\\', '\\\\').replace('\n',
+                                                    '\\n').replace('"', '\\"')
+
+
+def format_labels(labels):
+    if not labels:
+        return ''
+    pairs = ','.join(f'{k}="{escape_label(v)}"'
+                     for k, v in sorted(labels.items()))
+    return f'{{{pairs}}}'
+
+
+class Instrumentation:
+    def __init__(self):
+        self.log_name = f"{log_name}.{self.__class__.__name__}"
+        self.log = logging.getLogger(self.log_name)
+        self.lock = threading.Lock()
+        self.spans = []
+
+    def record(self, name, duration, started=None, **labels):
+        span = {
+            'name': name,
+            'labels': {k: str(v)
+                       for k, v in labels.items()},
+            'started': started if started is not None else time.time() -
+            duration,
+            'duration_seconds': round(duration, 6),
+        }
+        with self.lock:
+            self.spans.append(span)
+
+    @contextmanager
+    def span(self, name, **labels):
+        started = time.time()
+        started_perf = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.record(name,
+                        time.perf_counter() - started_perf, started, **labels)
+
+    def to_json(self):
+        with self.lock:
+            spans = list(self.spans)
+        return json.dumps({
+            'version': str(Config.powerdns_app_version),
+            'spans': spans
+        })
+
+    def prometheus_text(self):
+        """
+            Every span becomes a gauge sample. Repeated spans with the same labels keep the last value.
+        """
+        with self.lock:
+            spans = list(self.spans)
+        samples = {}
+        for span in spans:
+            labels = dict(span['labels'], span=span['name'])
+            samples[format_labels(labels)] = span['duration_seconds']
+        lines = [
+            f'# HELP {metric_prefix}_startup_span_seconds Duration of a container startup phase.',
+            f'# TYPE {metric_prefix}_startup_span_seconds gauge',
+        ]
+        lines += [
+            f'{metric_prefix}_startup_span_seconds{labels} {value}'
+            for labels, value in samples.items()
+        ]
+        lines += [
+            f'# HELP {metric_prefix}_info PowerDNS version of this image.',
+            f'# TYPE {metric_prefix}_info gauge',
+            f'{metric_prefix}_info{format_labels({"version": Config.powerdns_app_version})} 1',
+        ]
+        return '\n'.join(lines) + '\n'
+
+    def log_json(self):
+        self.log.info(self.to_json())
+
+    def write_textfile(self, file_path):
+        """
+            Write the Prometheus text atomically so a collector never reads a partial file.
+        """
+        directory = os.path.dirname(file_path) or '.'
+        try:
+            fd, tmp_path = tempfile.mkstemp(dir=directory,
+                                            prefix='.metrics.')
+            with os.fdopen(fd, 'w') as f:
+                f.write(self.prometheus_text())
+            os.chmod(tmp_path, 0o644)
+            os.replace(tmp_path, file_path)
+            self.log.debug(f"Wrote metrics to {file_path}")
+        except OSError as error:
+            self.log.error(f"Unable to write metrics to {file_path}")
+            self.log.debug(error)
+
+    def publish(self):
+        """
+            Log the spans as JSON and refresh the textfile if one is configured.
+        """
+        self.log_json()
+        if Config.metrics_textfile:
+            self.write_textfile(Config.metrics_textfile)
+
+
+instrumentation = Instrumentation()
+
+# Config is evaluated at import time, before any of this exists
+instrumentation.record('config_load', Config.load_duration)
@@ -0,0 +1,66 @@
+import re
+import time
+import logging
+from contextlib import contextmanager
+
+from lib.config import Config
+from lib.metrics import instrumentation
+'''
+    Backend independent helpers shared by the gpgsql and gsqlite3 migration modules.
+'''
+
+log_name = f'{Config.logger_name}.migrations'
+log = logging.getLogger(log_name)
+
+# Upstream schema files wrap themselves in BEGIN/COMMIT. These lines are removed
+# so that a whole upgrade chain can run inside one outer transaction.
+transaction_control = re.compile(
+    r'^\s*(BEGIN|COMMIT|END)(\s+TRANSACTION)?\s*;\s*$',
+    re.IGNORECASE | re.MULTILINE)
+
+
+def strip_transaction_control(sql):
+    """
+        Remove BEGIN/COMMIT statements from a schema file.
+    """
+    return transaction_control.sub('', sql)
+
+
+def read_sql_schema(file_path):
+    """
+        Read a schema file and make it safe to run inside an open transaction.
+    """
+    with open(file_path, "r") as f:
+        return strip_transaction_control(f.read())
+
+
+class StepTimer:
+    """
+        Collects wall clock timings for the steps of an install/migrate run.
+    """
+    def __init__(self, span_name='migration_step'):
+        self.log_name = f"{log_name}.{self.__class__.__name__}"
+        self.log = logging.getLogger(self.log_name)
+        self.span_name = span_name
+        self.steps = []
+
+    @contextmanager
+    def step(self, name):
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            duration = time.perf_counter() - started
+            self.steps.append((name, duration))
+            instrumentation.record(self.span_name, duration, step=name)
+            self.log.debug(f"Step {name} took {duration * 1000:.1f} ms")
+
+    def total(self):
+        return sum(duration for name, duration in self.steps)
+
+    def report(self):
+        for name, duration in self.steps:
+            self.log.info(f"{name}: {duration * 1000:.1f} ms")
+        self.log.info(
+            f"{len(self.steps)} step(s) took {self.total() * 1000:.1f} ms in total"
+        )
@@ -0,0 +1,30 @@
+import hashlib
+import logging
+
+from lib.config import Config
+from lib.migrations.registry import get_registry, file_checksum
+'''
+    A schema fingerprint identifies (app version, backend, install + upgrade script checksums).
+    It is stored in pdns_meta after a successful install/migrate.
+'''
+
+log_name = f'{Config.logger_name}.migrations.fingerprint'
+log = logging.getLogger(log_name)
+
+
+def compute_fingerprint(backend, sql_schemas_path, pdns_app_version,
+                        install_files):
+    """
+        Hash everything that decides what the schema of a fully migrated database looks like.
+    """
+    registry = get_registry(sql_schemas_path)
+    plan = registry.plan(registry.base_version(), pdns_app_version) or []
+    digest = hashlib.sha256()
+    digest.update(f"{backend}\n{pdns_app_version}\n".encode())
+    for file_path in install_files:
+        digest.update(f"{file_checksum(file_path)}\n".encode())
+    for migration in plan:
+        digest.update(
+            f"{migration.old}:{migration.new}:{migration.checksum}\n".encode())
+    return digest.hexdigest()
+
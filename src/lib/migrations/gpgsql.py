@@ -1,11 +1,20 @@
 import os
 import sys
+import io
+import csv
 import psycopg2
+import psycopg2.errors
+import psycopg2.extras
 import logging
+from contextlib import contextmanager
 import time
 from packaging import version
 
-from lib.config import Config, parse_sql_schema_filename
+from lib.config import Config
+from lib.backoff import backoff_delays
+from lib.migrations.common import StepTimer, read_sql_schema
+from lib.migrations.registry import get_registry, format_plan
+from lib.migrations.online import gpgsql_online_steps
 from lib.logger import logger as log
 '''
     SQL migration DLL's are copied from upstream powerdns
@@ -72,138 +81,440 @@ class DB:
         self.conn_obj.rollback()
 
 
-def execute_single_query(query):
+def db_connect_check(user, password, host, port, dbname=None,
+                     connect_timeout=1):
     """
-        Run a simple single read query.
+        Return True if the target database accepts connections and answers a query.
     """
-    conn = DB()
+    conn = None
     try:
-        cursor = conn.create_cursor()
-        cursor.execute(query)
-        record = cursor.fetchone()[0]
-        return record
-
+        conn = psycopg2.connect(host=host,
+                                port=port,
+                                dbname=dbname,
+                                user=user,
+                                password=password,
+                                connect_timeout=connect_timeout)
+        with conn.cursor() as cursor:
+            cursor.execute("select 1")
+        return True
     except (Exception, psycopg2.Error) as error:
-        log.error(error)
-        sys.exit(1)
-
+        log.debug(error)
+        return False
     finally:
         if conn is not None:
-            conn.close_all()
+            conn.close()
 
 
-def execute_sql_schema(file_path):
-    conn = DB()
-    try:
-        with conn.create_cursor() as cursor:
-            cursor.execute(open(file_path, "r").read())
-        conn.commit()
-        log.info(f'Committed schema to database: {file_path}')
-
-    except (Exception, psycopg2.DatabaseError) as error:
-        conn.rollback()
-        log.error(error)
-        sys.exit(1)
+def wait_for_db(timeout=None):
+    """
+        Probe the database until it is ready, backing off exponentially with jitter.
+    """
+    timeout = Config.db_wait_timeout if timeout is None else timeout
+    started = time.monotonic()
+    delays = backoff_delays(Config.db_wait_initial_delay,
+                            Config.db_wait_max_delay)
+    attempts = 0
+    while True:
+        attempts += 1
+        if db_connect_check(host=Config.gpgsql_host,
+                            port=Config.gpgsql_port,
+                            dbname=Config.gpgsql_dbname,
+                            user=Config.gpgsql_user,
+                            password=Config.gpgsql_password,
+                            connect_timeout=Config.db_wait_connect_timeout):
+            break
+
+        remaining = started + timeout - time.monotonic()
+        if remaining <= 0:
+            log.error(
+                f'Could not connect to the database after {attempts} attempt(s)'
+            )
+            sys.exit(1)
+        delay = min(next(delays), remaining)
+        log.info(
+            f"Waiting for postgres at: {Config.gpgsql_host}:{Config.gpgsql_port}/{Config.gpgsql_dbname} (retry in {delay:.2f}s)"
+        )
+        time.sleep(delay)
 
-    finally:
-        if conn is not None:
-            conn.close_all()
+    log.info(
+        f"Database ready after {(time.monotonic() - started) * 1000:.0f} ms and {attempts} attempt(s)"
+    )
 
 
-def bump_pdns_db_version(new_version, old_version):
+class Session:
     """
-        Update the PowerDNS version stored in pdns_meta. Also store the previous version.
+        Keeps one connection open for a whole install/migrate run.
+        Everything executed through the session shares a single transaction until commit() is called.
     """
-    conn = DB()
-    try:
-        cursor = conn.create_cursor()
-        query = f"update pdns_meta set db_version='{new_version}', db_version_previous='{old_version}' where db_version='{old_version}'"
-        log.debug(f'Bumping DB version: [{old_version} -> {new_version}]')
-        cursor.execute(query)
-        conn.commit()
-    except (Exception, psycopg2.DatabaseError) as error:
-        conn.rollback()
-        log.error(
-            f"Was unable to bump the version number to the latest! [{old_version} -> {new_version}]"
+    def __init__(self):
+        self.log_name = f"{log_name}.{self.__class__.__name__}"
+        self.log = logging.getLogger(self.log_name)
+        self.db = DB()
+        self.cursor = None
+        self.timer = StepTimer()
+
+    def __enter__(self):
+        self.cursor = self.db.create_cursor()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is not None:
+            self.db.rollback()
+        self.db.close_all()
+        return False
+
+    @contextmanager
+    def lock(self):
+        """
+            Hold a session level advisory lock so only one replica installs/migrates at a time.
+            Waiting replicas block inside Postgres until the lock is released.
+        """
+        started = time.perf_counter()
+        try:
+            self.cursor.execute("set lock_timeout = %s",
+                                (f"{int(Config.migration_lock_timeout * 1000)}ms", ))
+            self.cursor.execute("select pg_advisory_lock(%s)",
+                                (Config.migration_lock_id, ))
+            self.cursor.execute("reset lock_timeout")
+            self.db.commit()
+
+        except (Exception, psycopg2.Error) as error:
+            self.db.rollback()
+            self.log.error(
+                f"Unable to acquire migration lock {Config.migration_lock_id} within {Config.migration_lock_timeout}s"
+            )
+            self.log.debug(error)
+            sys.exit(1)
+
+        self.log.info(
+            f"Acquired migration lock after {(time.perf_counter() - started) * 1000:.1f} ms"
         )
-        log.debug(error)
-        sys.exit(1)
-    finally:
-        if conn is not None:
-            conn.close_all()
+        try:
+            yield self
+        finally:
+            try:
+                self.cursor.execute("select pg_advisory_unlock(%s)",
+                                    (Config.migration_lock_id, ))
+                self.db.commit()
+                self.log.debug("Released migration lock")
+            except (Exception, psycopg2.Error) as error:
+                # The lock is released together with the connection anyway
+                self.log.debug(error)
+
+    def fetch_one(self, query, params=None):
+        try:
+            self.cursor.execute(query, params)
+            record = self.cursor.fetchone()
+            return None if record is None else record[0]
 
+        except (Exception, psycopg2.Error) as error:
+            self.db.rollback()
+            self.log.error(error)
+            sys.exit(1)
 
-def db_connect_check(user, password, host, port):
-    conn = None
-    try:
-        conn_string = f"host={host} port={port} user={user} password={password} connect_timeout=1"
-        conn = psycopg2.connect(conn_string)
-        return True
-    except:
-        return False
-    finally:
-        if conn is not None:
-            conn.close()
+    def has_existing_table(self, table_name):
+        return self.fetch_one(
+            "select exists(select * from information_schema.tables where table_name=%s)",
+            (table_name, ))
+
+    def get_pdns_db_version(self):
+        """
+            Grab the PowerDNS version stored in pdns_meta and exits the program if missing
+        """
+        record = self.fetch_one("select db_version from pdns_meta")
+        if record is None or record == "":
+            self.log.error(
+                "Missing value in column db_version in table pdns_meta. Should be something like '4.1.0'"
+            )
+            sys.exit(1)
+        self.log.debug(f"Database version: {record}")
+        return version.parse(record)
 
+    def execute_sql_schema(self, file_path):
+        try:
+            with self.timer.step(os.path.basename(file_path)):
+                self.cursor.execute(read_sql_schema(file_path))
+            self.log.debug(f'Executed schema: {file_path}')
 
-def wait_for_db(timeout=30):
-    time_end = time.time() + timeout
-    while db_connect_check(host=Config.gpgsql_host,
-                           port=Config.gpgsql_port,
-                           user=Config.gpgsql_user,
-                           password=Config.gpgsql_password) is False:
-        if time.time() > time_end:
-            log.error('Could not connect to the database')
+        except (Exception, psycopg2.DatabaseError) as error:
+            self.db.rollback()
+            self.log.error(f'Failed to execute schema: {file_path}')
+            self.log.error(error)
             sys.exit(1)
-        log.info(
-            f"Waiting for postgres at: {Config.gpgsql_host}:{Config.gpgsql_port}"
-        )
-        time.sleep(5)
 
+    def bump_pdns_db_version(self, new_version, old_version):
+        """
+            Update the PowerDNS version stored in pdns_meta. Also store the previous version.
+        """
+        try:
+            self.log.debug(
+                f'Bumping DB version: [{old_version} -> {new_version}]')
+            self.cursor.execute(
+                "update pdns_meta set db_version=%s, db_version_previous=%s where db_version=%s",
+                (str(new_version), str(old_version), str(old_version)))
 
-def has_existing_data(table_name):
-    """
-        Query for table domains and records
-        If they exist and has content return true
-    """
-    query = f"select exists(select * from information_schema.tables where table_name='{table_name}')"
-    record = execute_single_query(query)
-    return record
+        except (Exception, psycopg2.DatabaseError) as error:
+            self.db.rollback()
+            self.log.error(
+                f"Was unable to bump the version number to the latest! [{old_version} -> {new_version}]"
+            )
+            self.log.debug(error)
+            sys.exit(1)
 
+    def get_fingerprint(self):
+        """
+            Read db_version and the schema fingerprint from pdns_meta in one query.
+            Returns None if the table or the column does not exist yet.
+        """
+        try:
+            self.cursor.execute("select db_version, fingerprint from pdns_meta")
+            return self.cursor.fetchone()
 
-def get_pdns_db_version():
-    """
-        Grab the PowerDNS version stored in pdns_meta and exits the program if missing
-    """
-    record = execute_single_query("select db_version from pdns_meta")
-    if record is None or record == "":
-        log.error(
-            "Missing value in column db_version in table pdns_meta. Should be something like '4.1.0'"
-        )
-    else:
-        pdns_db_version = version.parse(record)
-        log.debug(f"Database version: {record}")
-        return pdns_db_version
+        except (Exception, psycopg2.Error) as error:
+            self.db.rollback()
+            self.log.debug(f"No schema fingerprint found: {error}")
+            return None
+
+    def set_fingerprint(self, fingerprint):
+        try:
+            self.cursor.execute(
+                "alter table pdns_meta add column if not exists fingerprint varchar(64) default null"
+            )
+            self.cursor.execute("update pdns_meta set fingerprint=%s",
+                                (fingerprint, ))
+
+        except (Exception, psycopg2.DatabaseError) as error:
+            self.db.rollback()
+            self.log.error("Was unable to store the schema fingerprint")
+            self.log.debug(error)
+            sys.exit(1)
+
+    def execute(self, query, params=None):
+        try:
+            self.cursor.execute(query, params)
+
+        except (Exception, psycopg2.DatabaseError) as error:
+            self.db.rollback()
+            self.log.error(f"Query failed: {query}")
+            self.log.error(error)
+            sys.exit(1)
+
+    def fetch_all(self, query, params=None):
+        self.execute(query, params)
+        return self.cursor.fetchall()
+
+    def table_indexes(self, table_name):
+        """
+            (name, definition) of the secondary indexes on a table. Primary keys and unique indexes are left out.
+        """
+        return self.fetch_all(
+            "select i.relname, pg_get_indexdef(i.oid) from pg_index x "
+            "join pg_class i on i.oid = x.indexrelid "
+            "join pg_class t on t.oid = x.indrelid "
+            "where t.relname = %s and not x.indisprimary and not x.indisunique",
+            (table_name, ))
+
+    def insert_domains(self, domains):
+        """
+            Insert (name, type, master, account) rows. Returns {name: id} of the domains that were created.
+        """
+        if not domains:
+            return {}
+        try:
+            rows = psycopg2.extras.execute_values(
+                self.cursor,
+                "insert into domains (name, type, master, account) values %s "
+                "on conflict (name) do nothing returning id, name",
+                domains,
+                page_size=len(domains),
+                fetch=True)
+            return {name: domain_id for domain_id, name in rows}
+
+        except (Exception, psycopg2.DatabaseError) as error:
+            self.db.rollback()
+            self.log.error("Bulk insert into domains failed")
+            self.log.error(error)
+            sys.exit(1)
+
+    def insert_records(self, records):
+        """
+            Stream (domain_id, name, type, content, ttl, prio, disabled, auth) rows with COPY.
+        """
+        if not records:
+            return
+        buffer = io.StringIO()
+        writer = csv.writer(buffer)
+        for domain_id, name, rtype, content, ttl, prio, disabled, auth in records:
+            writer.writerow([
+                domain_id, name, rtype, content, ttl, prio,
+                't' if disabled else 'f', 't' if auth else 'f'
+            ])
+        buffer.seek(0)
+        try:
+            self.cursor.copy_expert(
+                "copy records (domain_id, name, type, content, ttl, prio, disabled, auth) "
+                "from stdin with (format csv)", buffer)
 
+        except (Exception, psycopg2.DatabaseError) as error:
+            self.db.rollback()
+            self.log.error("COPY into records failed")
+            self.log.error(error)
+            sys.exit(1)
+
+    def insert_cryptokeys(self, keys):
+        """
+            Insert (domain_id, flags, active, content) rows.
+        """
+        if not keys:
+            return
+        try:
+            psycopg2.extras.execute_values(
+                self.cursor,
+                "insert into cryptokeys (domain_id, flags, active, content) values %s",
+                keys,
+                page_size=1000)
+
+        except (Exception, psycopg2.DatabaseError) as error:
+            self.db.rollback()
+            self.log.error("Bulk insert into cryptokeys failed")
+            self.log.error(error)
+            sys.exit(1)
+
+    def sync_autoprimaries(self, rows, prune=True):
+        """
+            Upsert (ip, nameserver, account) rows into supermasters with one statement.
+            With prune the entries that are not in rows are deleted. Returns the number of deleted entries.
+        """
+        ips, nameservers, accounts = (list(column) for column in zip(*rows))
+        self.execute(
+            "insert into supermasters (ip, nameserver, account) "
+            "select * from unnest(%s::inet[], %s::varchar[], %s::varchar[]) "
+            "on conflict (ip, nameserver) do update set account = excluded.account",
+            (ips, nameservers, accounts))
+        if not prune:
+            return 0
+        self.execute(
+            "delete from supermasters s where not exists "
+            "(select 1 from unnest(%s::inet[], %s::varchar[]) as k(ip, nameserver) "
+            "where k.ip = s.ip and k.nameserver = s.nameserver)",
+            (ips, nameservers))
+        return self.cursor.rowcount
+
+    def maintenance_statements(self, tables, vacuum=False):
+        if vacuum:
+            return [f"vacuum (analyze) {table}" for table in tables]
+        return [f"analyze {table}" for table in tables]
+
+    def run_outside_transaction(self, statement):
+        """
+            Run a statement that is not allowed inside a transaction block (VACUUM).
+        """
+        self.commit()
+        try:
+            self.db.conn_obj.autocommit = True
+            self.cursor.execute(statement)
 
-def install():
+        except (Exception, psycopg2.DatabaseError) as error:
+            self.log.error(f"Query failed: {statement}")
+            self.log.error(error)
+            sys.exit(1)
+
+        finally:
+            self.db.conn_obj.autocommit = False
+
+    def index_status(self, tables):
+        """
+            (table, index, valid) for every index on the given tables.
+        """
+        return self.fetch_all(
+            "select t.relname, i.relname, x.indisvalid and x.indisready from pg_index x "
+            "join pg_class i on i.oid = x.indexrelid "
+            "join pg_class t on t.oid = x.indrelid "
+            "where t.relname = any(%s)", (list(tables), ))
+
+    def transaction(self, statements):
+        """
+            Run (query, params) pairs in their own short transaction with lock_timeout and statement_timeout.
+            Lock and statement timeouts roll back and retry with backoff. Returns the rows of the last statement.
+        """
+        delays = backoff_delays(0.1, 5)
+        for attempt in range(Config.migration_retries + 1):
+            try:
+                self.cursor.execute(
+                    "set local lock_timeout = %s",
+                    (f"{int(Config.migration_ddl_lock_timeout * 1000)}ms", ))
+                self.cursor.execute(
+                    "set local statement_timeout = %s",
+                    (f"{int(Config.migration_statement_timeout * 1000)}ms", ))
+                for query, params in statements:
+                    self.cursor.execute(query, params)
+                rows = self.cursor.fetchall(
+                ) if self.cursor.description else None
+                self.db.commit()
+                return rows
+
+            except (psycopg2.errors.LockNotAvailable,
+                    psycopg2.errors.QueryCanceled) as error:
+                self.db.rollback()
+                if attempt == Config.migration_retries:
+                    self.log.error(
+                        f"Giving up after {attempt + 1} attempt(s): {error}")
+                    sys.exit(1)
+                delay = next(delays)
+                self.log.warning(
+                    f"{str(error).strip()}. Retrying in {delay:.2f}s")
+                time.sleep(delay)
+
+            except (Exception, psycopg2.DatabaseError) as error:
+                self.db.rollback()
+                self.log.error(error)
+                sys.exit(1)
+
+    def rollback(self):
+        self.db.rollback()
+
+    def commit(self):
+        try:
+            with self.timer.step('commit'):
+                self.db.commit()
+
+        except (Exception, psycopg2.DatabaseError) as error:
+            self.db.rollback()
+            self.log.error(error)
+            sys.exit(1)
+
+
+def install(session=None):
     """
         Creates new DB if it does not exist. Also populates it with an empty schema if it does not exist
     """
-    if not has_existing_data("records"):
+    if session is None:
+        with Session() as session:
+            return install(session)
+
+    if not session.has_existing_table("records"):
         log.info("Install fresh database")
-        execute_sql_schema(sql_schema)
-        execute_sql_schema(create_metadata_table)
+        session.execute_sql_schema(sql_schema)
+        session.execute_sql_schema(create_metadata_table)
+        session.commit()
+        log.info('Committed fresh schema to database')
 
     else:
         log.debug("Database already exists!")
 
 
-def migrate(sql_schemas_path, pdns_app_version_raw):
+def migrate(sql_schemas_path, pdns_app_version_raw, session=None):
     """
         Compares the running application version with the database version.
         If the database version is older than the application version it will run an schema upgrade.
+        The whole upgrade chain and the version bumps are committed as one transaction,
+        unless MIGRATION_ONLINE is set and a step has an online variant (see lib.migrations.online).
+        Returns the list of applied migrations.
     """
+    if session is None:
+        with Session() as session:
+            return migrate(sql_schemas_path, pdns_app_version_raw, session)
+
     if pdns_app_version_raw is None or pdns_app_version_raw == "":
         log.error(
             "Missing value from PowerDNS. Should be something like '4.1.0'")
@@ -214,39 +525,47 @@ def migrate(sql_schemas_path, pdns_app_version_raw):
         pdns_app_version = version.parse(pdns_app_version_raw)
         log.debug(f"PowerDNS version: {pdns_app_version_raw}")
 
-    pdns_db_version = get_pdns_db_version()  # Refresh version from DB
+    pdns_db_version = session.get_pdns_db_version()
 
-    if pdns_app_version.major == pdns_db_version.major and pdns_app_version.minor == pdns_db_version.minor:
+    if pdns_app_version == pdns_db_version:
         log.info("No DB upgrade needed... Continuing")
 
-    elif pdns_app_version.major == pdns_db_version.major and pdns_app_version.minor > pdns_db_version.minor:
-        log.info("Found new version. Atempting schema upgrade!")
-        log.debug(f"Walking {sql_schemas_path}")
-
-        for dir_path, subdir_list, file_list in os.walk(sql_schemas_path):
-            filenames = sorted(file_list)
-            log.debug(f"Sorted filenames: {filenames}")
-
-            for filename in filenames:
-                schema_old, schema_new = parse_sql_schema_filename(filename)
-                pdns_db_version = get_pdns_db_version()  # Refresh DB version
-
-                if schema_old.major == pdns_db_version.major and schema_old.minor == pdns_db_version.minor and pdns_app_version.major == schema_new.major and pdns_app_version.minor >= schema_new.minor:
-                    full_path = os.path.join(dir_path, filename)
-                    log.info(f"Found match: {filename}")
-                    log.debug(f"Full Path: {full_path}")
-                    execute_sql_schema(full_path)
-                    bump_pdns_db_version(schema_new, schema_old)
-                    log.info(f"Upgraded from {schema_old} to {schema_new}")
-
-                else:
-                    log.debug(f"Skipping: {filename}")
-    elif pdns_app_version.major == pdns_db_version.major and pdns_app_version.minor > pdns_db_version.minor:
+    elif pdns_app_version < pdns_db_version:
         log.error(
             f"The pdns_db version cannot be newer than the pdns_app version! Please update the app :)"
         )
         sys.exit(1)
 
     else:
-        log.error(f"This should not be possible!")
-        sys.exit(1)
+        plan = get_registry(sql_schemas_path).plan(pdns_db_version,
+                                                  pdns_app_version)
+        if plan is None:
+            log.error(
+                f"No upgrade path from {pdns_db_version} to {pdns_app_version} in {sql_schemas_path}"
+            )
+            sys.exit(1)
+
+        log.info("Found new version. Atempting schema upgrade!")
+        for line in format_plan(plan):
+            log.info(f"Planned: {line}")
+
+        for migration in plan:
+            online_step = gpgsql_online_steps.get(
+                (str(migration.old),
+                 str(migration.new))) if Config.migration_online else None
+            if online_step is not None:
+                # Commits the steps before it and its own batches
+                with session.timer.step(
+                        f"{os.path.basename(migration.path)} (online)"):
+                    online_step.run(session, migration)
+            else:
+                session.execute_sql_schema(migration.path)
+                session.bump_pdns_db_version(migration.new, migration.old)
+            log.info(f"Upgraded from {migration.old} to {migration.new}")
+
+        session.commit()
+        log.info(f"Committed schema upgrade to {pdns_app_version}")
+        session.timer.report()
+        return plan
+
+    return []
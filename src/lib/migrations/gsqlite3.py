@@ -1,11 +1,17 @@
 import os
 import sys
+import fcntl
+import time
 from pathlib import Path
 import logging
+from contextlib import contextmanager
 from packaging import version
 import sqlite3
 
-from lib.config import Config, parse_sql_schema_filename
+from lib.config import Config
+from lib.migrations.common import StepTimer, read_sql_schema
+from lib.migrations.registry import get_registry, format_plan
+from lib.snapshot import take_snapshot
 from lib.logger import logger as log
 '''
     SQL migration DLL's are copied from upstream powerdns
@@ -19,18 +25,34 @@ create_metadata_table = os.path.join(Config.sql_schema_path,
                                      "create_metadata_table.sqlite3.sql")
 
 
+def split_sql_statements(sql):
+    """
+        Split a script into complete statements so they can be executed one by one.
+    """
+    statements = []
+    statement = ""
+    for line in sql.splitlines(keepends=True):
+        statement += line
+        if sqlite3.complete_statement(statement):
+            statements.append(statement.strip())
+            statement = ""
+    return statements
+
+
 class DB:
-    def __init__(self):
+    def __init__(self, isolation_level=""):
         self.log_name = f"{log_name}.{self.__class__.__name__}"
         self.log = logging.getLogger(self.log_name)
         self.db = Config.gsqlite3_path
+        self.isolation_level = isolation_level
 
         self.conn_obj = None
         self.cursor_obj = None
 
     def connection(self):
         try:
-            conn = sqlite3.connect(self.db)
+            conn = sqlite3.connect(self.db,
+                                   isolation_level=self.isolation_level)
             self.log.debug(f"Connected to database [{self.db}]")
             return conn
 
@@ -60,147 +82,392 @@ class DB:
         self.conn_obj.rollback()
 
 
-def get_pdns_db_version():
+class Session:
     """
-        Grab the PowerDNS version stored in pdns_meta and exits the program if missing
+        Keeps one connection open for a whole install/migrate run.
+        Everything executed through the session shares a single transaction until commit() is called.
     """
-    record = execute_single_query("SELECT db_version FROM pdns_meta")
-    if record is None or record == "":
-        log.error(
-            "Missing value in column db_version in table pdns_meta. Should be something like '4.1.0'"
-        )
-    else:
-        pdns_db_version = version.parse(record)
-        log.debug(f"Database version: {record}")
-        return pdns_db_version
+    def __init__(self):
+        self.log_name = f"{log_name}.{self.__class__.__name__}"
+        self.log = logging.getLogger(self.log_name)
+        # Transactions are handled explicitly. The sqlite3 module would otherwise
+        # commit before every DDL statement and executescript() call.
+        self.db = DB(isolation_level=None)
+        self.cursor = None
+        self.timer = StepTimer()
+        self.existing_domains = None
+        self.next_domain_id = None
+
+    def __enter__(self):
+        self.cursor = self.db.create_cursor()
+        self.apply_pragmas(Config.sqlite_profile.get('connection_pragmas', []))
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is not None and self.db.conn_obj.in_transaction:
+            self.db.rollback()
+        self.db.close_all()
+        return False
+
+    @contextmanager
+    def lock(self):
+        """
+            Hold an exclusive file lock next to the database so only one container installs/migrates at a time.
+        """
+        lock_path = f"{self.db.db}.migrate.lock"
+        started = time.perf_counter()
+        deadline = time.monotonic() + Config.migration_lock_timeout
+        with open(lock_path, "a") as lock_file:
+            while True:
+                try:
+                    fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                    break
+                except BlockingIOError:
+                    if time.monotonic() > deadline:
+                        self.log.error(
+                            f"Unable to acquire migration lock {lock_path} within {Config.migration_lock_timeout}s"
+                        )
+                        sys.exit(1)
+                    time.sleep(0.05)
+            self.log.info(
+                f"Acquired migration lock after {(time.perf_counter() - started) * 1000:.1f} ms"
+            )
+            try:
+                yield self
+            finally:
+                fcntl.flock(lock_file, fcntl.LOCK_UN)
+                self.log.debug("Released migration lock")
+
+    def apply_pragmas(self, pragmas):
+        """
+            Apply (name, value) pragmas. Must run outside of a transaction.
+        """
+        for name, value in pragmas:
+            try:
+                self.cursor.execute(f"PRAGMA {name}={value}")
+                self.log.debug(
+                    f"PRAGMA {name}={value} -> {self.cursor.fetchall()}")
+            except (Exception, sqlite3.Error) as error:
+                self.log.error(f"Unable to set PRAGMA {name}={value}")
+                self.log.debug(error)
+
+    def optimize(self, analyze=False):
+        """
+            Refresh the planner statistics. A full ANALYZE is used after tables were rebuilt.
+        """
+        statement = "ANALYZE" if analyze else "PRAGMA optimize"
+        try:
+            with self.timer.step(statement):
+                self.cursor.execute(statement)
+                self.cursor.fetchall()
+        except (Exception, sqlite3.Error) as error:
+            self.log.error(f"{statement} failed")
+            self.log.debug(error)
 
+    def begin(self):
+        if not self.db.conn_obj.in_transaction:
+            self.cursor.execute("BEGIN")
 
-def execute_single_query(query):
-    """
-        Execute a single query.
-    """
-    conn = DB()
-    try:
-        log.debug(f"Query: {query}")
-        cursor = conn.create_cursor()
-        cursor.execute(query)
-        conn.commit()
-        record = cursor.fetchone()[0]
-        return record
-
-    except (Exception, sqlite3.Error) as error:
-        conn.rollback()
-        log.error(error)
-        sys.exit(1)
+    def fetch_one(self, query, params=()):
+        try:
+            self.cursor.execute(query, params)
+            record = self.cursor.fetchone()
+            return None if record is None else record[0]
 
-    finally:
-        if conn is not None:
-            conn.close_all()
+        except (Exception, sqlite3.Error) as error:
+            self.log.error(error)
+            sys.exit(1)
 
+    def has_existing_table(self, table_name):
+        return bool(
+            self.fetch_one(
+                "SELECT count(name) FROM sqlite_master WHERE type='table' AND name=?",
+                (table_name, )))
+
+    def get_pdns_db_version(self):
+        """
+            Grab the PowerDNS version stored in pdns_meta and exits the program if missing
+        """
+        record = self.fetch_one("SELECT db_version FROM pdns_meta")
+        if record is None or record == "":
+            self.log.error(
+                "Missing value in column db_version in table pdns_meta. Should be something like '4.1.0'"
+            )
+            sys.exit(1)
+        self.log.debug(f"Database version: {record}")
+        return version.parse(record)
 
-def execute_sql_schema(file_path):
-    """
-        Execute a single file.
-    """
-    conn = DB()
-    try:
-        cursor = conn.create_cursor()
-        cursor.executescript(open(file_path, "r").read())
-        conn.commit()
-        log.info(f"Committed schema to database: {file_path}")
-
-    except (Exception, sqlite3.Error) as error:
-        conn.rollback()
-        log.error(error)
-        sys.exit(1)
+    def execute_sql_schema(self, file_path):
+        try:
+            with self.timer.step(os.path.basename(file_path)):
+                self.begin()
+                for statement in split_sql_statements(
+                        read_sql_schema(file_path)):
+                    self.cursor.execute(statement)
+            self.log.debug(f"Executed schema: {file_path}")
+
+        except (Exception, sqlite3.Error) as error:
+            self.db.rollback()
+            self.log.error(f"Failed to execute schema: {file_path}")
+            self.log.error(error)
+            sys.exit(1)
 
-    finally:
-        if conn is not None:
-            conn.close_all()
+    def bump_pdns_db_version(self, new_version, old_version):
+        """
+            Update the PowerDNS version stored in pdns_meta. Also store the previous version.
+        """
+        try:
+            self.log.debug(
+                f"Bumping DB version: [{old_version} -> {new_version}]")
+            self.begin()
+            self.cursor.execute(
+                "UPDATE pdns_meta SET db_version=?, db_version_previous=? WHERE db_version=?",
+                (str(new_version), str(old_version), str(old_version)))
 
+        except (Exception, sqlite3.Error) as error:
+            self.db.rollback()
+            self.log.error(
+                f"Was unable to bump the version number to the latest! [{old_version} -> {new_version}]"
+            )
+            self.log.debug(error)
+            sys.exit(1)
 
-def bump_pdns_db_version(new_version, old_version):
-    """
-        Update the PowerDNS version stored in pdns_meta. Also store the previous version.
-    """
-    conn = DB()
-    try:
-        cursor = conn.create_cursor()
-        query = f"UPDATE pdns_meta SET db_version='{new_version}', db_version_previous='{old_version}' WHERE db_version='{old_version}'"
-        log.debug(f"Bumping DB version: [{old_version} -> {new_version}]")
-        cursor.execute(query)
-        conn.commit()
-
-    except (Exception, sqlite3.Error) as error:
-        conn.rollback()
-        log.error(
-            f"Was unable to bump the version number to the latest! [{old_version} -> {new_version}]"
-        )
-        log.debug(error)
-        sys.exit(1)
+    def get_fingerprint(self):
+        """
+            Read db_version and the schema fingerprint from pdns_meta in one query.
+            Returns None if the table or the column does not exist yet.
+        """
+        try:
+            self.cursor.execute("SELECT db_version, fingerprint FROM pdns_meta")
+            return self.cursor.fetchone()
+
+        except (Exception, sqlite3.Error) as error:
+            self.log.debug(f"No schema fingerprint found: {error}")
+            return None
 
-    finally:
-        if conn is not None:
-            conn.close_all()
+    def set_fingerprint(self, fingerprint):
+        try:
+            self.begin()
+            self.cursor.execute("PRAGMA table_info(pdns_meta)")
+            if "fingerprint" not in [row[1] for row in self.cursor.fetchall()]:
+                self.cursor.execute(
+                    "ALTER TABLE pdns_meta ADD COLUMN fingerprint VARCHAR(64) DEFAULT NULL"
+                )
+            self.cursor.execute("UPDATE pdns_meta SET fingerprint=?",
+                                (fingerprint, ))
 
+        except (Exception, sqlite3.Error) as error:
+            self.db.rollback()
+            self.log.error("Was unable to store the schema fingerprint")
+            self.log.debug(error)
+            sys.exit(1)
 
-def has_existing_table(table_name):
-    """
-        Return True if the given table name exists.
-    """
-    conn = DB().connection()
-    query = f"SELECT count(name) FROM sqlite_master WHERE type='table' AND name='{table_name}';"
-    cursor = conn.cursor()
-    try:
-        cursor.execute(query)
-        if not cursor.fetchone()[0]:
-            result = False
-        else:
-            result = True
-
-    except (Exception) as error:
-        conn.rollback()
-        conn.close()
-        log.error(error)
-        sys.exit(1)
+    def execute(self, query, params=()):
+        try:
+            self.begin()
+            self.cursor.execute(query, params)
+
+        except (Exception, sqlite3.Error) as error:
+            self.db.rollback()
+            self.log.error(f"Query failed: {query}")
+            self.log.error(error)
+            sys.exit(1)
+
+    def fetch_all(self, query, params=()):
+        try:
+            self.cursor.execute(query, params)
+            return self.cursor.fetchall()
+
+        except (Exception, sqlite3.Error) as error:
+            self.log.error(error)
+            sys.exit(1)
+
+    def table_indexes(self, table_name):
+        """
+            (name, definition) of the secondary indexes on a table. Automatic and unique indexes are left out.
+        """
+        return [(name, sql) for name, sql in self.fetch_all(
+            "SELECT name, sql FROM sqlite_master WHERE type='index' AND tbl_name=? AND sql IS NOT NULL",
+            (table_name, )) if not sql.upper().startswith("CREATE UNIQUE")]
+
+    def insert_domains(self, domains):
+        """
+            Insert (name, type, master, account) rows. Returns {name: id} of the domains that were created.
+            Ids are assigned here so that executemany() can be used.
+        """
+        if not domains:
+            return {}
+        if self.existing_domains is None:
+            self.existing_domains = {
+                name.lower()
+                for name, in self.fetch_all("SELECT name FROM domains")
+            }
+            self.next_domain_id = (self.fetch_one(
+                "SELECT max(id) FROM domains") or 0) + 1
+
+        created = {}
+        rows = []
+        for name, kind, master, account in domains:
+            if name in self.existing_domains or name in created:
+                continue
+            created[name] = self.next_domain_id
+            rows.append((self.next_domain_id, name, kind, master, account))
+            self.next_domain_id += 1
+        try:
+            self.begin()
+            self.cursor.executemany(
+                "INSERT INTO domains (id, name, type, master, account) VALUES (?, ?, ?, ?, ?)",
+                rows)
+            self.existing_domains.update(created)
+            return created
+
+        except (Exception, sqlite3.Error) as error:
+            self.db.rollback()
+            self.log.error("Bulk insert into domains failed")
+            self.log.error(error)
+            sys.exit(1)
+
+    def insert_records(self, records):
+        """
+            Insert (domain_id, name, type, content, ttl, prio, disabled, auth) rows with executemany().
+        """
+        if not records:
+            return
+        try:
+            self.begin()
+            self.cursor.executemany(
+                "INSERT INTO records (domain_id, name, type, content, ttl, prio, disabled, auth) "
+                "VALUES (?, ?, ?, ?, ?, ?, ?, ?)", records)
+
+        except (Exception, sqlite3.Error) as error:
+            self.db.rollback()
+            self.log.error("Bulk insert into records failed")
+            self.log.error(error)
+            sys.exit(1)
+
+    def insert_cryptokeys(self, keys):
+        """
+            Insert (domain_id, flags, active, content) rows with executemany().
+        """
+        if not keys:
+            return
+        try:
+            self.begin()
+            self.cursor.executemany(
+                "INSERT INTO cryptokeys (domain_id, flags, active, content) VALUES (?, ?, ?, ?)",
+                keys)
+
+        except (Exception, sqlite3.Error) as error:
+            self.db.rollback()
+            self.log.error("Bulk insert into cryptokeys failed")
+            self.log.error(error)
+            sys.exit(1)
+
+    def sync_autoprimaries(self, rows, prune=True):
+        """
+            Upsert (ip, nameserver, account) rows into supermasters with one prepared statement.
+            With prune the entries that are not in rows are deleted. Returns the number of deleted entries.
+        """
+        try:
+            self.begin()
+            self.cursor.executemany(
+                "INSERT INTO supermasters (ip, nameserver, account) VALUES (?, ?, ?) "
+                "ON CONFLICT (ip, nameserver) DO UPDATE SET account = excluded.account",
+                rows)
+            if not prune:
+                return 0
+            wanted = {(ip, nameserver.lower()) for ip, nameserver, account in rows}
+            self.cursor.execute("SELECT ip, nameserver FROM supermasters")
+            stale = [(ip, nameserver) for ip, nameserver in self.cursor.fetchall()
+                     if (ip, nameserver.lower()) not in wanted]
+            self.cursor.executemany(
+                "DELETE FROM supermasters WHERE ip = ? AND nameserver = ?", stale)
+            return len(stale)
+
+        except (Exception, sqlite3.Error) as error:
+            self.db.rollback()
+            self.log.error("Was unable to update supermasters")
+            self.log.error(error)
+            sys.exit(1)
+
+    def maintenance_statements(self, tables, vacuum=False):
+        statements = [f"ANALYZE {table}" for table in tables]
+        if vacuum:
+            statements.append("VACUUM")  # SQLite only vacuums whole databases
+        return statements + ["PRAGMA optimize"]
+
+    def run_outside_transaction(self, statement):
+        """
+            Run a statement that is not allowed inside a transaction (VACUUM).
+        """
+        self.commit()
+        try:
+            self.cursor.execute(statement)
+            self.cursor.fetchall()
+
+        except (Exception, sqlite3.Error) as error:
+            self.log.error(f"Query failed: {statement}")
+            self.log.error(error)
+            sys.exit(1)
+
+    def index_status(self, tables):
+        """
+            (table, index, valid) for every index on the given tables. SQLite has no invalid indexes.
+        """
+        placeholders = ", ".join("?" for table in tables)
+        return [(table, name, True) for table, name in self.fetch_all(
+            f"SELECT tbl_name, name FROM sqlite_master WHERE type='index' AND tbl_name IN ({placeholders})",
+            tuple(tables))]
+
+    def rollback(self):
+        self.db.rollback()
+
+    def commit(self):
+        if not self.db.conn_obj.in_transaction:
+            return
+        try:
+            with self.timer.step("commit"):
+                self.db.commit()
 
-    conn.commit()
-    conn.close()
-    return result
+        except (Exception, sqlite3.Error) as error:
+            self.db.rollback()
+            self.log.error(error)
+            sys.exit(1)
 
 
-def install():
+def install(session=None):
     """
         Creates new DB if it does not exist. Also populates it with an empty schema if it does not exist
     """
-    Path(Config.gsqlite3_path).touch()
-    conn = None
-    try:
-        conn = sqlite3.connect(Config.gsqlite3_path)
-        log.info(f"SQLite version: {sqlite3.version}")
-
-    except sqlite3.Error as e:
-        log.error(e)
-        sys.exit(1)
-
-    finally:
-        if conn:
-            conn.close()
+    if session is None:
+        Path(Config.gsqlite3_path).touch()
+        log.info(f"SQLite version: {sqlite3.sqlite_version}")
+        with Session() as session:
+            return install(session)
 
-    if not has_existing_table("records"):
+    if not session.has_existing_table("records"):
         log.info("Install fresh database")
-        execute_sql_schema(sql_schema)
-        execute_sql_schema(create_metadata_table)
+        session.apply_pragmas(Config.sqlite_profile.get('install_pragmas', []))
+        session.execute_sql_schema(sql_schema)
+        session.execute_sql_schema(create_metadata_table)
+        session.commit()
+        log.info("Committed fresh schema to database")
 
     else:
         log.debug("Database already exists!")
 
 
-def migrate(sql_schemas_path, pdns_app_version_raw):
+def migrate(sql_schemas_path, pdns_app_version_raw, session=None):
     """
         Compares the running application version with the database version.
         If the database version is older than the application version it will run an schema upgrade.
+        The whole upgrade chain and the version bumps are committed as one transaction.
+        Returns the list of applied migrations.
     """
+    if session is None:
+        with Session() as session:
+            return migrate(sql_schemas_path, pdns_app_version_raw, session)
+
     if pdns_app_version_raw is None or pdns_app_version_raw == "":
         log.error(
             "Missing value from PowerDNS. Should be something like '4.1.0'")
@@ -211,39 +478,46 @@ def migrate(sql_schemas_path, pdns_app_version_raw):
         pdns_app_version = version.parse(pdns_app_version_raw)
         log.debug(f"PowerDNS version: {pdns_app_version_raw}")
 
-    pdns_db_version = get_pdns_db_version()  # Refresh version from DB
+    pdns_db_version = session.get_pdns_db_version()
 
-    if pdns_app_version.major == pdns_db_version.major and pdns_app_version.minor == pdns_db_version.minor:
+    if pdns_app_version == pdns_db_version:
         log.info("No DB upgrade needed... Continuing")
+        if Config.sqlite_profile.get('optimize'):
+            session.optimize()
 
-    elif pdns_app_version.major == pdns_db_version.major and pdns_app_version.minor > pdns_db_version.minor:
-        log.info("Found new version. Atempting schema upgrade!")
-        log.debug(f"Walking {sql_schemas_path}")
-
-        for dir_path, subdir_list, file_list in os.walk(sql_schemas_path):
-            filenames = sorted(file_list)
-            log.debug(f"Sorted filenames: {filenames}")
-
-            for filename in filenames:
-                schema_old, schema_new = parse_sql_schema_filename(filename)
-                pdns_db_version = get_pdns_db_version()  # Refresh DB version
-
-                if schema_old.major == pdns_db_version.major and schema_old.minor == pdns_db_version.minor and pdns_app_version.major == schema_new.major and pdns_app_version.minor >= schema_new.minor:
-                    full_path = os.path.join(dir_path, filename)
-                    log.info(f"Found match: {filename}")
-                    log.debug(f"Full Path: {full_path}")
-                    execute_sql_schema(full_path)
-                    bump_pdns_db_version(schema_new, schema_old)
-                    log.info(f"Upgraded from {schema_old} to {schema_new}")
-
-                else:
-                    log.debug(f"Skipping: {filename}")
-    elif pdns_app_version.major == pdns_db_version.major and pdns_app_version.minor > pdns_db_version.minor:
+    elif pdns_app_version < pdns_db_version:
         log.error(
             f"The pdns_db version cannot be newer than the pdns_app version! Please update the app :)"
         )
         sys.exit(1)
 
     else:
-        log.error(f"This should not be possible!")
-        sys.exit(1)
+        plan = get_registry(sql_schemas_path).plan(pdns_db_version,
+                                                  pdns_app_version)
+        if plan is None:
+            log.error(
+                f"No upgrade path from {pdns_db_version} to {pdns_app_version} in {sql_schemas_path}"
+            )
+            sys.exit(1)
+
+        log.info("Found new version. Atempting schema upgrade!")
+        for line in format_plan(plan):
+            log.info(f"Planned: {line}")
+
+        if Config.sqlite_snapshot:
+            take_snapshot(session.db.conn_obj, Config.gsqlite3_path,
+                          pdns_db_version)
+
+        for migration in plan:
+            session.execute_sql_schema(migration.path)
+            session.bump_pdns_db_version(migration.new, migration.old)
+            log.info(f"Upgraded from {migration.old} to {migration.new}")
+
+        session.commit()
+        log.info(f"Committed schema upgrade to {pdns_app_version}")
+        if Config.sqlite_profile.get('optimize'):
+            session.optimize(analyze=True)
+        session.timer.report()
+        return plan
+
+    return []
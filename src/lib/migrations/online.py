@@ -0,0 +1,127 @@
+import time
+import logging
+from collections import namedtuple
+
+from lib.config import Config
+'''
+    Online variants of the PostgreSQL upgrade scripts.
+    Instead of one long transaction that rewrites a whole table, an online step runs
+      1. short DDL transactions that add the new columns,
+      2. a backfill in bounded batches, each committed on its own,
+      3. one short transaction that locks the table, copies rows changed during the backfill,
+         swaps the columns and bumps pdns_meta.
+    Every transaction runs with lock_timeout/statement_timeout and is retried with backoff.
+'''
+
+log_name = f'{Config.logger_name}.migrations.online'
+log = logging.getLogger(log_name)
+
+# table: table to backfill, assignment: SET clause, key: monotonic key column
+Backfill = namedtuple('Backfill', ['table', 'assignment', 'key'])
+
+
+class OnlineStep:
+    def __init__(self, pre=(), backfills=(), post=()):
+        self.log_name = f"{log_name}.{self.__class__.__name__}"
+        self.log = logging.getLogger(self.log_name)
+        self.pre = list(pre)
+        self.backfills = list(backfills)
+        self.post = list(post)
+
+    def estimate_rows(self, session, table):
+        return int(
+            session.fetch_one(
+                "select greatest(reltuples, 0)::bigint from pg_class where relname = %s",
+                (table, )) or 0)
+
+    def backfill(self, session, backfill):
+        """
+            Walk the table in key order, batch_size rows per transaction.
+        """
+        batch_size = Config.migration_batch_size
+        total = self.estimate_rows(session, backfill.table)
+        query = (f"with batch as (select {backfill.key} from {backfill.table} "
+                 f"where {backfill.key} > %s order by {backfill.key} limit %s) "
+                 f"update {backfill.table} t set {backfill.assignment} "
+                 f"from batch where t.{backfill.key} = batch.{backfill.key} "
+                 f"returning t.{backfill.key}")
+        last_key = -1
+        done = 0
+        started = time.perf_counter()
+        reported = started
+        while True:
+            rows = session.transaction([(query, (last_key, batch_size))])
+            if not rows:
+                break
+            done += len(rows)
+            last_key = max(row[0] for row in rows)
+            now = time.perf_counter()
+            if now - reported >= 5:
+                reported = now
+                progress = f"{done * 100 / total:.0f}%" if total else "?"
+                self.log.info(
+                    f"Backfilling {backfill.table}: {done}/{total} rows ({progress}, {done / (now - started):.0f} rows/s)"
+                )
+        self.log.info(
+            f"Backfilled {done} row(s) of {backfill.table} in {time.perf_counter() - started:.1f}s"
+        )
+
+    def run(self, session, migration):
+        self.log.info(
+            f"Running online upgrade {migration.old} -> {migration.new}")
+        session.commit()
+        if self.pre:
+            session.transaction([(statement, None) for statement in self.pre])
+        for backfill in self.backfills:
+            self.backfill(session, backfill)
+        session.transaction(
+            [(statement, None) for statement in self.post] +
+            [("update pdns_meta set db_version=%s, db_version_previous=%s where db_version=%s",
+              (str(migration.new), str(migration.old), str(migration.old)))])
+
+
+def copy_column(table, column, new_column, column_type, expression):
+    """
+        Online replacement of `column` by `expression` stored in a new column of column_type.
+        The new column ends up last in the table, unlike with the ALTER TYPE of the upstream scripts.
+        Every statement can run again after an interrupted upgrade: the swap only happens while new_column exists.
+    """
+    return dict(
+        pre=[
+            f"alter table {table} add column if not exists {new_column} {column_type}"
+        ],
+        backfills=[Backfill(table, f"{new_column} = {expression}", 'id')],
+        post=[
+            f"lock table {table} in access exclusive mode",
+            f"""do $$ begin
+                if exists (select 1 from information_schema.columns
+                           where table_schema = current_schema() and table_name = '{table}'
+                           and column_name = '{new_column}') then
+                    update {table} set {new_column} = {expression} where {new_column} is distinct from {expression};
+                    alter table {table} drop column {column};
+                    alter table {table} rename column {new_column} to {column};
+                end if;
+            end $$""",
+        ])
+
+
+notified_serial = copy_column(
+    'domains', 'notified_serial', 'notified_serial_new', 'bigint',
+    'case when notified_serial >= 0 then notified_serial::bigint end')
+cryptokeys_content = copy_column('cryptokeys', 'content', 'content_new',
+                                 'text', 'content')
+
+# (old, new) -> online replacement of sql_update_schemas/gpgsql/<old>_to_<new>_schema.pgsql.sql
+gpgsql_online_steps = {
+    ('4.1.0', '4.2.0'):
+    OnlineStep(pre=["alter table records drop column if exists change_date"] +
+               notified_serial['pre'],
+               backfills=notified_serial['backfills'],
+               post=notified_serial['post']),
+    ('4.2.0', '4.3.0'):
+    OnlineStep(pre=[
+        "alter table cryptokeys add column if not exists published bool default true"
+    ] + cryptokeys_content['pre'],
+               backfills=cryptokeys_content['backfills'],
+               post=cryptokeys_content['post']),
+}
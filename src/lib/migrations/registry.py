@@ -0,0 +1,112 @@
+import os
+import re
+import hashlib
+import logging
+from collections import deque, namedtuple
+from functools import lru_cache
+from packaging import version
+
+from lib.config import Config
+'''
+    Index of the upgrade scripts in sql_update_schemas/<backend>.
+    Every file named <old>_to_<new>_schema.<dialect>.sql becomes an edge in a version graph.
+'''
+
+log_name = f'{Config.logger_name}.migrations.registry'
+log = logging.getLogger(log_name)
+
+schema_filename = re.compile(
+    r'^(?P<old>\d+\.\d+\.\d+)_to_(?P<new>\d+\.\d+\.\d+)_schema\.(?P<dialect>[a-z0-9]+)\.sql$'
+)
+
+Migration = namedtuple('Migration', ['old', 'new', 'path', 'checksum'])
+
+
+def file_checksum(file_path):
+    with open(file_path, 'rb') as f:
+        return hashlib.sha256(f.read()).hexdigest()
+
+
+class Registry:
+    def __init__(self, sql_schemas_path):
+        self.log_name = f"{log_name}.{self.__class__.__name__}"
+        self.log = logging.getLogger(self.log_name)
+        self.path = sql_schemas_path
+        self.edges = {}  # old version -> list of migrations
+        self.load()
+
+    def load(self):
+        for filename in sorted(os.listdir(self.path)):
+            match = schema_filename.match(filename)
+            if match is None:
+                self.log.warning(
+                    f"Ignoring file not named <old>_to_<new>_schema.<dialect>.sql: {filename}"
+                )
+                continue
+            full_path = os.path.join(self.path, filename)
+            migration = Migration(old=version.parse(match.group('old')),
+                                  new=version.parse(match.group('new')),
+                                  path=full_path,
+                                  checksum=file_checksum(full_path))
+            if migration.new <= migration.old:
+                self.log.warning(f"Ignoring downgrade script: {filename}")
+                continue
+            self.edges.setdefault(migration.old, []).append(migration)
+        self.log.debug(
+            f"Indexed {sum(len(e) for e in self.edges.values())} migration(s) in {self.path}"
+        )
+
+    def migrations(self):
+        return sorted((m for e in self.edges.values() for m in e),
+                      key=lambda m: (m.old, m.new))
+
+    def base_version(self):
+        """
+            The oldest version any migration starts from.
+        """
+        return min(self.edges) if self.edges else None
+
+    def plan(self, from_version, to_version):
+        """
+            Shortest chain of migrations from from_version to to_version.
+            Returns an empty list if the versions are equal and None if there is no path.
+        """
+        from_version = version.parse(str(from_version))
+        to_version = version.parse(str(to_version))
+        if from_version == to_version:
+            return []
+
+        previous = {from_version: None}
+        queue = deque([from_version])
+        while queue:
+            current = queue.popleft()
+            # Prefer the smallest steps first so equal length plans are stable
+            for migration in sorted(self.edges.get(current, []),
+                                    key=lambda m: m.new):
+                if migration.new in previous or migration.new > to_version:
+                    continue
+                previous[migration.new] = migration
+                if migration.new == to_version:
+                    chain = []
+                    step = migration
+                    while step is not None:
+                        chain.append(step)
+                        step = previous[step.old]
+                    return list(reversed(chain))
+                queue.append(migration.new)
+        return None
+
+
+@lru_cache(maxsize=None)
+def get_registry(sql_schemas_path):
+    """
+        Build the registry once per process and directory.
+    """
+    return Registry(sql_schemas_path)
+
+
+def format_plan(plan):
+    return [
+        f"{m.old} -> {m.new}  {os.path.basename(m.path)}  sha256:{m.checksum[:12]}"
+        for m in plan
+    ]
@@ -0,0 +1,177 @@
+import os
+import time
+import logging
+import threading
+from pathlib import Path
+
+from lib.config import Config
+from lib import dns
+'''
+    Readiness gate. Sends SOA queries over UDP and TCP to the local pdns_server for a set of zones
+    and reports the result on /ready and through a ready file.
+    Probes run fast until the first success and slow down while the state is steady.
+'''
+
+log_name = f'{Config.logger_name}.readiness'
+log = logging.getLogger(log_name)
+
+
+def sample_zones(backend, count):
+    """
+        Pick zones that have an SOA record from the domains table.
+    """
+    with backend.Session() as session:
+        rows = session.fetch_all(
+            "select name from domains d where exists "
+            "(select 1 from records r where r.domain_id = d.id and r.type = 'SOA') "
+            f"order by random() limit {int(count)}")
+    return [row[0] for row in rows]
+
+
+class ReadinessProbe(threading.Thread):
+    def __init__(self, zones=None, backend=None, sample=0, ready_file=None):
+        super().__init__(name='readiness', daemon=True)
+        self.log_name = f"{log_name}.{self.__class__.__name__}"
+        self.log = logging.getLogger(self.log_name)
+        self.host, self.port = dns.local_target(Config.pdns_conf)
+        self.zones = list(zones or [])
+        self.backend = backend
+        self.sample = sample
+        self.ready_file = ready_file
+        self.ready = False
+        self.reason = 'not probed yet'
+        self.failures = 0
+        self.interval = Config.ready_interval_min
+        self.stopped = threading.Event()
+        self.gates = []
+        self.running = threading.Event()
+        self.running.set()
+        self.add_gate(self.running, 'restarting pdns_server')
+
+    def add_gate(self, event, reason):
+        """
+            Stay not ready until event is set, whatever the probes say.
+        """
+        self.gates.append((event, reason))
+
+    def resolve_zones(self):
+        if self.zones or not self.sample or self.backend is None:
+            return
+        try:
+            self.zones = sample_zones(self.backend, self.sample)
+            self.log.info(f"Probing sampled zones {self.zones}")
+        except SystemExit:
+            # Database helpers exit on errors. Fall back to the root probe
+            self.log.warning("Unable to sample zones from the domains table")
+
+    def probe_zone(self, zone, tcp):
+        """
+            Returns None when zone is answered authoritatively, otherwise the reason.
+        """
+        transport = 'tcp' if tcp else 'udp'
+        try:
+            response = dns.query(self.host,
+                                 self.port,
+                                 zone,
+                                 'SOA',
+                                 timeout=Config.ready_timeout,
+                                 tcp=tcp)
+        except (OSError, ValueError) as error:
+            return f"{zone} over {transport}: {error or 'timeout'}"
+        if zone == '.':
+            return None  # Any answer means pdns_server is listening
+        if response['rcode'] != 'NOERROR' or not response['answers']:
+            return f"{zone} over {transport}: {response['rcode']} with {response['answers']} answer(s)"
+        if not response['authoritative']:
+            return f"{zone} over {transport}: answer is not authoritative"
+        return None
+
+    def gate_reason(self):
+        for event, reason in self.gates:
+            if not event.is_set():
+                return reason
+        return None
+
+    def probe(self):
+        reason = self.gate_reason()
+        if reason is not None:
+            return reason
+        for zone in self.zones or ['.']:
+            for tcp in ([False, True] if Config.ready_tcp else [False]):
+                reason = self.probe_zone(zone, tcp)
+                if reason is not None:
+                    return reason
+        return None
+
+    def set_state(self, ready, reason):
+        changed = ready != self.ready
+        self.ready, self.reason = ready, reason
+        if not changed:
+            return
+        if ready:
+            self.log.info("PowerDNS is ready")
+            if self.ready_file:
+                Path(self.ready_file).touch()
+        else:
+            self.log.warning(f"PowerDNS is not ready: {reason}")
+            if self.ready_file and os.path.exists(self.ready_file):
+                os.unlink(self.ready_file)
+
+    def step(self):
+        reason = self.probe()
+        if self.stopped.is_set():
+            return  # Drained or stopped while probing
+        # A gate closed while probing, e.g. a restart began
+        reason = reason or self.gate_reason()
+        if reason is None:
+            self.failures = 0
+            steady = self.ready
+            self.set_state(True, 'ok')
+            # Slow down once the state did not change for a probe
+            self.interval = min(self.interval * 2, Config.ready_interval_max
+                                ) if steady else Config.ready_interval_min
+        else:
+            self.failures += 1
+            self.log.debug(f"Probe failed: {reason}")
+            if not self.ready or self.failures >= Config.ready_failure_threshold:
+                self.set_state(False, reason)
+            self.interval = Config.ready_interval_min
+
+    def run(self):
+        if self.ready_file and os.path.exists(self.ready_file):
+            os.unlink(self.ready_file)  # Left over from a previous run
+        self.resolve_zones()
+        while not self.stopped.is_set():
+            started = time.perf_counter()
+            self.step()
+            self.stopped.wait(
+                max(self.interval - (time.perf_counter() - started), 0))
+
+    def stop(self, reason='stopped'):
+        self.stopped.set()
+        self.set_state(False, reason)
+
+    def drain(self):
+        """
+            Report not ready for good, pdns_server is about to stop.
+        """
+        self.stop('draining')
+
+    def hold(self):
+        """
+            Report not ready until release(), pdns_server is about to restart.
+        """
+        self.running.clear()
+        self.failures = 0
+        self.set_state(False, 'restarting pdns_server')
+
+    def release(self):
+        """
+            pdns_server was started again. Ready once it answers the probes.
+        """
+        self.running.set()
+
+    def http_handler(self):
+        if self.ready:
+            return 200, 'text/plain', 'ready\n'
+        return 503, 'text/plain', f'not ready: {self.reason}\n'
@@ -0,0 +1,117 @@
+import os
+import logging
+import threading
+
+from lib.config import Config, rebuild_pdns_conf
+from lib.exporter import ControlSocketSource
+'''
+    Applies changes of the mounted config without restarting the container.
+    The file is polled, merged again like at start and pdns.conf is only rendered when the result changed.
+    Settings that pdns_server accepts at runtime are set over the control socket,
+    everything else restarts pdns_server. Backend settings need a container restart.
+'''
+
+log_name = f'{Config.logger_name}.reload'
+log = logging.getLogger(log_name)
+
+# Settings "pdns_control set" changes at runtime
+runtime_settings = {'query-logging'}
+# Settings the database was provisioned for
+provision_settings = ('launch', 'gpgsql-', 'gsqlite3-', 'lmdb-')
+
+
+def config_changes(current, new):
+    """
+        {key: (old value, new value)} for every key that was added, removed or changed.
+    """
+    keys = set(current) | set(new)
+    return {
+        key: (current.get(key), new.get(key))
+        for key in sorted(keys)
+        if str(current.get(key)) != str(new.get(key))
+    }
+
+
+def control_command(line):
+    """
+        Send one command over the control socket of pdns_server and return the answer.
+    """
+    source = ControlSocketSource(
+        os.path.join(str(Config.pdns_conf.get('socket-dir')),
+                     'pdns.controlsocket'))
+    try:
+        source.connect()
+        return source.command(line).decode(errors='replace').strip('\0\n ')
+    finally:
+        source.close()
+
+
+class ConfigWatcher(threading.Thread):
+    def __init__(self, supervisor, render, interval=2):
+        super().__init__(name='config-watcher', daemon=True)
+        self.log_name = f"{log_name}.{self.__class__.__name__}"
+        self.log = logging.getLogger(self.log_name)
+        self.supervisor = supervisor
+        self.render = render
+        self.interval = interval
+        self.path = Config.pdns_conf_file
+        self.last_signature = self.signature()
+        self.stopped = threading.Event()
+
+    def signature(self):
+        try:
+            stat = os.stat(self.path)  # Follows the symlinks of ConfigMap volumes
+            return stat.st_ino, stat.st_mtime_ns, stat.st_size
+        except OSError:
+            return None
+
+    def run(self):
+        self.log.info(f"Watching {self.path} every {self.interval:g}s")
+        while not self.stopped.wait(self.interval):
+            signature = self.signature()
+            if signature != self.last_signature:
+                self.last_signature = signature
+                self.reload()
+
+    def stop(self):
+        self.stopped.set()
+
+    def set_at_runtime(self, changes):
+        for key, (old, new) in changes.items():
+            try:
+                answer = control_command(f"set {key} {new}")
+            except OSError as error:
+                self.log.warning(f"Unable to set {key} at runtime: {error}")
+                return False
+            if 'cannot' in answer.lower() or 'unknown' in answer.lower():
+                self.log.warning(f"Unable to set {key} at runtime: {answer}")
+                return False
+            self.log.info(f"Set {key}={new} at runtime")
+        return True
+
+    def reload(self):
+        new_conf = rebuild_pdns_conf()
+        changes = config_changes(Config.pdns_conf, new_conf)
+        if not changes:
+            self.log.info(f"{self.path} changed without changing the effective config")
+            return
+        for key, (old, new) in changes.items():
+            self.log.info(f"{key}: {old} -> {new}")
+        blocked = [key for key in changes if key.startswith(provision_settings)]
+        if blocked:
+            self.log.error(
+                f"{', '.join(blocked)} changed. Restart the container to apply the new config"
+            )
+            return
+
+        # Template and the rest of the entrypoint read Config.pdns_conf
+        Config.pdns_conf.clear()
+        Config.pdns_conf.update(new_conf)
+        self.render()
+
+        if all(key in runtime_settings and new is not None
+               for key, (old, new) in changes.items()):
+            if self.set_at_runtime(changes):
+                return
+        self.log.info("Restarting pdns_server to apply the new config")
+        self.supervisor.request_restart()
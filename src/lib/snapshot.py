@@ -0,0 +1,335 @@
+import os
+import sys
+import time
+import shutil
+import sqlite3
+import logging
+import tempfile
+import urllib.request
+
+from lib.config import Config
+from lib.metrics import instrumentation
+'''
+    Snapshots of the SQLite database, written with the SQLite backup API.
+    export writes a copy for bootstrapping secondaries. bootstrap loads such a copy into an empty
+    secondary database before pdns_server starts and turns the primary zones into secondary zones,
+    so only SOA checks and incremental transfers are left instead of an AXFR of every zone.
+    Before a schema upgrade a snapshot is kept next to the database, restore swaps one back in.
+'''
+
+log_name = f'{Config.logger_name}.snapshot'
+log = logging.getLogger(log_name)
+
+required_tables = ('domains', 'records', 'pdns_meta')
+
+
+def _replace(tmp_path, destination):
+    with open(tmp_path, 'rb') as f:
+        os.fsync(f.fileno())
+    os.replace(tmp_path, destination)
+
+
+def _copy_into(source_path, database):
+    """
+        Overwrite database with the file at source_path through the backup API. SQLite writes the copy as one
+        transaction on the live database, so its journal or WAL stays valid when the copy fails.
+    """
+    source = sqlite3.connect(f'file:{source_path}?mode=ro', uri=True)
+    try:
+        target = sqlite3.connect(database)
+        try:
+            source.backup(target)
+        finally:
+            target.close()
+    finally:
+        source.close()
+
+
+def copy_database(source, destination, pages=-1, finish=None):
+    """
+        Copy the open connection source to destination with the SQLite backup API, pages per step (-1: all).
+        Other connections are only locked out during a step. When they change the database the copy starts
+        over, so it is consistent. finish(target) runs on the copy before destination is replaced atomically.
+        Returns the number of bytes written.
+    """
+    directory = os.path.dirname(os.path.abspath(destination))
+    fd, tmp_path = tempfile.mkstemp(
+        dir=directory, prefix=f'.{os.path.basename(destination)}.')
+    os.close(fd)
+    started = time.perf_counter()
+    last_report = [started]
+
+    def progress(status, remaining, total):
+        now = time.perf_counter()
+        if now - last_report[0] >= 5:
+            last_report[0] = now
+            log.info(f"Copied {total - remaining}/{total} pages to {destination}")
+
+    try:
+        target = sqlite3.connect(tmp_path)
+        try:
+            source.backup(target, pages=pages, progress=progress)
+            # One self contained file, also when the source runs in WAL mode
+            target.execute("PRAGMA journal_mode=DELETE").fetchall()
+            if finish is not None:
+                finish(target)
+                target.commit()
+        finally:
+            target.close()
+        _replace(tmp_path, destination)
+    except BaseException:
+        if os.path.exists(tmp_path):
+            os.unlink(tmp_path)
+        raise
+
+    size = os.path.getsize(destination)
+    elapsed = time.perf_counter() - started
+    log.info(
+        f"Copied {size / 1048576:.1f} MiB to {destination} in {elapsed:.1f}s ({size / 1048576 / max(elapsed, 0.001):.1f} MiB/s)"
+    )
+    return size
+
+
+def stamp_snapshot(target):
+    target.execute("DROP TABLE IF EXISTS snapshot_info")
+    target.execute("CREATE TABLE snapshot_info (created INTEGER NOT NULL)")
+    target.execute("INSERT INTO snapshot_info (created) VALUES (?)",
+                   (int(time.time()), ))
+
+
+def export_snapshot(database, destination):
+    """
+        Copy database to destination and stamp the copy with its creation time.
+        The destination is replaced atomically. Returns the size of the snapshot in bytes.
+    """
+    try:
+        source = sqlite3.connect(f'file:{database}?mode=ro', uri=True)
+        try:
+            return copy_database(source, destination,
+                                 Config.sqlite_snapshot_pages, stamp_snapshot)
+        finally:
+            source.close()
+    except (Exception, sqlite3.Error) as error:
+        log.error(f"Unable to export {database} to {destination}")
+        log.error(error)
+        sys.exit(1)
+
+
+def needs_bootstrap(database):
+    """
+        True when the database does not exist yet or holds no domains.
+    """
+    if not os.path.exists(database) or os.path.getsize(database) == 0:
+        return True
+    conn = sqlite3.connect(database)
+    try:
+        if not conn.execute(
+                "SELECT count(name) FROM sqlite_master WHERE type='table' AND name='domains'"
+        ).fetchone()[0]:
+            return True
+        return conn.execute("SELECT 1 FROM domains LIMIT 1").fetchone() is None
+    finally:
+        conn.close()
+
+
+def fetch_snapshot(source, destination):
+    """
+        Copy a snapshot from a path or a http(s) URL.
+    """
+    if source.startswith(('http://', 'https://')):
+        with urllib.request.urlopen(source) as response, open(destination,
+                                                                'wb') as f:
+            shutil.copyfileobj(response, f, 1048576)
+    else:
+        shutil.copyfile(source, destination)
+
+
+def convert_to_secondary(conn, primaries):
+    """
+        Turn the primary and native zones of a snapshot into secondary zones of primaries.
+        Native zones are replicated by the database on the primary, a secondary can only keep them fresh by transfers.
+        Zones with DNSSEC keys are signed online on the primary and have no signatures in records.
+        Their records are removed so pdns_server transfers the signed zone instead of serving it unsigned.
+        Returns (converted, signed) zone counts.
+    """
+    master = ','.join(primaries)
+    native = conn.execute(
+        "SELECT count(*) FROM domains WHERE upper(type) = 'NATIVE'").fetchone()[0]
+    if native:
+        log.warning(
+            f"{native} native zone(s) become secondary zones. The primaries must allow AXFR of them")
+    converted = conn.execute(
+        "UPDATE domains SET type = 'SLAVE', master = ?, last_check = ?, notified_serial = NULL "
+        "WHERE upper(type) IN ('MASTER', 'PRIMARY', 'NATIVE')",
+        (master, snapshot_created(conn))).rowcount
+    # Only secondary zones are transferred again, other zones would be left empty
+    signed = conn.execute(
+        "SELECT DISTINCT domain_id FROM cryptokeys WHERE domain_id IN "
+        "(SELECT id FROM domains WHERE upper(type) IN ('SLAVE', 'SECONDARY'))").fetchall()
+    conn.executemany("DELETE FROM records WHERE domain_id = ?", signed)
+    conn.executemany("UPDATE domains SET last_check = NULL WHERE id = ?",
+                     signed)
+    # Private keys and the primary's autoprimaries stay on the primary
+    conn.execute("DELETE FROM cryptokeys")
+    conn.execute("DELETE FROM supermasters")
+    conn.execute("DROP TABLE IF EXISTS snapshot_info")
+    return converted, len(signed)
+
+
+def snapshot_created(conn):
+    """
+        Creation time stored by export. Zones count as checked at that time and are refreshed as their SOA says.
+    """
+    try:
+        return conn.execute("SELECT created FROM snapshot_info").fetchone()[0]
+    except sqlite3.Error:
+        return None
+
+
+def bootstrap(source, database, primaries):
+    """
+        Load the snapshot at source into database if it is empty. Returns True when the snapshot was loaded.
+    """
+    if not needs_bootstrap(database):
+        log.info(f"{database} already holds zones. Skipping snapshot bootstrap")
+        return False
+    if not primaries:
+        log.error(
+            "No primaries for the bootstrapped zones. Set SNAPSHOT_PRIMARIES or configure autoprimaries"
+        )
+        sys.exit(1)
+
+    directory = os.path.dirname(os.path.abspath(database))
+    fd, tmp_path = tempfile.mkstemp(dir=directory,
+                                    prefix=f'.{os.path.basename(database)}.')
+    os.close(fd)
+    try:
+        with instrumentation.span('snapshot_bootstrap'):
+            started = time.perf_counter()
+            fetch_snapshot(source, tmp_path)
+            log.info(
+                f"Fetched snapshot {source} ({os.path.getsize(tmp_path) / 1048576:.1f} MiB) in {time.perf_counter() - started:.1f}s"
+            )
+            conn = sqlite3.connect(tmp_path, isolation_level=None)
+            try:
+                check = conn.execute("PRAGMA quick_check").fetchone()[0]
+                if check != 'ok':
+                    raise sqlite3.DatabaseError(f"quick_check: {check}")
+                tables = {
+                    name
+                    for name, in conn.execute(
+                        "SELECT name FROM sqlite_master WHERE type='table'")
+                }
+                missing = [t for t in required_tables if t not in tables]
+                if missing:
+                    raise sqlite3.DatabaseError(
+                        f"Not a PowerDNS database, missing {missing}")
+                conn.execute("BEGIN")
+                converted, signed = convert_to_secondary(conn, primaries)
+                conn.execute("COMMIT")
+            finally:
+                conn.close()
+            _copy_into(tmp_path, database)
+    except (Exception, sqlite3.Error) as error:
+        log.error(f"Unable to bootstrap {database} from {source}")
+        log.error(error)
+        sys.exit(1)
+    finally:
+        if os.path.exists(tmp_path):
+            os.unlink(tmp_path)
+
+    log.info(
+        f"Bootstrapped {database} from {source}: {converted} zone(s) now secondary of {','.join(primaries)}"
+    )
+    if signed:
+        log.info(f"{signed} DNSSEC signed zone(s) will be transferred")
+    return True
+
+
+def snapshot_dir(database):
+    return Config.sqlite_snapshot_dir or os.path.join(
+        os.path.dirname(os.path.abspath(database)), 'snapshots')
+
+
+def list_snapshots(database):
+    """
+        Pre-migration snapshots of database, oldest first.
+    """
+    directory = snapshot_dir(database)
+    prefix = f"{os.path.basename(database)}."
+    if not os.path.isdir(directory):
+        return []
+    return sorted(
+        os.path.join(directory, name) for name in os.listdir(directory)
+        if name.startswith(prefix) and name.endswith('.snapshot'))
+
+
+def take_snapshot(conn, database, db_version):
+    """
+        Copy the database behind conn into the snapshot directory in page batches and keep the last snapshots.
+        Exits when there is not enough space, migrating without a way back is not an option.
+    """
+    directory = snapshot_dir(database)
+    os.makedirs(directory, exist_ok=True)
+    size = sum(
+        os.path.getsize(database + suffix) for suffix in ('', '-wal')
+        if os.path.exists(database + suffix))
+    free = shutil.disk_usage(directory).free
+    if free < size * 1.1:
+        log.error(
+            f"{directory} has {free / 1048576:.0f} MiB free, the snapshot needs about {size / 1048576:.0f} MiB"
+        )
+        sys.exit(1)
+
+    # Names sort by time
+    path = os.path.join(
+        directory,
+        f"{os.path.basename(database)}.{time.strftime('%Y%m%dT%H%M%SZ', time.gmtime())}.{db_version}.snapshot"
+    )
+    log.info(f"Taking a snapshot of {database} at {db_version} before upgrading")
+    try:
+        with instrumentation.span('sqlite_snapshot'):
+            copy_database(conn, path, Config.sqlite_snapshot_pages)
+    except (Exception, sqlite3.Error) as error:
+        log.error(f"Unable to take a snapshot of {database}")
+        log.error(error)
+        sys.exit(1)
+    prune_snapshots(database, Config.sqlite_snapshot_keep)
+    return path
+
+
+def prune_snapshots(database, keep):
+    snapshots = list_snapshots(database)
+    for path in snapshots[:max(len(snapshots) - keep, 0)]:
+        log.info(f"Removing old snapshot {path}")
+        os.unlink(path)
+
+
+def restore_snapshot(database, snapshot):
+    """
+        Replace database with the contents of snapshot. The snapshot is kept.
+    """
+    started = time.perf_counter()
+    try:
+        conn = sqlite3.connect(f'file:{snapshot}?mode=ro', uri=True)
+        try:
+            check = conn.execute("PRAGMA quick_check").fetchone()[0]
+            if check != 'ok':
+                raise sqlite3.DatabaseError(f"quick_check: {check}")
+            snapshot_version = conn.execute(
+                "SELECT db_version FROM pdns_meta").fetchone()[0]
+        finally:
+            conn.close()
+        with instrumentation.span('sqlite_restore'):
+            _copy_into(snapshot, database)
+    except (Exception, sqlite3.Error) as error:
+        log.error(f"Unable to restore {database} from {snapshot}")
+        log.error(error)
+        sys.exit(1)
+
+    size = os.path.getsize(database)
+    elapsed = time.perf_counter() - started
+    log.info(
+        f"Restored {database} to {snapshot_version} from {snapshot}: {size / 1048576:.1f} MiB in {elapsed:.1f}s "
+        f"({size / 1048576 / max(elapsed, 0.001):.1f} MiB/s)")
+    return snapshot_version
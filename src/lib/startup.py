@@ -0,0 +1,109 @@
+import time
+import logging
+from concurrent.futures import ThreadPoolExecutor, FIRST_COMPLETED, wait
+
+from lib.config import Config
+from lib.metrics import instrumentation
+'''
+    Runs the startup phases as a small dependency graph on a thread pool.
+    Independent phases (DNS resolution, template rendering, database readiness) overlap.
+'''
+
+log_name = f'{Config.logger_name}.startup'
+log = logging.getLogger(log_name)
+
+
+class Task:
+    def __init__(self, name, func, requires=()):
+        self.name = name
+        self.func = func
+        self.requires = list(requires)
+        self.started = None
+        self.finished = None
+
+    def duration(self):
+        return self.finished - self.started
+
+    def run(self):
+        self.started = time.perf_counter()
+        try:
+            return self.func()
+        finally:
+            self.finished = time.perf_counter()
+            instrumentation.record('startup_phase',
+                                   self.finished - self.started,
+                                   phase=self.name)
+
+
+class StartupGraph:
+    def __init__(self, max_workers=4):
+        self.log_name = f"{log_name}.{self.__class__.__name__}"
+        self.log = logging.getLogger(self.log_name)
+        self.max_workers = max_workers
+        self.tasks = {}
+        self.started = None
+        self.finished = None
+
+    def add(self, name, func, requires=()):
+        self.tasks[name] = Task(name, func, requires)
+
+    def _validate(self):
+        for task in self.tasks.values():
+            missing = [r for r in task.requires if r not in self.tasks]
+            if missing:
+                raise ValueError(
+                    f"Task {task.name} requires unknown task(s): {missing}")
+
+    def run(self):
+        """
+            Run every task as soon as its requirements are done.
+            The first failing task stops the graph and its exception is re-raised.
+        """
+        self._validate()
+        self.started = time.perf_counter()
+        done = set()
+        running = {}
+        with ThreadPoolExecutor(max_workers=self.max_workers,
+                                thread_name_prefix='startup') as executor:
+            while len(done) < len(self.tasks):
+                for task in self.tasks.values():
+                    if task.name in done or task.name in running.values():
+                        continue
+                    if all(r in done for r in task.requires):
+                        self.log.debug(f"Starting {task.name}")
+                        running[executor.submit(task.run)] = task.name
+                if not running:
+                    raise ValueError("Startup graph has a dependency cycle")
+
+                finished, _ = wait(running, return_when=FIRST_COMPLETED)
+                for future in finished:
+                    name = running.pop(future)
+                    future.result()  # Re-raise failures (including sys.exit)
+                    done.add(name)
+                    self.log.debug(
+                        f"Finished {name} in {self.tasks[name].duration() * 1000:.1f} ms"
+                    )
+        self.finished = time.perf_counter()
+        self.report()
+
+    def critical_path(self):
+        """
+            Walk back from the last task to finish through the requirement that finished last.
+        """
+        path = []
+        candidates = list(self.tasks.values())
+        while candidates:
+            task = max(candidates, key=lambda t: t.finished)
+            path.append(task)
+            candidates = [self.tasks[r] for r in task.requires]
+        return list(reversed(path))
+
+    def report(self):
+        for task in sorted(self.tasks.values(), key=lambda t: t.started):
+            self.log.info(
+                f"{task.name}: {task.duration() * 1000:.1f} ms (started at +{(task.started - self.started) * 1000:.1f} ms)"
+            )
+        path = self.critical_path()
+        self.log.info(
+            f"Critical path: {' -> '.join(t.name for t in path)} ({(self.finished - self.started) * 1000:.1f} ms)"
+        )
@@ -0,0 +1,247 @@
+import os
+import sys
+import time
+import signal
+import select
+import logging
+import subprocess
+
+from lib.config import Config
+from lib.backoff import backoff_delays
+'''
+    Runs pdns_server as a supervised child.
+    SIGTERM/SIGINT start a graceful stop: readiness fails first, pdns_server keeps answering
+    for the drain window and is then stopped. Restarts for a config change drain the same way.
+    Other signals are forwarded as they are.
+    When running as PID 1 orphaned children are reaped as well. In that case other code should not
+    wait on its own subprocesses, their exit status may be collected here first.
+'''
+
+log_name = f'{Config.logger_name}.supervisor'
+log = logging.getLogger(log_name)
+
+forwarded_signals = [signal.SIGHUP, signal.SIGUSR1, signal.SIGUSR2]
+stop_signals = [signal.SIGTERM, signal.SIGINT, signal.SIGQUIT]
+
+
+def exec_command(command):
+    """
+        Replace the Python process with command. Nothing written in Python keeps running.
+    """
+    log.info(f"Replacing the entrypoint with {command[0]}")
+    for handler in logging.getLogger(Config.logger_name).handlers:
+        handler.flush()
+    sys.stdout.flush()
+    sys.stderr.flush()
+    os.execvp(command[0], command)
+
+
+class Wakeup:
+    """
+        Wakes the main loop like a threading.Event, but is safe to set from signal handlers.
+        Handlers run in the main thread between any two bytecodes, also while it holds the lock of an Event.
+    """
+    def __init__(self):
+        self.read_fd, self.write_fd = os.pipe()
+        os.set_blocking(self.read_fd, False)
+        os.set_blocking(self.write_fd, False)
+
+    def set(self):
+        try:
+            os.write(self.write_fd, b'\0')
+        except BlockingIOError:
+            pass  # Pipe is full, the loop wakes up anyway
+
+    def wait(self, timeout):
+        select.select([self.read_fd], [], [], timeout)
+
+    def clear(self):
+        try:
+            while os.read(self.read_fd, 4096):
+                pass
+        except BlockingIOError:
+            pass
+
+
+class Supervisor:
+    def __init__(self,
+                 command,
+                 drain=None,
+                 drain_seconds=0,
+                 stop_timeout=10,
+                 restart=False,
+                 hold=None,
+                 release=None):
+        self.log_name = f"{log_name}.{self.__class__.__name__}"
+        self.log = logging.getLogger(self.log_name)
+        self.command = command
+        self.drain = drain
+        self.drain_seconds = drain_seconds
+        self.stop_timeout = stop_timeout
+        self.restart = restart
+        # Fail readiness while pdns_server restarts and let the probes decide again afterwards
+        self.hold = hold
+        self.release = release
+        self.restart_requested = False
+        self.process = None
+        self.started = None
+        self.stopping = False
+        self.restart_deadline = None
+        self.wakeup = Wakeup()
+        self.pending_signals = []
+        self.reap_orphans = os.getpid() == 1
+
+    def handle_signal(self, signum, frame):
+        # Only record the signal. The main loop acts on it
+        self.pending_signals.append(signum)
+        self.wakeup.set()
+
+    def install_signal_handlers(self):
+        for signum in forwarded_signals + stop_signals:
+            signal.signal(signum, self.handle_signal)
+        signal.signal(signal.SIGCHLD, lambda signum, frame: self.wakeup.set())
+
+    def start(self):
+        if self.started is None:
+            self.install_signal_handlers()
+        self.log.info(f"Starting {self.command[0]}")
+        self.process = subprocess.Popen(self.command, shell=False)
+        self.started = time.monotonic()
+        return self.process
+
+    def running(self):
+        return self.process is not None and self.process.returncode is None
+
+    def reap(self):
+        """
+            Collect exited children without blocking. Records the exit status of pdns_server.
+        """
+        if not self.reap_orphans:
+            self.process.poll()
+            return
+        while True:
+            try:
+                pid, status = os.waitpid(-1, os.WNOHANG)
+            except ChildProcessError:
+                return
+            if pid == 0:
+                return
+            if pid == self.process.pid:
+                # Same convention as Popen: negative signal number when killed
+                self.process.returncode = -os.WTERMSIG(
+                    status) if os.WIFSIGNALED(status) else os.WEXITSTATUS(status)
+            else:
+                self.log.debug(f"Reaped orphaned process {pid}")
+
+    def request_restart(self):
+        """
+            Fail readiness, keep serving for the drain window, then stop pdns_server and start it again.
+            Blocks the calling thread for the drain window. Can be called from any thread but the main loop.
+        """
+        if not self.running() or self.stopping or self.restart_requested:
+            return
+        self.restart_requested = True
+        if self.hold is not None:
+            self.log.info(
+                f"Restarting {self.command[0]}. Draining for {self.drain_seconds:g}s")
+            self.hold()
+            deadline = time.monotonic() + self.drain_seconds
+            while self.running() and not self.stopping and time.monotonic() < deadline:
+                time.sleep(min(deadline - time.monotonic(), 0.1))
+        if not self.running() or self.stopping:
+            # Stopped for good or crashed during the drain. The main loop takes over
+            self.restart_requested = False
+            return
+        self.restart_deadline = time.monotonic() + self.stop_timeout
+        self.process.send_signal(signal.SIGTERM)
+        self.wakeup.set()
+
+    def forward(self, signum):
+        if self.running():
+            self.log.info(
+                f"Forwarding {signal.Signals(signum).name} to {self.command[0]}")
+            self.process.send_signal(signum)
+
+    def shutdown(self, signum):
+        """
+            Fail readiness, keep serving for the drain window, then stop pdns_server.
+            Without readiness there is nothing to drain and pdns_server is stopped right away.
+        """
+        self.stopping = True
+        if self.drain is None:
+            # Nothing reports readiness, so nobody would stop sending queries during the window
+            self.log.info(f"Received {signal.Signals(signum).name}")
+            drain_seconds = 0
+        else:
+            self.log.info(
+                f"Received {signal.Signals(signum).name}. Draining for {self.drain_seconds:g}s"
+            )
+            self.drain()
+            drain_seconds = self.drain_seconds
+        deadline = time.monotonic() + drain_seconds
+        while self.running() and time.monotonic() < deadline:
+            self.wakeup.wait(max(deadline - time.monotonic(), 0))
+            self.wakeup.clear()
+            self.reap()
+        if self.running():
+            self.log.info(f"Stopping {self.command[0]}")
+            self.process.send_signal(signal.SIGTERM)
+        deadline = time.monotonic() + self.stop_timeout
+        while self.running() and time.monotonic() < deadline:
+            self.wakeup.wait(0.1)
+            self.wakeup.clear()
+            self.reap()
+        if self.running():
+            self.log.warning(
+                f"{self.command[0]} did not stop within {self.stop_timeout:g}s. Killing it"
+            )
+            self.process.kill()
+            while self.running():
+                self.wakeup.wait(0.1)
+                self.reap()
+
+    def run(self):
+        """
+            Supervise until pdns_server exits for good. Returns its exit code.
+        """
+        if self.process is None:
+            self.start()
+        delays = backoff_delays(1, 30)
+        while True:
+            self.wakeup.wait(1)
+            self.wakeup.clear()
+            while self.pending_signals:
+                signum = self.pending_signals.pop(0)
+                if signum in stop_signals and not self.stopping:
+                    self.shutdown(signum)
+                elif signum in forwarded_signals:
+                    self.forward(signum)
+            self.reap()
+            if self.running():
+                if self.restart_deadline and time.monotonic() > self.restart_deadline:
+                    self.log.warning(
+                        f"{self.command[0]} did not stop within {self.stop_timeout:g}s. Killing it"
+                    )
+                    self.process.kill()
+                continue
+            if self.restart_deadline and not self.stopping:
+                self.restart_deadline = None
+                self.start()
+                self.restart_requested = False
+                if self.release is not None:
+                    self.release()
+                continue
+
+            code = self.process.returncode
+            self.log.info(f"{self.command[0]} exited with code {code}")
+            if self.stopping or not self.restart or code == 0:
+                return 0 if self.stopping else code
+            if time.monotonic() - self.started > 60:
+                delays = backoff_delays(1, 30)  # It ran for a while. Start over
+            delay = next(delays)
+            self.log.warning(f"Restarting {self.command[0]} in {delay:.1f}s")
+            self.wakeup.wait(delay)
+            self.wakeup.clear()
+            if any(signum in stop_signals for signum in self.pending_signals):
+                return 0
+            self.start()
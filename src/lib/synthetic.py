@@ -0,0 +1,175 @@
+import base64
+import random
+import logging
+import ipaddress
+
+from lib.config import Config
+from lib.bulk import Zone, Record
+'''
+    Deterministic synthetic zones for load testing. The same seed and sizes give the same zones,
+    records, keys and query file, so benchmark runs can be compared.
+    Addresses come from the benchmarking (198.18.0.0/15) and documentation (2001:db8::/32) ranges.
+'''
+
+log_name = f'{Config.logger_name}.synthetic'
+log = logging.getLogger(log_name)
+
+tlds = ('com', 'net', 'org', 'io', 'se')
+syllables = ('ba', 'ko', 'ri', 'ta', 'mu', 'le', 'no', 'si', 'da', 've',
+             'lo', 'ka', 'mi', 'ne', 'ro', 'tu', 'sa', 'fe', 'ju', 'pa')
+host_labels = ('www', 'api', 'app', 'cdn', 'vpn', 'git', 'shop', 'blog')
+# Type mix of the records beyond the apex set
+type_weights = (('A', 55), ('AAAA', 25), ('TXT', 12), ('MX', 8))
+ipv4_network = ipaddress.ip_network('198.18.0.0/15')
+ipv6_network = ipaddress.ip_network('2001:db8::/32')
+ttl_choices = (60, 300, 3600, 86400)
+
+
+class SyntheticDataset:
+    """
+        Generates zones for BulkLoader, DNSSEC keys for a share of them and a dnsperf query file.
+        records is the total number of records. Every zone gets at least SOA and two NS records.
+    """
+    def __init__(self,
+                 seed,
+                 zones,
+                 records,
+                 dnssec_ratio=0.0,
+                 kind='NATIVE',
+                 sample_size=100000):
+        self.log_name = f"{log_name}.{self.__class__.__name__}"
+        self.log = logging.getLogger(self.log_name)
+        self.rng = random.Random(seed)
+        # Separate stream so the query file does not change the zones and the other way around
+        self.query_rng = random.Random(f"{seed}-queries")
+        self.zone_count = zones
+        self.record_count = records
+        self.dnssec_ratio = dnssec_ratio
+        self.kind = kind
+        self.sample_size = sample_size
+        self.types = [rtype for rtype, weight in type_weights]
+        self.weights = [weight for rtype, weight in type_weights]
+        self.zone_names = []
+        self.signed_zones = []
+        self.sample = []  # Reservoir of (name, type) for hit queries
+        self.seen = 0
+
+    def label(self):
+        return ''.join(
+            self.rng.choice(syllables)
+            for i in range(self.rng.randint(2, 4)))
+
+    def ipv4(self):
+        return str(ipv4_network[self.rng.randrange(ipv4_network.num_addresses)])
+
+    def ipv6(self):
+        return str(ipv6_network[self.rng.getrandbits(64)])
+
+    def remember(self, name, rtype):
+        """
+            Reservoir sampling keeps a uniform sample of queryable names in bounded memory.
+        """
+        self.seen += 1
+        if len(self.sample) < self.sample_size:
+            self.sample.append((name, rtype))
+        else:
+            index = self.query_rng.randrange(self.seen)
+            if index < self.sample_size:
+                self.sample[index] = (name, rtype)
+
+    def random_record(self, zone, index):
+        rtype = self.rng.choices(self.types, self.weights)[0]
+        if self.rng.random() < 0.3:
+            owner = f"{self.rng.choice(host_labels)}{index}.{zone}"
+        else:
+            owner = f"{self.label()}{index}.{zone}"
+        ttl = self.rng.choice(ttl_choices)
+        if rtype == 'A':
+            return Record(owner, rtype, self.ipv4(), ttl, 0, False)
+        if rtype == 'AAAA':
+            return Record(owner, rtype, self.ipv6(), ttl, 0, False)
+        if rtype == 'MX':
+            return Record(owner, rtype, f"mail.{zone}", ttl,
+                          self.rng.choice((10, 20, 30)), False)
+        token = base64.b64encode(self.rng.getrandbits(192).to_bytes(
+            24, 'big')).decode()
+        return Record(owner, rtype, f'"verification={token}"', ttl, 0, False)
+
+    def zone(self, index, size):
+        name = f"{self.label()}{index}.{self.rng.choice(tlds)}"
+        records = [
+            Record(name, 'SOA',
+                   f"ns1.{name} hostmaster.{name} 1 10800 3600 604800 3600",
+                   3600, 0, False),
+            Record(name, 'NS', f"ns1.{name}", 86400, 0, False),
+            Record(name, 'NS', f"ns2.{name}", 86400, 0, False),
+        ]
+        apex = [
+            Record(f"ns1.{name}", 'A', self.ipv4(), 86400, 0, False),
+            Record(f"ns2.{name}", 'A', self.ipv4(), 86400, 0, False),
+            Record(name, 'MX', f"mail.{name}", 3600, 10, False),
+            Record(f"mail.{name}", 'A', self.ipv4(), 3600, 0, False),
+            Record(name, 'TXT', '"v=spf1 mx -all"', 3600, 0, False),
+        ]
+        records += apex[:max(size - len(records), 0)]
+        records += [
+            self.random_record(name, i)
+            for i in range(max(size - len(records), 0))
+        ]
+        for record in records:
+            self.remember(record.name, record.type)
+        if self.rng.random() < self.dnssec_ratio:
+            self.signed_zones.append(name)
+        self.zone_names.append(name)
+        return Zone(name, self.kind, None, None, records)
+
+    def zones(self):
+        """
+            Yield the zones. Records are spread evenly, the first zones take the remainder.
+        """
+        base, remainder = divmod(self.record_count, self.zone_count)
+        if base < 3:
+            self.log.warning(
+                f"{self.record_count} records are less than 3 per zone. Every zone gets SOA and NS records"
+            )
+        for index in range(self.zone_count):
+            yield self.zone(index, base + (1 if index < remainder else 0))
+
+    def keys(self, zone_ids):
+        """
+            (domain_id, flags, active, content) rows with one ECDSA P-256 CSK per signed zone.
+            Read after zones() was consumed.
+        """
+        rows = []
+        for name in self.signed_zones:
+            private_key = base64.b64encode(
+                self.rng.getrandbits(256).to_bytes(32, 'big')).decode()
+            rows.append((zone_ids[name], 257, True,
+                         "Private-key-format: v1.2\n"
+                         "Algorithm: 13 (ECDSAP256SHA256)\n"
+                         f"PrivateKey: {private_key}\n"))
+        return rows
+
+    def queries(self, count, hit_ratio):
+        """
+            Yield (name, type). A hit_ratio share names existing records, the rest are NXDOMAIN names in existing zones.
+        """
+        for i in range(count):
+            if self.sample and self.query_rng.random() < hit_ratio:
+                yield self.query_rng.choice(self.sample)
+            else:
+                zone = self.query_rng.choice(self.zone_names)
+                yield f"nx{self.query_rng.getrandbits(32):08x}.{zone}", 'A'
+
+
+def write_query_file(file_path, queries):
+    """
+        Write queries in the dnsperf/resperf input format, one "name type" per line.
+    """
+    written = 0
+    with open(file_path, 'w') as f:
+        for name, rtype in queries:
+            f.write(f"{name} {rtype}\n")
+            written += 1
+    log.info(f"Wrote {written} queries to {file_path}")
+    return written
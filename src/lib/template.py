@@ -1,23 +1,43 @@
 import os
 import jinja2
 import logging
+import tempfile
+import threading
 
 from lib.config import Config
+from lib.metrics import instrumentation
+
+# One jinja2 environment per template directory, shared by every Template.
+# Compiled templates stay in the environment cache and their bytecode in TEMPLATE_CACHE_DIR.
+environments = {}
+environments_lock = threading.Lock()
+
+
+def get_environment(path):
+    with environments_lock:
+        if path not in environments:
+            environments[path] = jinja2.Environment(
+                loader=jinja2.FileSystemLoader(path),
+                bytecode_cache=jinja2.FileSystemBytecodeCache(
+                    Config.template_cache_dir))
+        return environments[path]
 
 
 class Template:
-    def __init__(self):
+    def __init__(self, data=None):
         self.log_name = f'{Config.logger_name}.{self.__class__.__name__}'
         self.log = logging.getLogger(self.log_name)
         self.path = None
         self.name = None
-        self.enviroment = Config.pdns_conf
+        self.enviroment = Config.pdns_conf if data is None else data
         self.autosecondary = Config.autosecondary
 
     def render_template(self, template, output_file):
         """
             Takes template, output file and dictionary of variables.
             Renders template with variables to the specified output file.
+            The file is replaced atomically and left untouched when the content did not change.
+            Returns True if the file was written.
         """
         self.path = os.path.dirname(template)
         self.name = os.path.basename(template)
@@ -25,21 +45,49 @@ class Template:
             f"Template path: {'Path_not_provided' if self.path == '' else self.path}"
         )
         self.log.debug(f"Template name: {self.name}")
-        # Remove file if exists
-
-        if os.path.exists(output_file):
-            self.log.info(f"Removing old file [{output_file}]")
-            os.remove(output_file)
 
-        # Write rendered template into file
-        self.log.info(f"Rendering template {template} to {output_file}")
         data = self.enviroment
         autosecondary = self.autosecondary
 
-        with open(output_file, 'w') as f:
-            f.write(
-                self._load_template(self.name, self.path).render(
-                    data=data, autosecondary=autosecondary))
+        with instrumentation.span('template_render', template=self.name):
+            rendered = self._load_template(self.name, self.path).render(
+                data=data, autosecondary=autosecondary).encode()
+            if self._read(output_file) == rendered:
+                self.log.info(f"{output_file} is up to date")
+                return False
+            self.log.info(f"Rendering template {template} to {output_file}")
+            self._write_atomic(output_file, rendered)
+        return True
+
+    def _read(self, output_file):
+        try:
+            with open(output_file, 'rb') as f:
+                return f.read()
+        except OSError:
+            return None
+
+    def _write_atomic(self, output_file, content):
+        """
+            Write to a temporary file next to output_file and rename it over the old file.
+            Readers see either the old or the new content, never a missing or partial file.
+        """
+        directory = os.path.dirname(output_file) or '.'
+        try:
+            mode = os.stat(output_file).st_mode & 0o777
+        except OSError:
+            mode = 0o644
+        fd, tmp_path = tempfile.mkstemp(
+            dir=directory, prefix=f'.{os.path.basename(output_file)}.')
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                f.write(content)
+                f.flush()
+                os.fsync(f.fileno())
+            os.chmod(tmp_path, mode)
+            os.replace(tmp_path, output_file)
+        except BaseException:
+            os.unlink(tmp_path)
+            raise
 
     def _load_template(self, name, path=None):
         """
@@ -54,6 +102,5 @@ class Template:
 
         else:
             self.log.debug(f"Template path: {path}")
-        env = jinja2.Environment(loader=jinja2.FileSystemLoader(path))
 
-        return env.get_template(name)
+        return get_environment(path).get_template(name)
@@ -0,0 +1,175 @@
+import time
+import logging
+import threading
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
+
+from lib.config import Config
+from lib.metrics import instrumentation
+from lib.exporter import source_from_config
+from lib import dns
+'''
+    Cache warm-up. Replays the busiest names against the local pdns_server before it is reported ready,
+    so the first real queries hit the packet and query caches instead of the database.
+'''
+
+log_name = f'{Config.logger_name}.warmup'
+log = logging.getLogger(log_name)
+
+
+def names_from_query_log(file_path, limit):
+    """
+        Most frequent (name, type) pairs of a query log with one "name [type]" per line
+        (dnsperf format, commas are accepted as separators).
+    """
+    counter = Counter()
+    with open(file_path, 'r') as f:
+        for line in f:
+            fields = line.replace(',', ' ').split()
+            if not fields or fields[0].startswith(('#', ';')):
+                continue
+            qtype = fields[1].upper() if len(fields) > 1 else 'A'
+            if qtype in dns.QTYPES:
+                counter[(fields[0].rstrip('.').lower(), qtype)] += 1
+    return [pair for pair, count in counter.most_common(limit)]
+
+
+def names_from_records(backend, limit):
+    """
+        (name, type) pairs of the enabled records, biggest zones first.
+    """
+    types = ', '.join(f"'{qtype}'" for qtype in dns.QTYPES)
+    with backend.Session() as session:
+        rows = session.fetch_all(
+            "select r.name, r.type from records r join "
+            "(select domain_id, count(*) as size from records group by domain_id) z "
+            "on z.domain_id = r.domain_id "
+            f"where not r.disabled and r.type in ({types}) "
+            f"order by z.size desc, r.domain_id, r.name limit {int(limit)}")
+    return list(dict.fromkeys((name, qtype) for name, qtype in rows))
+
+
+def cache_counters(source):
+    """
+        (packet cache hits, misses) from pdns_server, or None when the statistics are not reachable.
+    """
+    try:
+        stats = source.fetch()
+        return stats.get('packetcache-hit', 0), stats.get('packetcache-miss', 0)
+    except (OSError, ValueError) as error:
+        log.debug(f"Cache statistics not available: {error}")
+        source.close()
+        return None
+
+
+def hit_ratio(before, after):
+    if before is None or after is None:
+        return None
+    hits, misses = after[0] - before[0], after[1] - before[1]
+    return hits / (hits + misses) if hits + misses > 0 else None
+
+
+def median(values):
+    values = sorted(values)
+    return values[len(values) // 2] if values else None
+
+
+class Warmup(threading.Thread):
+    """
+        Replays the names returned by load_names with bounded concurrency inside a time budget, then sets done.
+        Names are loaded in the thread so that ranking a large records table does not delay the launch.
+        A short second pass over a sample of the names measures how much the caches improved.
+    """
+    def __init__(self, load_names, concurrency, budget, verify=100):
+        super().__init__(name='warmup', daemon=True)
+        self.log_name = f"{log_name}.{self.__class__.__name__}"
+        self.log = logging.getLogger(self.log_name)
+        self.host, self.port = dns.local_target(Config.pdns_conf)
+        self.load_names = load_names
+        self.names = []
+        self.concurrency = concurrency
+        self.budget = budget
+        self.verify = verify
+        self.deadline = None
+        self.done = threading.Event()
+
+    def query(self, pair):
+        """
+            Latency of one answer in seconds or None if it failed or the budget is spent.
+        """
+        if time.monotonic() >= self.deadline:
+            return None
+        started = time.perf_counter()
+        try:
+            dns.query(self.host,
+                      self.port,
+                      pair[0],
+                      pair[1],
+                      timeout=min(1.0, max(self.deadline - time.monotonic(), 0.01)))
+        except (OSError, ValueError):
+            return None
+        return time.perf_counter() - started
+
+    def replay(self, names):
+        source = source_from_config()
+        before = cache_counters(source)
+        with ThreadPoolExecutor(max_workers=self.concurrency,
+                                thread_name_prefix='warmup') as executor:
+            latencies = [
+                latency for latency in executor.map(self.query, names)
+                if latency is not None
+            ]
+        after = cache_counters(source)
+        source.close()
+        return latencies, hit_ratio(before, after)
+
+    def wait_for_answer(self):
+        while time.monotonic() < self.deadline:
+            try:
+                dns.query(self.host, self.port, '.', 'SOA', timeout=0.5)
+                return True
+            except (OSError, ValueError):
+                time.sleep(0.05)
+        return False
+
+    def run(self):
+        self.deadline = time.monotonic() + self.budget
+        try:
+            with instrumentation.span('cache_warmup'):
+                try:
+                    self.names = self.load_names()
+                except (OSError, SystemExit) as error:
+                    # Database helpers exit on errors. Do not hold back readiness for it
+                    self.log.warning(f"Unable to load warm-up names: {error}")
+                    return
+                if not self.wait_for_answer():
+                    self.log.warning(
+                        "PowerDNS did not answer within the warm-up budget")
+                    return
+                self.log.info(
+                    f"Warming up with {len(self.names)} name(s), {self.concurrency} at a time, within {self.budget:g}s"
+                )
+                started = time.perf_counter()
+                cold, cold_ratio = self.replay(self.names)
+                elapsed = time.perf_counter() - started
+                self.log.info(
+                    f"Replayed {len(cold)}/{len(self.names)} name(s) in {elapsed:.1f}s"
+                )
+                if time.monotonic() >= self.deadline:
+                    self.log.warning(
+                        "Warm-up budget spent before all names were replayed")
+                    return
+                warm, warm_ratio = self.replay(self.names[:self.verify])
+                self.report(cold, cold_ratio, warm, warm_ratio)
+        finally:
+            self.done.set()
+
+    def report(self, cold, cold_ratio, warm, warm_ratio):
+        if cold_ratio is not None and warm_ratio is not None:
+            self.log.info(
+                f"Packet cache hit ratio: {cold_ratio:.0%} during warm-up, {warm_ratio:.0%} afterwards"
+            )
+        if cold and warm:
+            self.log.info(
+                f"Median latency: {median(cold) * 1000:.2f} ms cold, {median(warm) * 1000:.2f} ms warm"
+            )
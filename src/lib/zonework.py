@@ -0,0 +1,175 @@
+import os
+import time
+import logging
+import threading
+import subprocess
+from concurrent.futures import ThreadPoolExecutor, as_completed
+
+from lib.config import Config
+from lib.metrics import instrumentation
+'''
+    Runs pdnsutil rectify-zone (and secure-zone) over many zones with a bounded pool of pdnsutil processes.
+    Zones are handed out in batches because pdnsutil accepts several zones per call and its start is
+    the expensive part. A failing batch is retried zone by zone to find the zone that failed.
+    Completed zones are appended to a checkpoint file so an interrupted run continues where it stopped.
+'''
+
+log_name = f'{Config.logger_name}.zonework'
+log = logging.getLogger(log_name)
+
+
+def list_zones(session, include_secondaries=False):
+    """
+        (name, has keys) of the zones in the domains table. Secondary zones are signed by their primary.
+    """
+    query = ("SELECT d.name, EXISTS (SELECT 1 FROM cryptokeys k WHERE k.domain_id = d.id) "
+             "FROM domains d")
+    if not include_secondaries:
+        query += " WHERE upper(d.type) NOT IN ('SLAVE', 'SECONDARY')"
+    return [(name, bool(keys))
+            for name, keys in session.fetch_all(query + " ORDER BY d.name")]
+
+
+class Checkpoint:
+    """
+        Append only list of completed zones. A partly written last line is ignored.
+    """
+    def __init__(self, file_path):
+        self.file_path = file_path
+        self.lock = threading.Lock()
+
+    def load(self):
+        try:
+            with open(self.file_path, 'r') as f:
+                return {
+                    line[:-1]
+                    for line in f if line.endswith('\n') and len(line) > 1
+                }
+        except FileNotFoundError:
+            return set()
+
+    def add(self, zones):
+        with self.lock, open(self.file_path, 'a') as f:
+            f.write(''.join(f"{zone}\n" for zone in zones))
+            f.flush()
+            os.fsync(f.fileno())
+
+    def remove(self):
+        if os.path.exists(self.file_path):
+            os.unlink(self.file_path)
+
+
+def pdnsutil(*args):
+    result = subprocess.run(['pdnsutil'] + list(args),
+                            stdout=subprocess.PIPE,
+                            stderr=subprocess.STDOUT,
+                            universal_newlines=True)
+    return result.returncode, result.stdout.strip()
+
+
+class ZoneWorkerPool:
+    """
+        keyed_zones returns the names of the zones that have keys now. It is asked when a batch failed
+        after secure-zone may have secured part of it.
+    """
+    def __init__(self, workers, batch_size=50, checkpoint=None, keyed_zones=None):
+        self.log_name = f"{log_name}.{self.__class__.__name__}"
+        self.log = logging.getLogger(self.log_name)
+        self.workers = workers
+        self.batch_size = batch_size
+        self.checkpoint = checkpoint
+        self.keyed_zones = keyed_zones
+        self.lock = threading.Lock()
+        self.done = 0
+        self.failed = {}
+        self.total = 0
+        self.started = None
+        self.last_report = 0
+
+    def process(self, zones, secure):
+        """
+            Secure the zones without keys if asked and rectify all of them.
+            Returns (completed zones, {zone: error}).
+        """
+        steps = []
+        unsigned = [name for name, keys in zones if not keys]
+        if secure and unsigned:
+            steps.append(['secure-zone'] + unsigned)
+        steps.append(['rectify-zone'] + [name for name, keys in zones])
+        secured = False
+        for step in steps:
+            code, output = pdnsutil(*step)
+            if code == 0:
+                secured = secured or step[0] == 'secure-zone'
+                continue
+            if len(zones) == 1:
+                error = output.splitlines()[-1] if output else f"exited with code {code}"
+                return [], {zones[0][0]: f"{step[0]}: {error}"}
+            # Find the failing zones. Zones secured in this batch already have keys now,
+            # a failed secure-zone may have secured some of them before it stopped
+            keyed = set()
+            if step[0] == 'secure-zone' and self.keyed_zones is not None:
+                keyed = self.keyed_zones()
+            completed, failed = [], {}
+            for name, keys in zones:
+                ok, errors = self.process(
+                    [(name, keys or secured or name in keyed)], secure)
+                completed += ok
+                failed.update(errors)
+            return completed, failed
+        return [name for name, keys in zones], {}
+
+    def batch_done(self, completed, failed):
+        if self.checkpoint is not None and completed:
+            self.checkpoint.add(completed)
+        with self.lock:
+            self.done += len(completed) + len(failed)
+            self.failed.update(failed)
+            for zone, error in failed.items():
+                self.log.error(f"{zone}: {error}")
+            now = time.perf_counter()
+            if now - self.last_report >= 10 or self.done == self.total:
+                self.last_report = now
+                self.report()
+
+    def report(self):
+        elapsed = time.perf_counter() - self.started
+        rate = self.done / elapsed if elapsed > 0 else 0
+        remaining = (self.total - self.done) / rate if rate > 0 else 0
+        self.log.info(
+            f"{self.done}/{self.total} zone(s) in {elapsed:.1f}s ({rate:.1f} zones/s, "
+            f"{len(self.failed)} failed, about {remaining:.0f}s left)")
+
+    def run(self, zones, secure=False):
+        """
+            Process (name, has keys) zones that are not in the checkpoint yet. Returns {zone: error} of the failures.
+        """
+        if self.checkpoint is not None:
+            completed = self.checkpoint.load()
+            if completed:
+                self.log.info(
+                    f"Resuming: {len(completed)} zone(s) are already done according to {self.checkpoint.file_path}"
+                )
+            zones = [zone for zone in zones if zone[0] not in completed]
+        self.total = len(zones)
+        self.started = time.perf_counter()
+        action = 'secure-zone and rectify-zone' if secure else 'rectify-zone'
+        self.log.info(
+            f"Running {action} on {self.total} zone(s) with {self.workers} worker(s)")
+        batches = [
+            zones[i:i + self.batch_size]
+            for i in range(0, len(zones), self.batch_size)
+        ]
+        with instrumentation.span('zone_maintenance',
+                                  action='secure' if secure else 'rectify'):
+            with ThreadPoolExecutor(max_workers=self.workers,
+                                    thread_name_prefix='pdnsutil') as executor:
+                futures = [
+                    executor.submit(self.process, batch, secure)
+                    for batch in batches
+                ]
+                for future in as_completed(futures):
+                    self.batch_done(*future.result())
+        if self.checkpoint is not None and not self.failed:
+            self.checkpoint.remove()
+        return self.failed
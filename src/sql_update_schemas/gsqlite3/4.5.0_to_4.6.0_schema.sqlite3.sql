@@ -0,0 +1,2 @@
+BEGIN TRANSACTION;
+COMMIT;
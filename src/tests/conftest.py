@@ -0,0 +1,5 @@
+import os
+
+# lib.config reads these when it is imported
+os.environ.setdefault('POWERDNS_VERSION', '46')
+os.environ.setdefault('EXEC_MODE', 'DOCKER')
@@ -0,0 +1,7 @@
+from lib.config import get_profile_pdns_conf, sqlite_profiles
+
+
+def test_journal_mode_only_on_versions_that_accept_it():
+    profile = sqlite_profiles['performance']
+    assert 'gsqlite3-pragma-journal-mode' not in get_profile_pdns_conf(profile, '42')
+    assert get_profile_pdns_conf(profile, '44') == {'gsqlite3-pragma-journal-mode': 'WAL'}
@@ -0,0 +1,27 @@
+import struct
+
+import pytest
+
+from lib import dns
+
+
+def answer(*records):
+    header = struct.pack('!HHHHHH', 1, 0x8180, 1, len(records), 0, 0)
+    question = dns.encode_name('example.com') + struct.pack('!HH', 1, 1)
+    return header + question + b''.join(records)
+
+
+def a_record(address, ttl=300):
+    return b'\xc0\x0c' + struct.pack('!HHIH', 1, 1, ttl, 4) + bytes(address)
+
+
+def test_parse_addresses():
+    data = answer(a_record([192, 0, 2, 1]), a_record([192, 0, 2, 2], 60))
+    assert dns.parse_addresses(data) == [('192.0.2.1', 300), ('192.0.2.2', 60)]
+
+
+@pytest.mark.parametrize('cut', [14, 30, -8, -3])
+def test_parse_addresses_truncated(cut):
+    data = answer(a_record([192, 0, 2, 1]))
+    with pytest.raises(ValueError):
+        dns.parse_addresses(data[:cut])
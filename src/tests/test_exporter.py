@@ -0,0 +1,144 @@
+import os
+import socket
+import threading
+
+import pytest
+
+from lib.exporter import ControlSocketSource, Exporter, latency_buckets, parse_show_all
+
+
+class StandInControlSocket(threading.Thread):
+    """
+        Answers "show *" on an AF_UNIX socket like pdns_server, one canned answer per command.
+    """
+    def __init__(self, path, answers):
+        super().__init__(daemon=True)
+        self.path = path
+        self.answers = list(answers)
+        self.commands = []
+        self.connections = 0
+        self.server = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.server.bind(path)
+        self.server.listen(1)
+
+    def run(self):
+        while True:
+            try:
+                conn, address = self.server.accept()
+            except OSError:
+                return
+            self.connections += 1
+            with conn:
+                data = b''
+                while True:
+                    chunk = conn.recv(4096)
+                    if not chunk:
+                        break
+                    data += chunk
+                    while b'\n' in data:
+                        line, data = data.split(b'\n', 1)
+                        self.commands.append(line.decode())
+                        conn.sendall(self.answers.pop(0).encode() + b'\0\n')
+
+    def close(self):
+        self.server.close()
+
+
+def show_all(**stats):
+    return ''.join(f"{name.replace('_', '-')}={value}," for name, value in stats.items())
+
+
+@pytest.fixture
+def control_socket(tmp_path):
+    servers = []
+
+    def start(*answers):
+        server = StandInControlSocket(str(tmp_path / 'pdns.controlsocket'), answers)
+        server.start()
+        servers.append(server)
+        return server
+
+    yield start
+    for server in servers:
+        server.close()
+
+
+def test_parse_show_all_skips_malformed_items():
+    assert parse_show_all("udp-queries=10,latency=250,\nbroken,uptime=x,") == {
+        'udp-queries': 10.0,
+        'latency': 250.0,
+    }
+
+
+def test_control_socket_source_reuses_the_connection(control_socket):
+    server = control_socket(show_all(udp_queries=1), show_all(udp_queries=2))
+    source = ControlSocketSource(server.path)
+    try:
+        assert source.fetch() == {'udp-queries': 1.0}
+        assert source.fetch() == {'udp-queries': 2.0}
+    finally:
+        source.close()
+    assert server.commands == ['show *', 'show *']
+    assert server.connections == 1
+
+
+def test_derived_rates(control_socket):
+    server = control_socket(
+        show_all(udp_queries=100, tcp_queries=0, packetcache_hit=10,
+                 packetcache_miss=10, backend_queries=5, latency=200),
+        show_all(udp_queries=280, tcp_queries=20, packetcache_hit=85,
+                 packetcache_miss=35, backend_queries=45, latency=800))
+    exporter = Exporter(ControlSocketSource(server.path), 10)
+    try:
+        exporter.update(exporter.source.fetch(), 100.0)
+        assert exporter.derived == {}
+        exporter.update(exporter.source.fetch(), 110.0)
+    finally:
+        exporter.source.close()
+    assert exporter.derived['queries_per_second'] == pytest.approx(20.0)
+    assert exporter.derived['packetcache_hit_ratio'] == pytest.approx(0.75)
+    assert exporter.derived['backend_queries_per_second'] == pytest.approx(4.0)
+    assert 'query_cache_hit_ratio' not in exporter.derived
+    # 200us and 800us
+    assert exporter.latency_count == 2
+    assert exporter.latency_counts[latency_buckets.index(0.00025)] == 1
+    assert exporter.latency_counts[latency_buckets.index(0.001)] == 2
+
+
+def test_counter_restart_gives_no_negative_rates(control_socket):
+    server = control_socket(show_all(udp_queries=500), show_all(udp_queries=20))
+    exporter = Exporter(ControlSocketSource(server.path), 10)
+    try:
+        exporter.update(exporter.source.fetch(), 0.0)
+        exporter.update(exporter.source.fetch(), 5.0)
+    finally:
+        exporter.source.close()
+    assert exporter.derived['queries_per_second'] == 0
+
+
+def test_prometheus_text(control_socket):
+    server = control_socket(show_all(udp_queries=7, latency=300))
+    exporter = Exporter(ControlSocketSource(server.path), 10)
+    try:
+        assert exporter.poll()
+    finally:
+        exporter.source.close()
+    lines = exporter.prometheus_text().splitlines()
+    assert 'pdns_auth_exporter_poll_failures_total 0' in lines
+    assert '# TYPE pdns_auth_udp_queries untyped' in lines
+    assert 'pdns_auth_udp_queries 7' in lines
+    assert '# TYPE pdns_auth_sampled_latency_seconds histogram' in lines
+    assert 'pdns_auth_sampled_latency_seconds_bucket{le="0.00025"} 0' in lines
+    assert 'pdns_auth_sampled_latency_seconds_bucket{le="0.0005"} 1' in lines
+    assert 'pdns_auth_sampled_latency_seconds_bucket{le="+Inf"} 1' in lines
+    assert 'pdns_auth_sampled_latency_seconds_count 1' in lines
+    assert any(line.startswith('pdns_auth_exporter_poll_duration_seconds ')
+               for line in lines)
+
+
+def test_poll_counts_failures_without_pdns_server(tmp_path):
+    exporter = Exporter(
+        ControlSocketSource(os.path.join(str(tmp_path), 'missing.controlsocket')), 10)
+    assert not exporter.poll()
+    assert 'pdns_auth_exporter_poll_failures_total 1' in exporter.prometheus_text()
+
@@ -0,0 +1,46 @@
+import pytest
+
+from lib.readiness import ReadinessProbe
+
+
+@pytest.fixture
+def probe(monkeypatch):
+    probe = ReadinessProbe(zones=['example.com'])
+    answers = {'reason': None}
+    monkeypatch.setattr(probe, 'probe_zone', lambda zone, tcp: answers['reason'])
+    probe.answers = answers
+    return probe
+
+
+def test_hold_fails_readiness_until_the_probe_answers_again(probe):
+    probe.step()
+    assert probe.ready
+
+    probe.hold()
+    assert not probe.ready
+    assert probe.http_handler()[0] == 503
+    probe.step()
+    assert not probe.ready
+
+    # Released, but the restarted pdns_server does not answer yet
+    probe.release()
+    probe.answers['reason'] = 'example.com over udp: timeout'
+    probe.step()
+    assert not probe.ready
+    probe.answers['reason'] = None
+    probe.step()
+    assert probe.ready
+
+
+def test_probe_that_finished_after_hold_does_not_report_ready(probe, monkeypatch):
+    probe.step()
+    original = probe.probe
+
+    def probe_then_hold():
+        reason = original()
+        probe.hold()  # The restart began while this probe was in flight
+        return reason
+
+    monkeypatch.setattr(probe, 'probe', probe_then_hold)
+    probe.step()
+    assert not probe.ready
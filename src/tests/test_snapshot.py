@@ -0,0 +1,119 @@
+import os
+import sqlite3
+
+import pytest
+
+from lib import snapshot
+
+schema_path = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))),
+                           'sql_schemas', '4.1.0_schema.sqlite3.sql')
+
+
+@pytest.fixture
+def primary(tmp_path):
+    """
+        A primary database with a signed and an unsigned zone of every kind.
+    """
+    database = str(tmp_path / 'primary.db')
+    conn = sqlite3.connect(database)
+    with open(schema_path) as f:
+        conn.executescript(f.read())
+    conn.execute("CREATE TABLE pdns_meta (db_version TEXT)")
+    zones = [
+        ('signed-native.com', 'NATIVE', True),
+        ('native.com', 'NATIVE', False),
+        ('signed-master.com', 'MASTER', True),
+        ('master.com', 'MASTER', False),
+        ('slave.com', 'SLAVE', False),
+    ]
+    for name, kind, signed in zones:
+        domain_id = conn.execute(
+            "INSERT INTO domains (name, type, master) VALUES (?, ?, ?)",
+            (name, kind, '192.0.2.53' if kind == 'SLAVE' else None)).lastrowid
+        conn.executemany(
+            "INSERT INTO records (domain_id, name, type, content, ttl) VALUES (?, ?, ?, ?, 3600)",
+            [(domain_id, name, 'SOA', f'ns1.{name} hostmaster.{name} 1 10800 3600 604800 3600'),
+             (domain_id, name, 'NS', f'ns1.{name}')])
+        if signed:
+            conn.execute(
+                "INSERT INTO cryptokeys (domain_id, flags, active, content) VALUES (?, 257, 1, 'key')",
+                (domain_id, ))
+    conn.execute("INSERT INTO supermasters VALUES ('192.0.2.1', 'ns1.example.com', 'admin')")
+    conn.commit()
+    conn.close()
+    return database
+
+
+def bootstrapped(primary, tmp_path):
+    exported = str(tmp_path / 'export.db')
+    secondary = str(tmp_path / 'secondary.db')
+    snapshot.export_snapshot(primary, exported)
+    assert snapshot.bootstrap(exported, secondary, ['192.0.2.1', '192.0.2.2'])
+    conn = sqlite3.connect(secondary)
+    zones = {
+        name: (kind, master, records)
+        for name, kind, master, records in conn.execute(
+            "SELECT d.name, d.type, d.master, "
+            "(SELECT count(*) FROM records r WHERE r.domain_id = d.id) FROM domains d")
+    }
+    return conn, zones
+
+
+def test_bootstrap_converts_primary_and_native_zones(primary, tmp_path):
+    conn, zones = bootstrapped(primary, tmp_path)
+    for name in ('native.com', 'master.com'):
+        assert zones[name] == ('SLAVE', '192.0.2.1,192.0.2.2', 2)
+    # Secondary zones of the primary keep their own primary
+    assert zones['slave.com'] == ('SLAVE', '192.0.2.53', 2)
+    assert conn.execute("SELECT count(*) FROM cryptokeys").fetchone()[0] == 0
+    assert conn.execute("SELECT count(*) FROM supermasters").fetchone()[0] == 0
+
+
+def test_bootstrap_transfers_signed_zones(primary, tmp_path):
+    conn, zones = bootstrapped(primary, tmp_path)
+    for name in ('signed-native.com', 'signed-master.com'):
+        assert zones[name] == ('SLAVE', '192.0.2.1,192.0.2.2', 0)
+    assert conn.execute(
+        "SELECT count(*) FROM domains WHERE name LIKE 'signed-%' AND last_check IS NULL"
+    ).fetchone()[0] == 2
+
+
+def test_bootstrap_keeps_a_database_with_zones(primary, tmp_path):
+    exported = str(tmp_path / 'export.db')
+    snapshot.export_snapshot(primary, exported)
+    assert not snapshot.bootstrap(exported, primary, ['192.0.2.1'])
+
+
+def test_restore_replaces_a_database_in_wal_mode(primary, tmp_path):
+    conn = sqlite3.connect(primary)
+    conn.execute("INSERT INTO pdns_meta VALUES ('4.1.0')")
+    conn.commit()
+    conn.close()
+    saved = str(tmp_path / 'saved.snapshot')
+    snapshot.export_snapshot(primary, saved)
+
+    # Committed changes that are only in the WAL of the live database
+    live = sqlite3.connect(primary)
+    live.execute("PRAGMA journal_mode=WAL")
+    live.execute("PRAGMA wal_autocheckpoint=0")
+    live.execute("UPDATE pdns_meta SET db_version = '4.6.0'")
+    live.execute("DELETE FROM records")
+    live.commit()
+    assert os.path.getsize(primary + '-wal') > 0
+
+    assert snapshot.restore_snapshot(primary, saved) == '4.1.0'
+    live.close()
+    conn = sqlite3.connect(primary)
+    assert conn.execute("PRAGMA integrity_check").fetchone()[0] == 'ok'
+    assert conn.execute("SELECT db_version FROM pdns_meta").fetchone()[0] == '4.1.0'
+    assert conn.execute("SELECT count(*) FROM records").fetchone()[0] == 10
+
+
+def test_failed_restore_keeps_the_database(primary, tmp_path):
+    broken = str(tmp_path / 'broken.snapshot')
+    with open(broken, 'wb') as f:
+        f.write(b'not a database')
+    with pytest.raises(SystemExit):
+        snapshot.restore_snapshot(primary, broken)
+    conn = sqlite3.connect(primary)
+    assert conn.execute("SELECT count(*) FROM records").fetchone()[0] == 10
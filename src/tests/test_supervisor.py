@@ -0,0 +1,117 @@
+import signal
+import threading
+import time
+
+import pytest
+
+from lib.supervisor import Supervisor, forwarded_signals, stop_signals
+
+
+@pytest.fixture(autouse=True)
+def signal_handlers():
+    """
+        Supervisor.start installs handlers for the whole process. Put back those of pytest.
+    """
+    signums = forwarded_signals + stop_signals + [signal.SIGCHLD]
+    saved = {signum: signal.getsignal(signum) for signum in signums}
+    yield
+    for signum, handler in saved.items():
+        signal.signal(signum, handler)
+
+
+class Events:
+    def __init__(self):
+        self.events = []
+
+    def __call__(self, name):
+        return lambda: self.events.append(name)
+
+
+def supervise(**kwargs):
+    supervisor = Supervisor(['sleep', '30'], stop_timeout=5, **kwargs)
+    supervisor.start()
+    thread = threading.Thread(target=supervisor.run, daemon=True)
+    thread.start()
+    return supervisor, thread
+
+
+def stop(supervisor, thread):
+    supervisor.handle_signal(signal.SIGTERM, None)
+    thread.join(10)
+    assert not thread.is_alive()
+
+
+def wait_for(condition, timeout=5):
+    deadline = time.monotonic() + timeout
+    while not condition():
+        assert time.monotonic() < deadline
+        time.sleep(0.01)
+
+
+def test_stop_drains_with_readiness():
+    events = Events()
+    supervisor, thread = supervise(drain=events('drain'), drain_seconds=0.3)
+    process = supervisor.process
+    started = time.monotonic()
+    stop(supervisor, thread)
+    assert time.monotonic() - started >= 0.3
+    assert events.events == ['drain']
+    assert process.returncode == -signal.SIGTERM
+
+
+def test_stop_without_readiness_does_not_wait():
+    supervisor, thread = supervise(drain_seconds=5)
+    started = time.monotonic()
+    stop(supervisor, thread)
+    assert time.monotonic() - started < 2
+
+
+def test_child_exit_wakes_the_main_loop():
+    supervisor, thread = supervise()
+    supervisor.process.terminate()
+    # SIGCHLD sets the wake-up from the signal handler in this thread
+    thread.join(5)
+    assert not thread.is_alive()
+
+
+def test_restart_drains_and_releases_after_the_start():
+    events = Events()
+    supervisor, thread = supervise(hold=events('hold'),
+                                   release=events('release'),
+                                   drain_seconds=0.3)
+    first = supervisor.process
+    requested = time.monotonic()
+    supervisor.request_restart()
+    # pdns_server kept answering for the drain window
+    assert time.monotonic() - requested >= 0.3
+    assert events.events[0] == 'hold'
+    wait_for(lambda: events.events == ['hold', 'release'])
+    assert supervisor.process is not first
+    assert supervisor.running()
+    assert first.returncode == -signal.SIGTERM
+    stop(supervisor, thread)
+
+
+def test_restart_without_readiness_does_not_wait():
+    supervisor, thread = supervise(drain_seconds=5)
+    first = supervisor.process
+    requested = time.monotonic()
+    supervisor.request_restart()
+    wait_for(lambda: supervisor.process is not first and supervisor.running())
+    assert time.monotonic() - requested < 2
+    stop(supervisor, thread)
+
+
+def test_stop_during_the_restart_drain_does_not_restart():
+    events = Events()
+    supervisor, thread = supervise(hold=events('hold'),
+                                   release=events('release'),
+                                   drain_seconds=2)
+    first = supervisor.process
+    restart = threading.Thread(target=supervisor.request_restart)
+    restart.start()
+    wait_for(lambda: events.events)
+    stop(supervisor, thread)
+    restart.join(5)
+    assert supervisor.process is first
+    assert events.events == ['hold']